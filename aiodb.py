@@ -0,0 +1,143 @@
+"""
+asyncio front-end for the db module.
+
+peewee and sqlite3 block, so every call is shipped to a dedicated DB thread
+(writes, and reads without a reader pool) or to a small executor sharing
+db's reader pool. Single-pair lookups arriving within ``window`` seconds of
+each other are coalesced into one ``db.get_results`` batch query.
+
+    adb = await AsyncDB.open("results.db", wal=True, readers=4)
+    val = await adb.get(a, b)
+    await adb.bulk_insert(db.Result, rows, on_conflict='update')
+    await adb.close()
+
+Only one AsyncDB may be open at a time, as db itself holds one database.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import db
+
+class AsyncDB:
+    def __init__(self, window=0.001, max_batch=10000, method='json', readers=0):
+        self.window = window       # seconds to wait for more lookups
+        self.max_batch = max_batch # send a batch early once this many pairs wait
+        self.method = method       # lookup strategy of batches, None = planner
+        self.batches = 0           # lookup batches sent
+        self.lookups = 0           # get() calls served
+
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix="db-writer")
+        self._reader = self._writer
+        if readers:
+            self._reader = ThreadPoolExecutor(
+                readers, thread_name_prefix="db-reader"
+            )
+        self._pending = {} # (a, b) -> futures waiting on it
+        self._timer = None
+        self._tasks = set()
+
+    @classmethod
+    async def open(cls, path, wal=False, layout=None, readers=0, timeout=5.0,
+                   cache_size=0, profile=None, pragmas=None, **kwargs):
+        """``db.open`` on the DB thread; ``kwargs`` go to the constructor."""
+        adb = cls(readers=readers, **kwargs)
+        await adb._run(
+            adb._writer, db.open, path, wal=wal, layout=layout,
+            readers=readers, timeout=timeout, cache_size=cache_size,
+            profile=profile, pragmas=pragmas
+        )
+        return adb
+
+    async def close(self):
+        """Answer waiting lookups, then ``db.close`` on the DB thread."""
+        self._flush()
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self._run(self._writer, db.close)
+        if self._reader is not self._writer:
+            self._reader.shutdown()
+        self._writer.shutdown()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def _run(self, executor, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(executor, partial(func, *args, **kwargs))
+
+    ## Coalesced lookups
+    async def get(self, a, b):
+        """``val`` of pair ``(a, b)`` in either order, None if missing."""
+        if a == b:
+            raise ValueError(f"Invalid query pair: {a}, {b}")
+        key = (a, b) if a < b else (b, a)
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._pending.setdefault(key, []).append(fut)
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await fut
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        task = asyncio.get_running_loop().create_task(self._lookup(pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _lookup(self, pending):
+        self.batches += 1
+        try:
+            vals = await self._run(
+                self._reader, db.get_results, list(pending), self.method
+            )
+        except Exception as e:
+            for futs in pending.values():
+                for fut in futs:
+                    if not fut.done():
+                        fut.set_exception(e)
+            return
+        for key, futs in pending.items():
+            self.lookups += len(futs)
+            val = vals.get(key)
+            for fut in futs:
+                if not fut.done(): # the caller may have been cancelled
+                    fut.set_result(val)
+
+    ## Batch reads
+    async def get_results(self, pairs, method=None, out='dict'):
+        return await self._run(
+            self._reader, db.get_results, list(pairs), method, out
+        )
+
+    async def get_submatrix(self, ids1, ids2=None, **kwargs):
+        return await self._run(
+            self._reader, db.get_submatrix, ids1, ids2, **kwargs
+        )
+
+    async def get_cross(self, ids_a, ids_b, out='dict'):
+        return await self._run(self._reader, db.get_cross, ids_a, ids_b, out)
+
+    ## Writes, serialized on the DB thread
+    async def bulk_insert(self, model, rows, **kwargs):
+        return await self._run(
+            self._writer, db.bulk_insert, model, rows, **kwargs
+        )
+
+    async def claim_batch(self, worker_id, n, lease_time=600.0):
+        return await self._run(
+            self._writer, db.claim_batch, worker_id, n, lease_time
+        )
+
+    async def run(self, func, *args, **kwargs):
+        """Run any blocking ``func`` using db on the DB thread."""
+        return await self._run(self._writer, func, *args, **kwargs)
@@ -0,0 +1,309 @@
+"""
+Compare benchmark results written by ``utils.bench``.
+
+    python compare.py data/base.json data/new.json [more.json ...]
+
+The first file is the baseline. Runs are lined up by method and option, and
+every later file is reported as RPS and speedup over the baseline in
+markdown tables like those of the readme. A speedup is marked ``*`` when
+Welch's t-test on the run times finds it significant at 95%. The exit code
+is 1 when any method gets slower than ``--threshold`` (significantly, when
+both sides have at least 2 runs), or starts to time out or fail.
+"""
+import argparse
+import json
+import math
+import os
+import statistics
+import sys
+from utils import t95
+
+# Options that differ between runs without changing the workload
+IGNORED_FIELDS = {"bench_id", "sample_path_fmt", "test_db_path"}
+
+
+def load(path):
+    with open(path) as f:
+        rcd = json.load(f)
+    # files written before bench() recorded the name are named after the file
+    rcd.setdefault("name", os.path.splitext(os.path.basename(path))[0])
+    return rcd
+
+
+def option_key(opt, fields):
+    return json.dumps({k: opt.get(k) for k in fields}, sort_keys=True)
+
+
+_guessed = set() # methods row_count warned about
+
+def row_count(method, opt, rows="auto", extras=()):
+    """
+    Rows touched by one run of ``method`` on ``opt``, see ``--rows``. With
+    "auto", the ``rows`` or ``pairs`` recorded in the ``extras`` of the runs
+    win; without them the count is guessed from the method name and the
+    option fields, with a warning, as the guess is wrong for some methods.
+    """
+    if rows == "auto":
+        counts = [e.get("rows", e.get("pairs")) for e in extras if e]
+        counts = [c for c in counts if c is not None]
+        if counts:
+            return statistics.fmean(counts)
+        if method not in _guessed:
+            _guessed.add(method)
+            print(f"warning: {method} recorded no row count, guessing it "
+                  f"from the options; pass --rows to set it", file=sys.stderr)
+    if rows == "pairs" or (rows == "auto" and "_qry" not in method and (
+        "_rst_" in method or "alloc" in method
+    )):
+        n = opt["sample_count"]
+        return n * (n - 1) // 2
+    if rows != "auto":
+        return opt[rows]
+    if "qry_count" in opt:
+        return opt["qry_count"]
+    if "report_count" in opt:
+        return opt["report_count"]
+    if "results_per_writer" in opt:
+        return opt["writers"] * opt["results_per_writer"]
+    return opt["sample_count"]
+
+
+def times_of(records, method, idx):
+    """Successful run times; None if the method never ran on the option."""
+    rst = records["results"].get(method)
+    if rst is None:
+        return None
+    return [t for t in rst[idx] if t is not None and t >= 0]
+
+
+def extras_of(records, method, idx):
+    """Extras recorded by the runs of ``method`` on option ``idx``."""
+    per_opt = records.get("extra", {}).get(method)
+    return per_opt[idx] if per_opt else []
+
+
+def welch(xs, ys):
+    """True when the means of xs and ys differ at 95%, None if untestable."""
+    if len(xs) < 2 or len(ys) < 2:
+        return None
+    vx = statistics.variance(xs) / len(xs)
+    vy = statistics.variance(ys) / len(ys)
+    diff = statistics.fmean(xs) - statistics.fmean(ys)
+    if vx + vy == 0:
+        return diff != 0
+    df = (vx + vy) ** 2 / (
+        vx ** 2 / (len(xs) - 1) + vy ** 2 / (len(ys) - 1)
+    )
+    df = max(1, math.floor(df))
+    return abs(diff) / math.sqrt(vx + vy) > t95(df)
+
+
+def compare(files, threshold=0.05, rows="auto"):
+    """
+    Line up the runs of ``files`` (loaded records) on the baseline. Returns
+    the markdown table rows and the list of regressions.
+    """
+    base = files[0]
+    fields = set.intersection(*(
+        set(opt) for rcd in files for opt in rcd["options"]
+    )) - IGNORED_FIELDS
+    index = [
+        {option_key(opt, fields): i for i, opt in enumerate(rcd["options"])}
+        for rcd in files
+    ]
+    # only show the option fields that vary, like the readme tables
+    shown = sorted(
+        k for k in fields
+        if len({json.dumps(opt.get(k)) for opt in base["options"]}) > 1
+    ) or sorted(fields)[:1]
+
+    lines, regressions = [], []
+    for method in base["results"]:
+        for bidx, opt in enumerate(base["options"]):
+            key = option_key(opt, fields)
+            label = ", ".join(f"{k} = {opt.get(k)}" for k in shown)
+            n_rows = row_count(method, opt, rows, extras_of(base, method, bidx))
+            base_t = times_of(base, method, bidx)
+            cells = [__cell(n_rows, base_t)]
+            for rcd, idx in zip(files[1:], index[1:]):
+                if key not in idx or times_of(rcd, method, idx[key]) is None:
+                    cells.append("--")
+                    continue
+                new_t = times_of(rcd, method, idx[key])
+                cell, regressed = __versus(n_rows, base_t, new_t, threshold)
+                cells.append(cell)
+                if regressed:
+                    regressions.append((method, label, rcd.get("name"), cell))
+            lines.append(f"| **{method}** | {label} | " + " | ".join(cells) + " |")
+    return lines, regressions
+
+
+def phase_lines(rcd):
+    """
+    Markdown table of the mean seconds and share of every phase, for result
+    files recorded with ``bench(..., instrument=True)``.
+    """
+    names, rows = [], []
+    for method, per_opt in rcd.get("phases", {}).items():
+        for opt, runs in zip(rcd["options"], per_opt):
+            runs = [r["time"] for r in runs if r is not None]
+            if not runs:
+                continue
+            mean = {}
+            for run in runs:
+                for k, t in run.items():
+                    if k not in names:
+                        names.append(k)
+                    mean[k] = mean.get(k, 0) + t / len(runs)
+            rows.append((method, opt, mean))
+    if not rows:
+        return []
+    varying = [
+        k for k in rcd["options"][0]
+        if k not in IGNORED_FIELDS
+        and len({json.dumps(o.get(k)) for o in rcd["options"]}) > 1
+    ] or ["sample_count"]
+    lines = ["| Method | Option | " + " | ".join(names) + " |"]
+    lines += ["| " + " | ".join(["--------"] * (len(names) + 2)) + " |"]
+    for method, opt, mean in rows:
+        total = sum(mean.values()) or 1
+        label = ", ".join(f"{k} = {opt.get(k)}" for k in varying)
+        cells = [
+            f"{mean[k]:.4f} ({mean[k] / total:.0%})" if k in mean else "--"
+            for k in names
+        ]
+        lines.append(f"| **{method}** | {label} | " + " | ".join(cells) + " |")
+    return lines
+
+
+def usage_lines(rcd, rows="auto"):
+    """
+    Markdown table of the mean memory, I/O and page-cache usage of every
+    method, for result files recorded with ``bench(..., usage=True)``; the
+    page-cache columns need ``sqlite_status=True`` too. RPS/MB divides the RPS by the peak RSS.
+    """
+    MB = 1024 * 1024
+    def mean(values):
+        values = [v for v in values if v is not None]
+        return statistics.fmean(values) if values else None
+    def fmt(val, unit=MB, spec=".1f"):
+        return "--" if val is None else f"{val / unit:{spec}}"
+
+    lines = []
+    for method, per_opt in rcd.get("usage", {}).items():
+        for idx, (opt, runs) in enumerate(zip(rcd["options"], per_opt)):
+            runs = [r for r in runs if r]
+            if not runs:
+                continue
+            rss = mean(r.get("peak_rss") for r in runs)
+            traced = mean(r.get("tracemalloc_peak") for r in runs)
+            written = mean(r.get("io", {}).get("write_bytes") for r in runs)
+            size = mean(
+                (r.get("db_size") or 0) + (r.get("wal_size") or 0) for r in runs
+            )
+            caches = [r["sqlite_cache"] for r in runs if r.get("sqlite_cache")]
+            hit = None
+            if caches:
+                hits = sum(c["cache_hit"] for c in caches)
+                total = hits + sum(c["cache_miss"] for c in caches)
+                hit = hits / total if total else None
+            times = times_of(rcd, method, idx)
+            rps_mb = None
+            if times and rss:
+                n_rows = row_count(method, opt, rows, extras_of(rcd, method, idx))
+                rps_mb = __rps(n_rows, times) / (rss / MB)
+            label = f"sample_count = {opt.get('sample_count')}"
+            if "qry_count" in opt:
+                label += f", qry_count = {opt['qry_count']}"
+            lines.append(
+                f"| **{method}** | {label} | {fmt(rss)} | {fmt(traced)} | "
+                f"{fmt(written)} | {fmt(size)} | {fmt(hit, 0.01, '.1f')} | "
+                f"{fmt(rps_mb, 1)} |"
+            )
+    if not lines:
+        return []
+    return [
+        "| Method | Option | Peak RSS (MB) | tracemalloc (MB) | Written (MB) "
+        "| DB + WAL (MB) | Cache hits (%) | RPS/MB |",
+        "| " + " | ".join(["--------"] * 8) + " |",
+    ] + lines
+
+
+def __rps(n_rows, times):
+    avg = statistics.fmean(times)
+    return n_rows / avg if avg > 0 else math.inf
+
+
+def __cell(n_rows, times):
+    if not times:
+        return "TIMEOUT"
+    return f"{__rps(n_rows, times):.1f}"
+
+
+def __versus(n_rows, base_t, new_t, threshold):
+    if not new_t:
+        return "TIMEOUT", bool(base_t)
+    if not base_t:
+        return __cell(n_rows, new_t), False
+    speedup = statistics.fmean(base_t) / statistics.fmean(new_t)
+    significant = welch(base_t, new_t)
+    mark = "*" if significant else ""
+    regressed = speedup < 1 - threshold and significant is not False
+    flag = " REGRESSED" if regressed else ""
+    return f"{__cell(n_rows, new_t)} ({speedup:.2f}x{mark}){flag}", regressed
+
+
+def __env_line(path, rcd):
+    env = rcd.get("env", {})
+    return (
+        f"- `{path}`: {rcd.get('name')}, SQLite {env.get('sqlite', '?')}, "
+        f"Python {env.get('python', '?').split()[0]}"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("files", nargs="+", help="result JSON files, baseline first")
+    parser.add_argument("--threshold", type=float, default=0.05,
+                        help="slowdown tolerated before failing (default: 0.05)")
+    parser.add_argument("--rows", default="auto",
+                        help="rows per run: auto, pairs or an option field")
+    parser.add_argument("--phases", action="store_true",
+                        help="add the phase breakdown of instrumented runs")
+    parser.add_argument("--usage", action="store_true",
+                        help="add the memory and I/O usage of the runs")
+    parser.add_argument("-o", "--output", help="also write the markdown here")
+    args = parser.parse_args(argv)
+
+    files = [load(p) for p in args.files]
+    lines, regressions = compare(files, args.threshold, args.rows)
+    header = ["| Method | Option | " + " | ".join(args.files) + " |"]
+    header += ["| " + " | ".join(["--------"] * (len(args.files) + 2)) + " |"]
+    md = [__env_line(p, r) for p, r in zip(args.files, files)]
+    md += ["", f"**RPS for {files[0].get('name')}**:", ""] + header + lines
+    md += ["", "- `*`: significant at 95% (Welch's t-test on the run times)"]
+    for path, rcd in zip(args.files, files) if args.phases else []:
+        table = phase_lines(rcd)
+        if table:
+            md += ["", f"**Seconds per phase in `{path}`**:", ""] + table
+    for path, rcd in zip(args.files, files) if args.usage else []:
+        table = usage_lines(rcd, args.rows)
+        if table:
+            md += ["", f"**Usage in `{path}`**:", ""] + table
+    md = "\n".join(md) + "\n"
+
+    print(md, end="")
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(md)
+    if regressions:
+        print(f"\n{len(regressions)} regressions over {args.threshold:.0%}:",
+              file=sys.stderr)
+        for method, label, name, cell in regressions:
+            print(f"- {method} [{label}] in {name}: {cell}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
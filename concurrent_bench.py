@@ -0,0 +1,245 @@
+from utils import clock, since
+import multiprocessing as mp
+import queue
+import pydantic
+import peewee
+import sqlite3
+import db
+import os
+import os.path
+import time
+
+class ConcOption(pydantic.BaseModel):
+    sample_count: int = 1000
+    sample_path_fmt: str = "/tmp/sample-{}"
+    test_db_path: str = "bench-concurrent.db"
+
+    writers: int = 4
+    results_per_writer: int = 1000
+    batch_size: int = 1        # results per commit
+    wal: bool = True
+    busy_timeout: float = 5.0  # seconds
+
+# Retries once busy_timeout has run out, sleeping LOCK_BACKOFF seconds
+# doubled on every retry, up to a second
+LOCK_RETRIES = 10
+LOCK_BACKOFF = 0.01
+
+
+def __prepare_db(opt: ConcOption):
+    for suffix in ["", "-wal", "-shm", "-journal"]:
+        if os.path.exists(opt.test_db_path + suffix):
+            os.remove(opt.test_db_path + suffix)
+
+    db.open(opt.test_db_path, wal=opt.wal)
+    db.bulk_insert(db.Sample, (
+        (opt.sample_path_fmt.format(i),)
+        for i in range(opt.sample_count)
+    ))
+    db.allocate_results()
+    db.close()
+
+
+def __gen_slice(opt: ConcOption, idx: int):
+    """The (a, b) pairs written by writer idx, disjoint across writers."""
+    total = opt.writers * opt.results_per_writer
+    pairs = (
+        (a, b)
+        for b in range(2, opt.sample_count + 1)
+        for a in range(1, b)
+    )
+    for i, (a, b) in enumerate(pairs):
+        if i >= total:
+            break
+        if i % opt.writers == idx:
+            yield a, b
+
+
+def __percentiles(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {"p50": None, "p99": None}
+    pick = lambda q: latencies[min(int(q * len(latencies)), len(latencies) - 1)]
+    return {"p50": pick(0.50), "p99": pick(0.99)}
+
+
+def __retry_locked(fn):
+    """
+    Call fn, retried while it fails with "database is locked" or "database
+    is busy", LOCK_RETRIES times at most. Returns the retry count.
+    """
+    for retry in range(LOCK_RETRIES + 1):
+        try:
+            fn()
+            return retry
+        except (peewee.OperationalError, sqlite3.OperationalError) as e:
+            msg = str(e)
+            if retry == LOCK_RETRIES or not ("locked" in msg or "busy" in msg):
+                raise
+        time.sleep(min(LOCK_BACKOFF * 2 ** retry, 1.0))
+
+
+def __open(opt: ConcOption):
+    """db.open, retried while it fails on a lock. Returns the retry count."""
+    def attempt():
+        try:
+            db.open(opt.test_db_path, wal=opt.wal, timeout=opt.busy_timeout)
+        except Exception:
+            db.close()
+            raise
+    return __retry_locked(attempt)
+
+
+## Direct writers: every process commits its own results
+def __direct_writer(opt: ConcOption, idx: int, out):
+    latencies = []
+    locked = 0
+    err = None
+    try:
+        locked += __open(opt)
+        batch = []
+        slice_ = list(__gen_slice(opt, idx))
+        for i, (a, b) in enumerate(slice_):
+            batch.append((a, b, 0.5, time.monotonic()))
+            if len(batch) < opt.batch_size and i + 1 < len(slice_):
+                continue
+            locked += __retry_locked(lambda: db.bulk_insert(
+                db.Result, [r[:3] for r in batch], on_conflict='update'
+            ))
+            now = time.monotonic()
+            latencies += [now - r[3] for r in batch]
+            batch = []
+    except Exception as e:
+        err = str(e)
+    finally:
+        db.close()
+    out.put((latencies, locked, err))
+
+
+## Funnel: workers send results to one committing process
+def __funnel_worker(opt: ConcOption, idx: int, que):
+    for a, b in __gen_slice(opt, idx):
+        que.put((a, b, 0.5, time.monotonic()))
+    que.put(None)
+
+
+def __funnel_writer(opt: ConcOption, que, out):
+    latencies = []
+    locked = 0
+    err = None
+    try:
+        locked += __open(opt)
+        pending = []
+        done = 0
+        with db.ResultSink(max_rows=opt.batch_size, max_delay=None) as sink:
+            while done < opt.writers:
+                try:
+                    msg = que.get(timeout=0.01)
+                except queue.Empty:
+                    msg = False # idle, commit what we have
+                if msg is None:
+                    done += 1
+                    continue
+                if msg:
+                    flushed = sink.flushed
+                    sink.put(*msg[:3])
+                    pending.append(msg[3])
+                    if sink.flushed == flushed:
+                        continue
+                elif not sink.flush():
+                    continue
+                now = time.monotonic()
+                latencies += [now - t for t in pending]
+                pending = []
+            sink.flush()
+            now = time.monotonic()
+            latencies += [now - t for t in pending]
+    except Exception as e:
+        err = str(e)
+    finally:
+        db.close()
+    out.put((latencies, locked, err))
+
+
+def __run(opt: ConcOption, funnel: bool):
+    __prepare_db(opt)
+
+    out = mp.Queue()
+    if funnel:
+        que = mp.Queue()
+        procs = [mp.Process(target=__funnel_writer, args=(opt, que, out))]
+        procs += [
+            mp.Process(target=__funnel_worker, args=(opt, i, que))
+            for i in range(opt.writers)
+        ]
+        collect = 1
+    else:
+        procs = [
+            mp.Process(target=__direct_writer, args=(opt, i, out))
+            for i in range(opt.writers)
+        ]
+        collect = opt.writers
+
+    st = clock()
+    for p in procs:
+        p.start()
+    latencies, locked, errors = [], 0, []
+    for _ in range(collect):
+        lat, lck, err = out.get()
+        latencies += lat
+        locked += lck
+        if err:
+            errors.append(err)
+    for p in procs:
+        p.join()
+    if errors:
+        raise RuntimeError(f"{len(errors)} writers failed: {errors[0]}")
+    elapsed = since(st)
+
+    db.open(opt.test_db_path, wal=opt.wal)
+    count = db.Result.select().where(db.Result.val >= 0).count()
+    db.close()
+
+    extra = __percentiles(latencies)
+    extra["locked"] = locked
+    print(f"Committed {count} results in {elapsed}, p50 {extra['p50']} s, "
+          f"p99 {extra['p99']} s, {locked} lock errors")
+    return elapsed, extra
+
+
+def time_conc_direct(opt = ConcOption()):
+    return __run(opt, funnel=False)
+
+def time_conc_funnel(opt = ConcOption()):
+    return __run(opt, funnel=True)
+
+
+## Benchmark
+from utils import bench
+
+def bench_conc():
+    funcs = [
+        time_conc_direct,
+        time_conc_funnel,
+    ]
+
+    opt_list = [
+        ConcOption(writers=n, batch_size=batch, wal=wal, busy_timeout=timeout)
+        for wal in [False, True]
+        for timeout in [0.1, 5.0]
+        for batch in [1, 100]
+        for n in [1, 2, 4, 8, 16]
+    ]
+
+    bench(
+        "Concurrent Writers", funcs, opt_list,
+        timeout=60, repeat=3,
+        hint=lambda x: (
+            f"writers = {x.writers}, batch_size = {x.batch_size}, "
+            f"wal = {x.wal}, busy_timeout = {x.busy_timeout}"
+        )
+    )
+
+
+if __name__ == "__main__":
+    bench_conc()
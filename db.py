@@ -1,15 +1,40 @@
+import atexit
+import builtins
+import json
+import multiprocessing as mp
+import operator
+import os
+import queue
+import signal
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import reduce
+from itertools import chain, islice
+from multiprocessing import resource_tracker, shared_memory
+from math import ceil, isqrt
 import peewee
 from peewee import (
     Model, SqliteDatabase, CompositeKey, DatabaseProxy,
     Check
 )
+from playhouse.sqlite_ext import AutoIncrementField
+
+class _ConnProxy(DatabaseProxy):
+    def savepoint(self):
+        return _Savepoint(self) # see _bump_generation
 
 # Enable dynamic connection
 # Anotate it as SqliteDatabase for better IDE hint
-conn: SqliteDatabase = DatabaseProxy()
+conn: SqliteDatabase = _ConnProxy()
 
 class Sample(Model):
-    id = peewee.AutoField()
+    # AUTOINCREMENT: ids of deleted samples are never reused, which the
+    # allocation watermark relies on
+    id = AutoIncrementField()
     path = peewee.TextField(unique=True)
 
     class Meta:
@@ -27,6 +52,10 @@ class Result(Model):
         primary_key = CompositeKey('a', 'b')
         constraints = [Check('a_id < b_id')]
 
+# Special values of Result.val
+PENDING = -1    # waiting for dispatch
+DISPATCHED = -2 # leased to a worker, waiting for a result
+
 class Attachment(Model):
     key = peewee.CharField(64, primary_key=True)
     val = peewee.CharField()
@@ -34,19 +63,1796 @@ class Attachment(Model):
     class Meta:
         database = conn
 
-def open(path: str, wal = False):
-    if wal:
-        conn.initialize(SqliteDatabase(path, pragmas={
-            'journal_mode': 'wal'
+# Attachment counting the transactions that change result values in place,
+# so a DistanceMatrix file (matrix.py) can tell it is stale. Bumped inside
+# the writing transaction, and only once a matrix has created it.
+MATRIX_GENERATION_KEY = 'matrix_generation'
+_gen_local = threading.local() # transaction of this thread's last bump
+
+def _bump_generation():
+    """
+    Bump the generation once per transaction: a write only bumps again in
+    another (or nested) transaction, or after a savepoint rolled back, which
+    may have undone the bump. Callers hold a peewee transaction.
+    """
+    txn = conn.obj.top_transaction()
+    if txn is not None and txn is getattr(_gen_local, 'txn', None):
+        return
+    conn.execute_sql(
+        "UPDATE attachment SET val = CAST(val AS INTEGER) + 1 WHERE key = ?;",
+        (MATRIX_GENERATION_KEY,)
+    )
+    _gen_local.txn = txn
+
+class _Savepoint(peewee._savepoint):
+    # peewee does not stack savepoints with the transactions
+    def rollback(self, begin=True):
+        _gen_local.txn = None
+        super().rollback(begin)
+
+class Lease(Model):
+    # One row per DISPATCHED result, see claim_batch
+    a_id = peewee.IntegerField()
+    b_id = peewee.IntegerField()
+    worker = peewee.TextField()
+    expires = peewee.FloatField(index=True) # unix time
+
+    class Meta:
+        database = conn
+        primary_key = CompositeKey('a_id', 'b_id')
+
+
+## Result layouts
+# "pair" is the Result model as declared above. The "tri" layouts store each
+# pair under the single integer key k = b*(b-1)/2 + a in table result_tri,
+# either as the rowid ("tri") or in a WITHOUT ROWID b-tree
+# ("tri_without_rowid"). For them "result" is a view with INSTEAD OF
+# triggers, so the Result model keeps working, but filtering it by a/b scans
+# the table: go through the module functions, which address result_tri by k.
+LAYOUTS = ('pair', 'tri', 'tri_without_rowid')
+
+result_layout = 'pair' # layout of the open database, set by open()
+
+def tri_key(a, b):
+    return b * (b - 1) // 2 + a
+
+def tri_pair(k):
+    b = (1 + isqrt(8 * k - 7)) // 2
+    return k - b * (b - 1) // 2, b
+
+# Decodes b from k in SQL; needs SQLite built with math functions (3.35+)
+_TRI_B_SQL = "CAST((1 + sqrt(8 * k - 7)) / 2 AS INTEGER)"
+
+def _tri_key_sql(a, b):
+    return f"(({b}) * (({b}) - 1) / 2 + ({a}))"
+
+def _result_table():
+    return 'result' if result_layout == 'pair' else 'result_tri'
+
+def _match(alias, a, b):
+    """SQL condition selecting the result row of pair (a, b) as ``alias``."""
+    if result_layout == 'pair':
+        return f"{alias}.a_id = {a} AND {alias}.b_id = {b}"
+    return f"{alias}.k = {_tri_key_sql(a, b)}"
+
+def _tri_ddl(without_rowid=False):
+    return [
+        f"""
+        CREATE TABLE IF NOT EXISTS result_tri (
+            k INTEGER PRIMARY KEY,
+            val REAL NOT NULL DEFAULT {float(PENDING)}
+        ){' WITHOUT ROWID' if without_rowid else ''};
+        """,
+
+        f"""
+        CREATE VIEW IF NOT EXISTS result AS
+        SELECT k - b * (b - 1) / 2 AS a_id, b AS b_id, val
+        FROM (SELECT k, {_TRI_B_SQL} AS b, val FROM result_tri);
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS result_insert
+        INSTEAD OF INSERT ON result BEGIN
+            SELECT RAISE(ABORT, 'CHECK constraint failed: a_id < b_id')
+            WHERE NEW.a_id >= NEW.b_id;
+            INSERT INTO result_tri (k, val)
+            VALUES ({_tri_key_sql('NEW.a_id', 'NEW.b_id')},
+                    coalesce(NEW.val, {float(PENDING)}));
+        END;
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS result_update
+        INSTEAD OF UPDATE ON result BEGIN
+            SELECT RAISE(ABORT, 'CHECK constraint failed: a_id < b_id')
+            WHERE NEW.a_id >= NEW.b_id;
+            UPDATE result_tri
+            SET k = {_tri_key_sql('NEW.a_id', 'NEW.b_id')}, val = NEW.val
+            WHERE k = {_tri_key_sql('OLD.a_id', 'OLD.b_id')};
+        END;
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS result_delete
+        INSTEAD OF DELETE ON result BEGIN
+            DELETE FROM result_tri
+            WHERE k = {_tri_key_sql('OLD.a_id', 'OLD.b_id')};
+        END;
+        """,
+    ]
+
+def _detect_layout():
+    row = conn.execute_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'result_tri';"
+    ).fetchone()
+    if row is not None:
+        return 'tri_without_rowid' if 'WITHOUT ROWID' in row[0].upper() else 'tri'
+    row = conn.execute_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'result';"
+    ).fetchone()
+    return 'pair' if row is not None else None
+
+# Tables, indexes, views and triggers each layout needs
+_SCHEMA_OBJECTS = {
+    'pair': {
+        'sample', 'sample_path', 'attachment', 'lease', 'lease_expires',
+        'result', 'result_a_id', 'result_b_id',
+    },
+}
+_SCHEMA_OBJECTS['tri'] = _SCHEMA_OBJECTS['tri_without_rowid'] = {
+    'sample', 'sample_path', 'attachment', 'lease', 'lease_expires',
+    'result', 'result_tri',
+    'result_insert', 'result_update', 'result_delete',
+}
+
+def _schema_names():
+    cur = conn.execute_sql("SELECT name FROM sqlite_master;")
+    return [name for name, in cur]
+
+def _create_result(layout, indexes=True):
+    if layout == 'pair':
+        if indexes:
+            conn.create_tables([Result])
+        else:
+            Result._schema.create_table(safe=True)
+    else:
+        for ddl in _tri_ddl(without_rowid=(layout == 'tri_without_rowid')):
+            conn.execute_sql(ddl)
+
+def _create_indexes(layout):
+    """Create the secondary indexes left out by a staging open."""
+    models = [Sample, Attachment, Lease]
+    if layout == 'pair':
+        models.append(Result)
+    for model in models:
+        model._schema.create_indexes(safe=True)
+
+## Connections
+# peewee connects once per thread. An exclusive lock or a staged in-memory
+# database only work through the connection of the thread calling open(),
+# any other would wait for the lock or see another, empty database.
+_owner = None # ident of that thread, None when every thread may connect
+
+class Database(SqliteDatabase):
+    def _connect(self):
+        if _owner is not None and threading.get_ident() != _owner:
+            raise sqlite3.OperationalError(
+                "The database is single-connection (exclusive locking or "
+                "staging), use it from the thread that opened it"
+            )
+        return super()._connect()
+
+## Instrumentation
+# Off by default. After instrument(), open() creates InstrumentedDatabase
+# connections, which split the time of every statement into phases:
+#   sql     peewee generating the SQL of a query
+#   step    sqlite3 preparing and stepping a statement; rows fetched later
+#           are counted in the phase of the caller
+#   commit  COMMIT of a transaction, including the journal/WAL fsync
+# and count statements (trace callback) and VM steps (progress handler,
+# in units of PROGRESS_STEPS). Other code names its own phases with
+# phase(). A phase's time excludes the phases nested in it, so they add up.
+# mark_phases() ends the measured part; later phases are reported apart.
+PROGRESS_STEPS = 1000
+_phases = None # phase name -> ns, None when not instrumenting
+_counters = {'statements': 0, 'vm_steps': 0}
+_marked = None # (phases, counters) at mark_phases()
+_phase_local = threading.local()
+
+def instrument(on=True):
+    """Turn phase timing and statement counting on or off for later ``open``s."""
+    global _phases
+    _phases = {} if on else None
+    reset_phases()
+
+def reset_phases():
+    global _marked
+    if _phases is not None:
+        _phases.clear()
+    _phase_local.stack = []
+    _counters.update(statements=0, vm_steps=0)
+    _marked = None
+
+def mark_phases():
+    global _marked
+    if _phases is not None:
+        _marked = (dict(_phases), dict(_counters))
+
+def phase_report() -> dict:
+    """
+    Seconds per phase and the counters from ``reset_phases`` to
+    ``mark_phases``, and seconds per phase after the mark in ``'after'``.
+    """
+    if _phases is None:
+        return None
+    phases, counters = _marked or (_phases, _counters)
+    after = {
+        name: (ns - phases.get(name, 0)) / 1e9
+        for name, ns in _phases.items() if ns != phases.get(name, 0)
+    }
+    return {
+        'time': {name: ns / 1e9 for name, ns in phases.items()},
+        'after': after,
+        **counters,
+    }
+
+@contextmanager
+def phase(name):
+    """Time the block as phase ``name`` while instrumenting."""
+    if _phases is None:
+        yield
+        return
+    stack = getattr(_phase_local, 'stack', None)
+    if stack is None:
+        stack = _phase_local.stack = []
+    frame = [time.perf_counter_ns(), 0] # start, ns of nested phases
+    stack.append(frame)
+    try:
+        yield
+    finally:
+        stack.pop()
+        total = time.perf_counter_ns() - frame[0]
+        _phases[name] = _phases.get(name, 0) + total - frame[1]
+        if stack:
+            stack[-1][1] += total
+
+def _count_statement(sql):
+    _counters['statements'] += 1
+
+def _count_steps():
+    _counters['vm_steps'] += PROGRESS_STEPS
+    return 0
+
+class InstrumentedDatabase(Database):
+    def _add_conn_hooks(self, conn):
+        super()._add_conn_hooks(conn)
+        conn.set_trace_callback(_count_statement)
+        conn.set_progress_handler(_count_steps, PROGRESS_STEPS)
+
+    def execute(self, query, **context_options):
+        with phase('sql'):
+            return super().execute(query, **context_options)
+
+    def execute_sql(self, sql, params=None):
+        with phase('step'):
+            return super().execute_sql(sql, params)
+
+    def commit(self):
+        with phase('commit'):
+            return super().commit()
+
+def _database(*args, **kwargs) -> SqliteDatabase:
+    if _phases is None:
+        return Database(*args, **kwargs)
+    return InstrumentedDatabase(*args, **kwargs)
+
+## SQLite status
+# sqlite3 does not wrap sqlite3_db_status, so it is called through ctypes
+# with the sqlite3* handle CPython keeps right after the object header of a
+# connection. That layout is private: it is only relied on for the CPython
+# versions in _CAPI_VERSIONS, whose pysqlite_Connection starts with the
+# handle. The library must also be the one sqlite3 runs on and the handle
+# must name the same file, otherwise the counters are unavailable (None).
+DB_STATUS = {
+    'cache_used': 1,  # bytes of page cache
+    'cache_hit': 7,
+    'cache_miss': 8,
+    'cache_write': 9, # pages written from the cache
+}
+_CAPI_VERSIONS = [(3, 8), (3, 9), (3, 10), (3, 11), (3, 12), (3, 13)]
+_capi = None
+
+def _sqlite_capi():
+    global _capi
+    if _capi is None:
+        _capi = False
+        if (sys.implementation.name != 'cpython'
+                or sys.version_info[:2] not in _CAPI_VERSIONS):
+            return None
+        try:
+            import ctypes
+            import _sqlite3
+            lib = ctypes.CDLL(_sqlite3.__file__)
+            lib.sqlite3_libversion.restype = ctypes.c_char_p
+            lib.sqlite3_db_filename.restype = ctypes.c_char_p
+            lib.sqlite3_db_filename.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+            lib.sqlite3_db_status.argtypes = [
+                ctypes.c_void_p, ctypes.c_int, ctypes.POINTER(ctypes.c_int),
+                ctypes.POINTER(ctypes.c_int), ctypes.c_int,
+            ]
+            if lib.sqlite3_libversion().decode() == sqlite3.sqlite_version:
+                _capi = (ctypes, lib)
+        except (ImportError, OSError, AttributeError):
+            pass
+    return _capi or None
+
+def db_status(reset=False) -> dict:
+    """
+    ``DB_STATUS`` counters of the open ``conn`` since it was opened or last
+    reset; ``reset=True`` zeroes the hit/miss/write counters after reading.
+    None when unavailable.
+    """
+    capi = _sqlite_capi()
+    if capi is None or not getattr(conn, 'obj', None) or conn.is_closed():
+        return None
+    ctypes, lib = capi
+    con = conn.connection()
+    handle = ctypes.c_void_p.from_address(id(con) + object.__basicsize__).value
+    name = lib.sqlite3_db_filename(handle, b'main')
+    if name is None or os.fsdecode(name) not in ('', os.path.abspath(conn.database)):
+        return None
+    stats = {}
+    for key, op in DB_STATUS.items():
+        cur, hi = ctypes.c_int(), ctypes.c_int()
+        if lib.sqlite3_db_status(handle, op, ctypes.byref(cur), ctypes.byref(hi), int(reset)):
+            return None
+        stats[key] = cur.value
+    return stats
+
+## Pragma profiles
+# Named settings for open(profile=...); the journal mode stays with its wal
+# argument. What each costs in durability:
+#   durable      synchronous FULL: every commit waits for fsync and survives
+#                power loss
+#   fast-ingest  synchronous NORMAL: with WAL, commits right before a power
+#   read-heavy   loss or OS crash may be lost but the file stays consistent;
+#                without WAL such a crash may corrupt it
+#   bulk-build   synchronous OFF and an exclusive lock (one connection: no
+#                readers, other threads or processes): an OS crash or power
+#                loss may corrupt the file.
+#                Build, then reopen with another profile
+# An application crash alone loses nothing committed under any of them.
+# page_size only applies to a new database, or a DELETE one after VACUUM.
+PROFILES = {
+    'durable': {
+        'synchronous': 'full',
+    },
+    'fast-ingest': {
+        'synchronous': 'normal',
+        'cache_size': -262144, # KiB
+        'temp_store': 'memory',
+    },
+    'read-heavy': {
+        'synchronous': 'normal',
+        'cache_size': -262144,
+        'mmap_size': 1 << 30,
+        'temp_store': 'memory',
+    },
+    'bulk-build': {
+        'page_size': 16384,
+        'synchronous': 'off',
+        'locking_mode': 'exclusive',
+        'cache_size': -1048576,
+        'temp_store': 'memory',
+    },
+}
+_default_pragmas = {}
+
+def profile_pragmas(profile=None, pragmas=None) -> dict:
+    """The pragmas of ``profile`` (a ``PROFILES`` key), updated by ``pragmas``."""
+    if profile is not None and profile not in PROFILES:
+        raise ValueError(f"Unknown pragma profile: {profile!r}")
+    return {**PROFILES.get(profile, {}), **(pragmas or {})}
+
+def set_default_profile(profile=None, pragmas=None):
+    """Tune the later ``open`` calls that pass neither profile nor pragmas."""
+    global _default_pragmas
+    _default_pragmas = profile_pragmas(profile, pragmas)
+
+PRAGMA_NAMES = (
+    'journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'temp_store',
+    'page_size', 'locking_mode',
+)
+
+def current_pragmas() -> dict:
+    """Values of ``PRAGMA_NAMES`` on ``conn``."""
+    return {
+        name: conn.execute_sql(f"PRAGMA {name};").fetchone()[0]
+        for name in PRAGMA_NAMES
+    }
+
+# (path, open() arguments) of the in-memory database being staged
+_staging = None
+
+def open(path: str, wal = False, layout = None, readers = 0, timeout = 5.0,
+         cache_size = 0, staging = False, profile = None, pragmas = None):
+    """
+    Open the database at ``path``. ``layout`` picks one of ``LAYOUTS`` for a
+    new database; for an existing one it must match the stored layout (see
+    ``migrate_layout``) or be ``None`` to keep it. ``readers > 0`` adds a pool
+    of that many read-only connections, see ``reading``. ``timeout`` is the
+    busy timeout in seconds: how long a statement waits for another
+    connection's lock before failing with "database is locked".
+    ``cache_size > 0`` puts a ``PairCache`` of that many pairs in front of
+    ``get_results``.
+
+    ``staging=True`` builds the database in memory instead, starting from a
+    copy of ``path`` if it exists, and leaves out the secondary indexes
+    (FK, unique and partial ones) so bulk loads only grow the tables.
+    ``persist`` then writes it to ``path`` and reopens it from there. The
+    staged database is only visible to the calling thread.
+
+    ``profile`` names one of ``PROFILES`` and ``pragmas`` sets or overrides
+    single pragmas, e.g. ``{'cache_size': -65536}``. Without either, the
+    ones of ``set_default_profile`` apply.
+
+    With ``staging`` or an exclusive ``locking_mode`` the database is
+    single-connection: only the calling thread may use it, so there are
+    no readers, no ``ResultSink`` flush thread and no other threads.
+    """
+    global result_layout, _pool, cache, _staging, _owner
+    if layout is not None and layout not in LAYOUTS:
+        raise ValueError(f"Unknown layout: {layout!r}")
+    if profile is None and pragmas is None:
+        tuned = dict(_default_pragmas)
+    else:
+        tuned = profile_pragmas(profile, pragmas)
+    if readers and str(tuned.get('locking_mode', '')).lower() == 'exclusive':
+        raise ValueError("An exclusively locked database cannot have readers")
+    # page_size has to come before the journal mode switches to WAL
+    head = {'page_size': tuned['page_size']} if 'page_size' in tuned else {}
+
+    close() # a connection left open would keep its locks, e.g. an exclusive one
+    _staging = None
+    exclusive = str(tuned.get('locking_mode', '')).lower() == 'exclusive'
+    _owner = threading.get_ident() if staging or exclusive else None
+    if staging:
+        if readers:
+            raise ValueError("A staged database cannot be shared by readers")
+        conn.initialize(_database(':memory:', pragmas=tuned))
+        if os.path.exists(path):
+            src = sqlite3.connect(path)
+            src.backup(conn.connection())
+            src.close()
+        _staging = (path, dict(
+            wal=wal, layout=layout, timeout=timeout, cache_size=cache_size,
+            profile=profile, pragmas=pragmas,
+        ))
+    elif wal:
+        conn.initialize(_database(path, timeout=timeout, pragmas={
+            **head, 'journal_mode': 'wal', **tuned
         }))
     else:
-        conn.initialize(SqliteDatabase(path, pragmas={
-            'journal_mode': 'DELETE'
+        conn.initialize(_database(path, timeout=timeout, pragmas={
+            **head, 'journal_mode': 'DELETE', **tuned
         }))
-    with conn.atomic():
-        conn.create_tables([Sample, Result, Attachment])
+    existing = _detect_layout()
+    if existing is not None and layout not in (None, existing):
+        raise ValueError(
+            f"{path} uses the {existing!r} layout, "
+            f"use migrate_layout({layout!r}) to convert it"
+        )
+    result_layout = existing or layout or 'pair'
+
+    # Only take the write lock when something is missing, so that many
+    # processes can open a ready database without contending for it.
+    # IMMEDIATE so that concurrent creators wait on each other instead of
+    # failing to upgrade a read lock.
+    if staging:
+        for model in [Sample, Attachment, Lease]:
+            model._schema.create_table(safe=True)
+        _create_result(result_layout, indexes=False)
+    elif not _SCHEMA_OBJECTS[result_layout] <= set(_schema_names()):
+        with conn.atomic('IMMEDIATE'):
+            result_layout = _detect_layout() or result_layout
+            conn.create_tables([Sample, Attachment, Lease])
+            _create_result(result_layout)
+
+    if readers:
+        _pool = ReaderPool(path, readers, {
+            **READER_PRAGMAS,
+            **{k: v for k, v in tuned.items() if k in ('cache_size', 'mmap_size')},
+        })
+    cache = PairCache(cache_size) if cache_size else None
+
+def migrate_layout(layout, vacuum=True):
+    """
+    Convert the open database's ``result`` table to ``layout`` in one
+    transaction, then VACUUM to hand the freed pages back.
+    """
+    global result_layout
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown layout: {layout!r}")
+    if layout == result_layout:
+        return
+
+    with conn.atomic('IMMEDIATE'):
+        queue = bool({'result_pending', 'result_tri_pending'} & set(_schema_names()))
+        if result_layout == 'pair':
+            conn.execute_sql("ALTER TABLE result RENAME TO result_old;")
+            conn.execute_sql("DROP INDEX IF EXISTS result_pending;")
+            copy = f"""
+            INSERT INTO result_tri (k, val)
+            SELECT {_tri_key_sql('a_id', 'b_id')}, val FROM result_old
+            ORDER BY b_id, a_id;
+            """
+            drop = "DROP TABLE result_old;"
+        else:
+            conn.execute_sql("ALTER TABLE result_tri RENAME TO result_old;")
+            for name in ['result_insert', 'result_update', 'result_delete']:
+                conn.execute_sql(f"DROP TRIGGER {name};")
+            conn.execute_sql("DROP VIEW result;")
+            conn.execute_sql("DROP INDEX IF EXISTS result_tri_pending;")
+            copy = f"""
+            INSERT INTO result_tri (k, val) SELECT k, val FROM result_old;
+            """ if layout != 'pair' else f"""
+            INSERT INTO result (a_id, b_id, val)
+            SELECT k - b * (b - 1) / 2, b, val
+            FROM (SELECT k, {_TRI_B_SQL} AS b, val FROM result_old)
+            ORDER BY 1, 2;
+            """
+            drop = "DROP TABLE result_old;"
+        _create_result(layout)
+        conn.execute_sql(copy)
+        conn.execute_sql(drop)
+        result_layout = layout
+        if queue:
+            create_queue_index()
+
+    if vacuum:
+        conn.execute_sql("VACUUM;")
+
+STAGING_METHODS = ('backup', 'vacuum')
+
+def persist(method='backup', indexes=True):
+    """
+    Write the database staged by ``open(..., staging=True)`` to its path,
+    replacing the file, and reopen it from there with the original
+    arguments. ``method`` is ``'backup'`` (the online backup API, copies
+    pages as they are) or ``'vacuum'`` (``VACUUM INTO``, writes a compacted
+    copy). ``indexes=True`` builds the deferred indexes in memory first;
+    otherwise ``open`` builds them on the file.
+    """
+    if _staging is None:
+        raise RuntimeError("No staged database, use open(..., staging=True)")
+    if method not in STAGING_METHODS:
+        raise ValueError(f"Unknown staging method: {method!r}")
+    path, kwargs = _staging
+
+    if indexes:
+        _create_indexes(result_layout)
+    for suffix in ['', '-wal', '-shm', '-journal']:
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    if method == 'backup':
+        dst = sqlite3.connect(path)
+        conn.connection().backup(dst)
+        dst.close()
+    else:
+        conn.execute_sql("VACUUM INTO ?;", (path,))
+    close()
+    open(path, **kwargs)
 
 def close():
+    global _pool, cache, _staging, _owner
+    if _pool is not None:
+        _pool.close()
+        _pool = None
+    cache = None
+    _staging = None
+    _path_ids.clear()
     # A little hack to check if db_conn was initialized
     if getattr(conn, 'obj', None):
-        conn.close()
\ No newline at end of file
+        conn.close()
+    _owner = None
+
+
+## Reader pool
+# With WAL, readers never block the writer nor each other. conn stays the
+# writer; the lookup functions run on a pooled read-only connection when
+# the database was opened with readers > 0.
+READER_PRAGMAS = {
+    'query_only': 1,
+    'cache_size': -64000, # KiB
+    'temp_store': 'memory',
+}
+
+class ReaderPool:
+    """A bounded pool of read-only connections to ``path``."""
+
+    def __init__(self, path, size, pragmas=READER_PRAGMAS):
+        if path == ':memory:':
+            raise ValueError("An in-memory database cannot be shared by readers")
+        self._free = queue.LifoQueue()
+        self._all = []
+        for _ in range(size):
+            rdb = _database(
+                f'file:{path}?mode=ro', uri=True, pragmas=pragmas,
+                thread_safe=False, check_same_thread=False,
+            )
+            rdb.connect()
+            self._all.append(rdb)
+            self._free.put(rdb)
+
+    def __len__(self):
+        return len(self._all)
+
+    def acquire(self, timeout=None) -> SqliteDatabase:
+        return self._free.get(timeout=timeout)
+
+    def release(self, rdb):
+        self._free.put(rdb)
+
+    def close(self):
+        for rdb in self._all:
+            rdb.close()
+        self._all = []
+
+_pool: ReaderPool = None
+_local = threading.local()
+
+def _reader():
+    """The connection the current thread reads from."""
+    return getattr(_local, 'reader', None) or conn
+
+@contextmanager
+def reading(timeout=None):
+    """
+    Check out a pooled reader for the current thread for the duration of the
+    block; lookup functions called inside use it. Nested blocks share one
+    reader, and without a pool this yields ``conn``.
+    """
+    if _pool is None or getattr(_local, 'reader', None) is not None:
+        yield _reader()
+        return
+    rdb = _pool.acquire(timeout)
+    _local.reader = rdb
+    try:
+        yield rdb
+    finally:
+        _local.reader = None
+        _pool.release(rdb)
+
+
+## JSON bulk insert
+# Rows are shipped to SQLite as one JSON array per chunk and unpacked
+# natively with json_each, avoiding the placeholder limit of insert_many.
+# The same statements are also built with a VALUES row for executemany,
+# see stream_insert.
+CONFLICT_MODES = (None, 'ignore', 'replace', 'update')
+INSERT_SOURCES = ('json', 'values')
+
+_insert_sql_cache = {}
+
+def _resolve_fields(model, columns=None):
+    """Map field names / column names / Field objects to model fields.
+
+    By default every field is used except an auto-increment primary key.
+    """
+    meta = model._meta
+    if columns is None:
+        return tuple(
+            f for f in meta.sorted_fields
+            if not isinstance(f, peewee.AutoField)
+        )
+    fields = []
+    for c in columns:
+        if isinstance(c, peewee.Field):
+            fields.append(c)
+        elif c in meta.fields:
+            fields.append(meta.fields[c])
+        elif c in meta.columns:
+            fields.append(meta.columns[c])
+        else:
+            raise ValueError(f"Unknown column {c!r} for {model.__name__}")
+    return tuple(fields)
+
+def _source_sql(sels, source):
+    """Row source of an INSERT selecting ``sels``, plus its upsert prefix."""
+    if source == 'values':
+        return f'VALUES ({", ".join(sels)})', ' ON CONFLICT'
+    # "WHERE true" keeps the parser from reading ON CONFLICT as a join
+    return (
+        f'SELECT {", ".join(sels)}\nFROM json_each(?) AS j',
+        ' WHERE true ON CONFLICT'
+    )
+
+def _source_cols(n, source):
+    if source == 'values':
+        return [f"?{i + 1}" for i in range(n)]
+    return [f"(j.value ->> '$[{i}]')" for i in range(n)]
+
+def _build_insert_sql(model, fields, on_conflict=None, source='json'):
+    if on_conflict not in CONFLICT_MODES:
+        raise ValueError(f"Unknown on_conflict mode: {on_conflict!r}")
+
+    verb = {
+        'ignore': 'INSERT OR IGNORE',
+        'replace': 'INSERT OR REPLACE',
+    }.get(on_conflict, 'INSERT')
+    cols = ', '.join(f'"{f.column_name}"' for f in fields)
+    body, upsert = _source_sql(_source_cols(len(fields), source), source)
+    sql = f'{verb} INTO "{model._meta.table_name}" ({cols})\n{body}'
+
+    if on_conflict == 'update':
+        pk = {f.name for f in model._meta.get_primary_keys()}
+        sets = [
+            f'"{f.column_name}" = excluded."{f.column_name}"'
+            for f in fields if f.name not in pk
+        ]
+        if sets:
+            sql += upsert + ' DO UPDATE SET ' + ', '.join(sets)
+        else:
+            sql += upsert + ' DO NOTHING'
+    return sql
+
+def _build_tri_insert_sql(fields, on_conflict=None, source='json'):
+    # Result rows go straight to result_tri, the view cannot be upserted
+    if on_conflict not in CONFLICT_MODES:
+        raise ValueError(f"Unknown on_conflict mode: {on_conflict!r}")
+    pos = {
+        f.name: col
+        for f, col in zip(fields, _source_cols(len(fields), source))
+    }
+    if 'a' not in pos or 'b' not in pos:
+        raise ValueError("Result rows need both a and b")
+
+    verb = {
+        'ignore': 'INSERT OR IGNORE',
+        'replace': 'INSERT OR REPLACE',
+    }.get(on_conflict, 'INSERT')
+    cols, sels = ['k'], [_tri_key_sql(pos['a'], pos['b'])]
+    if 'val' in pos:
+        cols.append('val')
+        sels.append(pos['val'])
+    body, upsert = _source_sql(sels, source)
+    sql = f'{verb} INTO result_tri ({", ".join(cols)})\n{body}'
+    if on_conflict == 'update':
+        if 'val' in pos:
+            sql += upsert + ' DO UPDATE SET val = excluded.val'
+        else:
+            sql += upsert + ' DO NOTHING'
+    return sql
+
+_ORDER_ERROR = 'CHECK constraint failed: a_id < b_id'
+
+def _ordered_rows(rows, ia, ib, skip=False, error=sqlite3.IntegrityError):
+    """
+    The pair layout's CHECK for result_tri, where a >= b would key another
+    pair: yield ``rows``, raising ``error`` at the first such row, or
+    dropping it with ``skip`` as INSERT OR IGNORE does.
+    """
+    for r in rows:
+        if r[ia] < r[ib]:
+            yield r
+        elif not skip:
+            raise error(_ORDER_ERROR)
+
+def insert_sql(model, columns=None, on_conflict=None, source='json'):
+    """
+    Return the cached ``INSERT ... SELECT ... FROM json_each(?)`` statement
+    for ``model`` and the fields it binds, in order. ``source='values'``
+    builds ``INSERT ... VALUES (?1, ...)`` for one row instead.
+    """
+    if source not in INSERT_SOURCES:
+        raise ValueError(f"Unknown insert source: {source!r}")
+    fields = _resolve_fields(model, columns)
+    tri = model is Result and result_layout != 'pair'
+    key = (model, fields, on_conflict, tri, source)
+    sql = _insert_sql_cache.get(key)
+    if sql is None:
+        if tri:
+            sql = _build_tri_insert_sql(fields, on_conflict, source)
+        else:
+            sql = _build_insert_sql(model, fields, on_conflict, source)
+        _insert_sql_cache[key] = sql
+    return sql, fields
+
+def bulk_insert(model, rows, columns=None, on_conflict=None, chunk_size=100000):
+    """
+    Insert ``rows`` into ``model``'s table with the JSON array method.
+
+    ``rows`` may be any iterable, consumed ``chunk_size`` rows at a time so the
+    whole data set never has to be materialised. Each row is either a sequence
+    ordered like ``columns`` or a dict keyed by field names (all rows of one
+    call share a shape). FK fields take
+    raw ids, e.g. ``bulk_insert(Result, [(1, 2, -1)])``.
+
+    ``on_conflict`` is one of ``None`` (abort), ``'ignore'``, ``'replace'`` or
+    ``'update'`` (upsert the non-key columns).
+
+    All chunks are written in a single transaction. Returns the number of rows
+    changed as reported by SQLite.
+    """
+    sql, fields = insert_sql(model, columns, on_conflict)
+    names = [f.name for f in fields]
+
+    def encode(chunk):
+        if chunk and isinstance(chunk[0], dict):
+            chunk = [[r[n] for n in names] for r in chunk]
+        return json.dumps(chunk)
+
+    ordered = model is Result and result_layout != 'pair'
+    track = model is Result and cache is not None
+    if ordered or track:
+        ia, ib = names.index('a'), names.index('b')
+    if track:
+        written = []
+
+    it = iter(rows)
+    count = 0
+    with conn.atomic():
+        while True:
+            with phase('build'):
+                chunk = list(islice(it, chunk_size))
+            if not chunk:
+                break
+            if ordered:
+                keys = ('a', 'b') if isinstance(chunk[0], dict) else (ia, ib)
+                chunk = list(_ordered_rows(
+                    chunk, *keys, on_conflict == 'ignore', peewee.IntegrityError
+                ))
+                if not chunk:
+                    continue
+            if track:
+                if isinstance(chunk[0], dict):
+                    written += [(r['a'], r['b']) for r in chunk]
+                else:
+                    written += [(r[ia], r[ib]) for r in chunk]
+            with phase('serialize'):
+                data = encode(chunk)
+            cur = conn.execute_sql(sql, (data,))
+            count += cur.rowcount
+        if model is Result and count:
+            _bump_generation()
+    if track:
+        cache.invalidate(written)
+    return count
+
+def stream_insert(model, rows, columns=None, on_conflict=None) -> int:
+    """
+    Insert ``rows`` with sqlite3's ``executemany``, one transaction.
+
+    sqlite3 pulls the rows from the iterable one at a time, so a generator
+    is never materialised and memory stays constant whatever the row count;
+    there is no JSON encoding and no placeholder limit either. Rows are
+    sequences ordered like ``columns``; ``on_conflict`` is as for
+    ``bulk_insert``. Returns the number of rows changed.
+    """
+    sql, fields = insert_sql(model, columns, on_conflict, source='values')
+    if model is Result and result_layout != 'pair':
+        names = [f.name for f in fields]
+        rows = _ordered_rows(
+            rows, names.index('a'), names.index('b'), on_conflict == 'ignore'
+        )
+    with conn.atomic(), phase('step'): # rows are built while stepping
+        count = conn.connection().executemany(sql, rows).rowcount
+        if model is Result and count:
+            _bump_generation()
+    if model is Result and cache is not None:
+        cache.clear() # remembering every written pair would cost memory
+    return count
+
+
+## Sample paths
+# path -> id of every sample this process has resolved. Sample ids never
+# change, so entries stay valid until the database is closed.
+_path_ids = {}
+
+def resolve_paths(paths, create=True, chunk_size=100000) -> dict:
+    """
+    Map sample paths to ids in bulk: paths already resolved by this process
+    come from memory, the rest take one SELECT per chunk through json_each.
+    With ``create=True`` unknown paths are registered by an
+    ``INSERT ... ON CONFLICT DO NOTHING RETURNING`` in the same transaction,
+    otherwise they are left out of the returned dict.
+    """
+    found = {}
+    missing = []
+    for p in paths:
+        i = _path_ids.get(p)
+        if i is None:
+            missing.append(p)
+        else:
+            found[p] = i
+    if not missing:
+        return found
+
+    SELECT = """
+    SELECT s.path, s.id FROM json_each(?) AS j
+    CROSS JOIN sample AS s ON s.path = j.value;
+    """
+    INSERT = """
+    INSERT INTO sample (path) SELECT value FROM json_each(?)
+    WHERE true ON CONFLICT DO NOTHING
+    RETURNING path, id;
+    """
+    it = iter(dict.fromkeys(missing)) # dedupe, keep order
+    resolved = {}
+    with conn.atomic('IMMEDIATE' if create else 'DEFERRED'):
+        while True:
+            chunk = list(islice(it, chunk_size))
+            if not chunk:
+                break
+            rows = conn.execute_sql(SELECT, (json.dumps(chunk),))
+            resolved.update(rows)
+            new = [p for p in chunk if p not in resolved]
+            if create and new:
+                rows = conn.execute_sql(INSERT, (json.dumps(new),))
+                resolved.update(rows)
+    # only remember ids once they are committed
+    _path_ids.update(resolved)
+    found.update(resolved)
+    return found
+
+
+## Compiled statements
+# peewee builds an expression tree and generates SQL for every query. These
+# helpers generate the SQL of the common single-row queries once per model
+# and layout, then run it on the raw sqlite3 connection, so a call only
+# binds its parameters.
+COMPILED_KINDS = ('get', 'create', 'update')
+_compiled_cache = {}
+
+def _build_compiled_sql(model, kind):
+    pk = model._meta.get_primary_keys()
+    pk_names = {f.name for f in pk}
+    fields = _resolve_fields(model)
+    if model is Result and result_layout != 'pair':
+        # a >= b keys another pair: no row, as in the pair layout
+        k = _tri_key_sql('?1', '?2')
+        return {
+            'get': f"SELECT ?1, ?2, val FROM result_tri "
+                   f"WHERE ?1 < ?2 AND k = {k};",
+            'create': f"INSERT INTO result_tri (k, val) VALUES ({k}, ?3);",
+            'update': f"UPDATE result_tri SET val = ?1 "
+                      f"WHERE ?2 < ?3 AND k = {_tri_key_sql('?2', '?3')};",
+        }[kind]
+
+    # Compile with placeholder values, the parameter order is what counts
+    where = reduce(operator.and_, [f == 0 for f in pk])
+    if kind == 'get':
+        query = model.select().where(where)
+    elif kind == 'create':
+        query = model.insert({f: 0 for f in fields})
+    else:
+        values = {f: 0 for f in fields if f.name not in pk_names}
+        query = model.update(values).where(where)
+    sql, _ = query.sql()
+    return sql
+
+def compiled_sql(model, kind) -> str:
+    """
+    Return the cached SQL of a single-row query on ``model``, ``kind`` being
+    one of ``COMPILED_KINDS``. Parameters are laid out as:
+
+    - ``get``: the primary key fields;
+    - ``create``: the fields bulk_insert uses by default, in order;
+    - ``update``: the non-key fields of ``create``, then the primary key.
+    """
+    if kind not in COMPILED_KINDS:
+        raise ValueError(f"Unknown statement kind: {kind!r}")
+    key = (model, kind, result_layout if model is Result else None)
+    sql = _compiled_cache.get(key)
+    if sql is None:
+        sql = _compiled_cache[key] = _build_compiled_sql(model, kind)
+    return sql
+
+def get_by_pk(model, *key, as_model=False):
+    """
+    Fetch the row of ``model`` with primary key ``key`` (raw ids for FK
+    fields), e.g. ``get_by_pk(Result, a, b)``. Returns a tuple in field
+    order, a model instance with ``as_model=True``, or None if missing.
+    """
+    row = _reader().connection().execute(
+        compiled_sql(model, 'get'), key
+    ).fetchone()
+    if row is None or not as_model:
+        return row
+    inst = model(**{f.name: v for f, v in zip(model._meta.sorted_fields, row)})
+    inst._dirty.clear()
+    return inst
+
+def _write_result(sql, values):
+    """
+    Run a single-row write of result and bump the generation with it, once
+    per enclosing transaction. An autocommit write is its own transaction.
+    """
+    database = conn.obj # runs per row, skip the proxy's __getattr__
+    if not database.in_transaction():
+        with conn.atomic():
+            return _write_result(sql, values)
+    cur = database.connection().execute(sql, values)
+    if cur.rowcount:
+        _bump_generation()
+    return cur
+
+def create_row(model, *values) -> int:
+    """
+    Insert one row, ``values`` ordered like ``insert_sql``'s default fields.
+    Returns the rowid.
+    """
+    if model is Result and result_layout != 'pair' and values[0] >= values[1]:
+        raise sqlite3.IntegrityError(_ORDER_ERROR)
+    if model is not Result:
+        return conn.connection().execute(
+            compiled_sql(model, 'create'), values
+        ).lastrowid
+    cur = _write_result(compiled_sql(model, 'create'), values)
+    if cache is not None:
+        cache.invalidate([values[:2]])
+    return cur.lastrowid
+
+def update_row(model, *values) -> int:
+    """
+    Update one row by primary key, e.g. ``update_row(Result, val, a, b)``.
+    Returns the number of rows changed.
+    """
+    if model is not Result:
+        return conn.connection().execute(
+            compiled_sql(model, 'update'), values
+        ).rowcount
+    cur = _write_result(compiled_sql(model, 'update'), values)
+    if cache is not None:
+        cache.invalidate([values[-2:]])
+    return cur.rowcount
+
+
+## Result lookup
+# A strategy takes a list of normalised, distinct (a, b) pairs and yields
+# (a_id, b_id, val) rows for those that exist. Register new ones in
+# LOOKUP_STRATEGIES together with a COST_MODEL entry.
+def _lookup_1b1(pairs):
+    cur = _reader().cursor()
+    if result_layout == 'pair':
+        SQL = "SELECT val FROM result WHERE a_id = ? AND b_id = ?;"
+        params = lambda a, b: (a, b)
+    else:
+        SQL = "SELECT val FROM result_tri WHERE k = ?;"
+        params = lambda a, b: (tri_key(a, b),)
+    for a, b in pairs:
+        row = cur.execute(SQL, params(a, b)).fetchone()
+        if row is not None:
+            yield a, b, row[0]
+
+def _lookup_json_sql():
+    a, b = "(j.value ->> '$[0]')", "(j.value ->> '$[1]')"
+    return f"""
+    SELECT {a}, {b}, r.val
+    FROM json_each(?) AS j CROSS JOIN {_result_table()} AS r
+    ON {_match('r', a, b)};
+    """
+
+def _lookup_json(pairs):
+    with phase('serialize'):
+        data = json.dumps(pairs)
+    return _reader().execute_sql(_lookup_json_sql(), (data,))
+
+def _lookup_idset(pairs):
+    # Query the whole id-set block, then keep only the requested pairs.
+    # The ids are distinct and sorted, so no DISTINCT pass is needed.
+    SQL = f"""
+    SELECT s1.value, s2.value, r.val
+    FROM json_each(?) AS s1
+    CROSS JOIN json_each(?) AS s2 ON s1.value < s2.value
+    CROSS JOIN {_result_table()} AS r ON {_match('r', 's1.value', 's2.value')};
+    """
+    ids = json.dumps(sorted({i for p in pairs for i in p}))
+    wanted = set(pairs)
+    cur = _reader().execute_sql(SQL, (ids, ids))
+    return (row for row in cur if (row[0], row[1]) in wanted)
+
+LOOKUP_STRATEGIES = {
+    '1b1': _lookup_1b1,
+    'json': _lookup_json,
+    'idset': _lookup_idset,
+}
+
+## Lookup planner
+# Each strategy costs ``c0 + c1 * rows`` seconds, where rows is the number
+# of pairs for 1b1/json and the size of the implied id-set block for idset.
+# The defaults are read off the Query RPS table in readme.md; use calibrate()
+# to refit them from benchmark digests on the target machine.
+COST_MODEL = {
+    '1b1': (0.0, 2.4e-4),
+    'json': (1.0e-3, 1.0e-5),
+    'idset': (5.5e-4, 4.5e-6),
+}
+
+# query_bench function name -> strategy it measures
+CALIBRATION_FUNCS = {
+    'time_qry_1b1': '1b1',
+    'time_qry_blkjson': 'json',
+    'time_qry_idset': 'idset',
+}
+
+def _idset_block(qry_count):
+    # mirrors the id-set sizing in query_bench.time_qry_idset
+    k = ceil((1 + (1 + 8 * qry_count) ** 0.5) / 2)
+    return k * (k - 1) // 2
+
+def _fit_linear(points):
+    n = len(points)
+    mx = sum(x for x, _ in points) / n
+    my = sum(y for _, y in points) / n
+    sxx = sum((x - mx) ** 2 for x, _ in points)
+    if sxx == 0:
+        return 0.0, my / mx
+    c1 = sum((x - mx) * (y - my) for x, y in points) / sxx
+    c1 = max(c1, 1e-9)
+    return max(my - c1 * mx, 0.0), c1
+
+def calibrate(paths) -> dict:
+    """
+    Fit a cost model from ``data/*.json`` files written by ``utils.bench``
+    for the query benchmark. Strategies without usable digests keep their
+    current coefficients. Returns the new model; pass it to
+    ``set_cost_model`` to use it.
+    """
+    points = {method: [] for method in COST_MODEL}
+    for path in paths:
+        with builtins.open(path) as f:
+            records = json.load(f)
+        options = records.get("options", [])
+        for fn, method in CALIBRATION_FUNCS.items():
+            for opt, t in zip(options, records.get("digest", {}).get(fn, [])):
+                if t is None or t <= 0 or "qry_count" not in opt:
+                    continue
+                rows = opt["qry_count"]
+                if method == 'idset':
+                    rows = _idset_block(rows)
+                points[method].append((rows, t))
+
+    model = dict(COST_MODEL)
+    for method, pts in points.items():
+        if pts:
+            model[method] = _fit_linear(pts)
+    return model
+
+def set_cost_model(model: dict):
+    COST_MODEL.update(model)
+
+def estimate_cost(method, n_pairs, n_ids) -> float:
+    c0, c1 = COST_MODEL[method]
+    rows = n_ids * (n_ids - 1) // 2 if method == 'idset' else n_pairs
+    return c0 + c1 * rows
+
+def pick_strategy(pairs):
+    """
+    Pick the cheapest lookup strategy for normalised, distinct ``pairs``
+    from the pair count and the number of distinct ids, i.e. how dense the
+    implied id-set block is.
+    """
+    n_ids = len({i for p in pairs for i in p})
+    return min(
+        COST_MODEL,
+        key=lambda method: estimate_cost(method, len(pairs), n_ids)
+    )
+
+def normalize_pairs(pairs):
+    """Order every pair so that a < b and drop duplicates, keeping order."""
+    out = {}
+    for a, b in pairs:
+        if a < b:
+            out[(a, b)] = None
+        elif a > b:
+            out[(b, a)] = None
+        else:
+            raise ValueError(f"Invalid query pair: {a}, {b}")
+    return list(out)
+
+## Pair cache
+# An optional in-process LRU of (a, b) -> val in front of get_results.
+# Writes made through this module invalidate the pairs they touch; writes
+# made behind its back (other processes, raw SQL) need cache.clear().
+class PairCache:
+    """
+    A bounded LRU map of normalised ``(a, b)`` pairs to ``val``.
+
+    Every invalidation bumps ``epoch``. A reader notes the epoch before it
+    queries SQLite and ``update`` drops its rows if the epoch moved since, so
+    a lookup racing a write never caches the value the write replaced.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.epoch = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def lookup(self, pairs):
+        """Split ``pairs`` into a dict of cached values and a list of misses."""
+        found, missing = {}, []
+        with self._lock:
+            for p in pairs:
+                val = self._data.get(p)
+                if val is None:
+                    missing.append(p)
+                else:
+                    self._data.move_to_end(p)
+                    found[p] = val
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def update(self, rows, epoch):
+        """Cache ``(a, b, val)`` rows read while the epoch was ``epoch``."""
+        with self._lock:
+            if epoch != self.epoch:
+                return
+            for a, b, val in rows:
+                self._data[(a, b)] = val
+                self._data.move_to_end((a, b))
+            extra = len(self._data) - self.max_size
+            for _ in range(max(extra, 0)):
+                self._data.popitem(last=False)
+            self.evictions += max(extra, 0)
+
+    def invalidate(self, pairs):
+        with self._lock:
+            self.epoch += 1
+            for a, b in pairs:
+                self._data.pop((a, b) if a < b else (b, a), None)
+
+    def clear(self):
+        with self._lock:
+            self.epoch += 1
+            self._data.clear()
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._data), 'hits': self.hits,
+            'misses': self.misses, 'evictions': self.evictions,
+        }
+
+cache: PairCache = None
+
+RESULT_DTYPE = [('a', '<i8'), ('b', '<i8'), ('val', '<f8')]
+
+def _rows_to_arrays(rows):
+    import numpy as np
+    arr = np.fromiter(rows, dtype=RESULT_DTYPE)
+    return arr['a'], arr['b'], arr['val']
+
+def get_results(pairs, method=None, out='dict'):
+    """
+    Look up ``val`` for many ``(a, b)`` pairs.
+
+    Pairs are accepted in either order. ``out='dict'`` returns a dict mapping
+    each normalised ``(a, b)`` with ``a < b`` to its value; ``out='array'``
+    returns parallel NumPy arrays ``(a, b, val)`` filled straight from the
+    cursor. Pairs missing from the table are absent. ``method`` names an
+    entry of ``LOOKUP_STRATEGIES`` and defaults to the planner's choice, see
+    ``pick_strategy``. With a ``cache``, only the pairs it misses are sent
+    to SQLite, and the method is planned for those.
+    """
+    if out not in ('dict', 'array'):
+        raise ValueError(f"Unknown output format: {out!r}")
+    pairs = normalize_pairs(pairs)
+    if cache is not None:
+        epoch = cache.epoch
+        found, pairs = cache.lookup(pairs)
+    with reading():
+        rows = []
+        if pairs:
+            if method is None:
+                method = pick_strategy(pairs)
+            rows = LOOKUP_STRATEGIES[method](pairs)
+        if cache is not None:
+            rows = list(rows)
+            cache.update(rows, epoch)
+            rows = chain(((a, b, val) for (a, b), val in found.items()), rows)
+        with phase('fetch'):
+            if out == 'array':
+                return _rows_to_arrays(rows)
+            return {(a, b): val for a, b, val in rows}
+
+def get_submatrix(ids1, ids2=None, diag=0.0, missing=float('nan')):
+    """
+    Return the dense ``len(ids1) x len(ids2)`` NumPy matrix of values between
+    two id lists (``ids2`` defaults to ``ids1``). SQLite reports each row's
+    positions through json_each's ``key`` column, so filling the matrix is a
+    single vectorized assignment. Same-id entries get ``diag``, pairs missing
+    from the table get ``missing``.
+    """
+    import numpy as np
+    ids1 = np.asarray(ids1, dtype=np.int64)
+    sym = ids2 is None
+    ids2 = ids1 if sym else np.asarray(ids2, dtype=np.int64)
+
+    lo, hi = "min(s1.value, s2.value)", "max(s1.value, s2.value)"
+    SQL = f"""
+    SELECT s1.key, s2.key, r.val
+    FROM json_each(?) AS s1
+    CROSS JOIN json_each(?) AS s2 ON s1.value {'<' if sym else '<>'} s2.value
+    CROSS JOIN {_result_table()} AS r ON {_match('r', lo, hi)};
+    """
+    j1 = json.dumps(ids1.tolist())
+    j2 = j1 if sym else json.dumps(ids2.tolist())
+    with reading() as rdb:
+        i, j, val = _rows_to_arrays(rdb.execute_sql(SQL, (j1, j2)))
+
+    out = np.full((len(ids1), len(ids2)), missing, dtype=np.float64)
+    out[i, j] = val
+    if sym:
+        out[j, i] = val
+    out[ids1[:, None] == ids2[None, :]] = diag
+    return out
+
+
+def get_cross(ids_a, ids_b, out='dict'):
+    """
+    Look up every pair between id sets A and B (x in A, y in B, x != y),
+    each unordered pair once, in one streaming query.
+
+    A x B is split into disjoint parts that need no DISTINCT pass:
+    A x (B - A), (A - B) x (A & B) and the upper triangle of (A & B)^2.
+    Every part is joined smaller id outer, larger id inner, so the result
+    index is probed in key order. Results come back like ``get_results``.
+    """
+    if out not in ('dict', 'array'):
+        raise ValueError(f"Unknown output format: {out!r}")
+    a_set, b_set = set(ids_a), set(ids_b)
+    parts = [
+        sorted(a_set), sorted(b_set - a_set),
+        sorted(a_set - b_set), sorted(a_set & b_set),
+    ]
+
+    part = lambda x, y: f"""
+    SELECT x.value, y.value, r.val
+    FROM json_each(?{x}) AS x
+    CROSS JOIN json_each(?{y}) AS y ON x.value < y.value
+    CROSS JOIN {_result_table()} AS r ON {_match('r', 'x.value', 'y.value')}
+    """
+    SQL = "UNION ALL".join([
+        part(1, 2), part(2, 1), # A x (B - A)
+        part(3, 4), part(4, 3), # (A - B) x (A & B)
+        part(4, 4),             # (A & B) x (A & B)
+    ])
+    with reading() as rdb:
+        rows = rdb.execute_sql(SQL, [json.dumps(p) for p in parts])
+        if out == 'array':
+            return _rows_to_arrays(rows)
+        return {(a, b): val for a, b, val in rows}
+
+## Parallel lookup
+# One core tops out at about 100k rows/s on the JSON path whatever the batch
+# size. LookupPool splits a batch into chunks and runs the JSON lookup on a
+# pool of reader processes, each keeping one read-only connection open.
+# Pairs go in and rows come back through shared memory as RESULT_DTYPE
+# arrays; only names and offsets are pickled.
+_worker_reader = None # (connection, SQL) of a pool process
+
+def _lookup_worker_init(path, sql):
+    global _worker_reader
+    _worker_reader = (sqlite3.connect(f'file:{path}?mode=ro', uri=True), sql)
+
+def _lookup_worker(in_name, out_name, n, start, stop) -> int:
+    import numpy as np
+    con, sql = _worker_reader
+    src = shared_memory.SharedMemory(name=in_name)
+    dst = shared_memory.SharedMemory(name=out_name)
+    try:
+        pairs = np.ndarray((n, 2), dtype='<i8', buffer=src.buf)[start:stop]
+        cur = con.execute(sql, (json.dumps(pairs.tolist()),))
+        rows = np.fromiter(cur, dtype=RESULT_DTYPE)
+        out = np.ndarray((n,), dtype=RESULT_DTYPE, buffer=dst.buf)
+        out[start:start + len(rows)] = rows
+        del pairs, out # views must go before the blocks are closed
+        return len(rows)
+    finally:
+        src.close()
+        dst.close()
+
+class LookupPool:
+    """
+    ``workers`` reader processes (default: one per core) for the database
+    currently open, which should be in WAL mode so they never block the
+    writer. ``chunk_size`` defaults to an even split over the workers.
+    """
+
+    def __init__(self, workers=None, chunk_size=None):
+        self.workers = workers or os.cpu_count()
+        self.chunk_size = chunk_size
+        # Start the tracker before forking so the workers share it: one
+        # they started themselves would unlink the blocks they attach to
+        resource_tracker.ensure_running()
+        self._pool = mp.Pool(
+            self.workers, initializer=_lookup_worker_init,
+            initargs=(conn.database, _lookup_json_sql()),
+        )
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get_results(self, pairs, out='array'):
+        """``get_results`` over the pool, ``out='array'`` by default."""
+        import numpy as np
+        if out not in ('dict', 'array'):
+            raise ValueError(f"Unknown output format: {out!r}")
+        pairs = normalize_pairs(pairs)
+        n = len(pairs)
+        rows = np.empty(0, dtype=RESULT_DTYPE)
+        if n:
+            chunk = self.chunk_size or ceil(n / self.workers)
+            bounds = [(s, min(s + chunk, n)) for s in range(0, n, chunk)]
+            src = shared_memory.SharedMemory(create=True, size=16 * n)
+            dst = shared_memory.SharedMemory(
+                create=True, size=np.dtype(RESULT_DTYPE).itemsize * n
+            )
+            try:
+                np.ndarray((n, 2), dtype='<i8', buffer=src.buf)[:] = pairs
+                counts = self._pool.starmap(_lookup_worker, [
+                    (src.name, dst.name, n, start, stop)
+                    for start, stop in bounds
+                ])
+                res = np.ndarray((n,), dtype=RESULT_DTYPE, buffer=dst.buf)
+                rows = np.concatenate([
+                    res[start:start + count]
+                    for (start, _), count in zip(bounds, counts)
+                ])
+                del res
+            finally:
+                for shm in (src, dst):
+                    shm.close()
+                    shm.unlink()
+        if out == 'array':
+            return rows['a'], rows['b'], rows['val']
+        return dict(zip(
+            zip(rows['a'].tolist(), rows['b'].tolist()), rows['val'].tolist()
+        ))
+
+
+## Job queue
+# Pending results are handed out by flipping val from PENDING to DISPATCHED
+# and recording a Lease. Expired leases are put back to PENDING.
+# The partial index on pending results is not part of the schema: right
+# after allocation every result is pending, so it would be a second full
+# index slowing every bulk allocation.
+_PENDING_INDEX_DDL = {
+    'pair': f"""
+    CREATE INDEX IF NOT EXISTS result_pending
+    ON result (a_id, b_id) WHERE val = {float(PENDING)};
+    """,
+    'tri': f"""
+    CREATE INDEX IF NOT EXISTS result_tri_pending
+    ON result_tri (k) WHERE val = {float(PENDING)};
+    """,
+}
+
+def create_queue_index():
+    """
+    Index the PENDING results so ``claim_batch`` does not scan ``result``.
+    Call it once the results are allocated, before dispatching them.
+    """
+    conn.execute_sql(_PENDING_INDEX_DDL[
+        'pair' if result_layout == 'pair' else 'tri'
+    ])
+
+def reclaim_expired(now=None) -> int:
+    """Return results whose lease expired to PENDING. Returns the count."""
+    now = time.time() if now is None else now
+    table = _result_table()
+    SQL = f"""
+    UPDATE {table} SET val = ?
+    FROM lease AS l
+    WHERE l.expires < ? AND {table}.val = ?
+    AND {_match(table, 'l.a_id', 'l.b_id')};
+    """
+    with conn.atomic():
+        cur = conn.execute_sql(SQL, (PENDING, now, DISPATCHED))
+        count = cur.rowcount
+        Lease.delete().where(Lease.expires < now).execute()
+        if count:
+            _bump_generation()
+    if count and cache is not None:
+        cache.clear()
+    return count
+
+def claim_batch(worker_id, n, lease_time=600.0) -> list:
+    """
+    Atomically claim up to ``n`` PENDING results for ``worker_id``.
+
+    The pairs are picked and flipped to DISPATCHED by one statement inside an
+    IMMEDIATE transaction, so concurrent callers never receive the same pair.
+    Each claim is leased for ``lease_time`` seconds; expired leases are
+    reclaimed first. Returns a list of ``(a_id, b_id)``, empty when nothing is
+    pending. See ``create_queue_index``.
+    """
+    # The literal must match the pending index predicate exactly, a bound
+    # parameter would not let SQLite use the partial index.
+    if result_layout == 'pair':
+        SQL = f"""
+        UPDATE result SET val = ?
+        WHERE (a_id, b_id) IN (
+            SELECT a_id, b_id FROM result WHERE val = {float(PENDING)} LIMIT ?
+        )
+        RETURNING a_id, b_id;
+        """
+    else:
+        SQL = f"""
+        UPDATE result_tri SET val = ?
+        WHERE k IN (
+            SELECT k FROM result_tri WHERE val = {float(PENDING)} LIMIT ?
+        )
+        RETURNING k;
+        """
+    now = time.time()
+    with conn.atomic('IMMEDIATE'):
+        reclaim_expired(now)
+        pairs = conn.execute_sql(SQL, (DISPATCHED, n)).fetchall()
+        if pairs:
+            _bump_generation()
+        if result_layout != 'pair':
+            pairs = [tri_pair(k) for k, in pairs]
+        expires = now + lease_time
+        bulk_insert(
+            Lease, ((a, b, worker_id, expires) for a, b in pairs),
+            on_conflict='replace'
+        )
+    if cache is not None:
+        cache.invalidate(pairs)
+    return pairs
+
+
+## Write-behind result sink
+class ResultSink:
+    """
+    Buffer worker results in memory and write them to ``result`` in bulk.
+
+    ``put`` only touches a dict; the buffer is flushed as a single
+    ``UPDATE ... FROM json_each(?)`` once it holds ``max_rows`` results or its
+    oldest result is ``max_delay`` seconds old, so ``max_delay`` bounds how
+    much work a crash can lose. A background thread enforces the delay while
+    no results arrive; pass ``max_delay=None`` to flush by size only.
+
+    The sink is flushed on ``close``, on leaving a ``with`` block, at
+    interpreter exit, and on any of ``signals`` (main thread only), after
+    which the previous handler runs; ``put`` raises once it is closed. With
+    ``upsert=True`` rows missing from ``result`` are inserted instead of
+    ignored.
+
+    A flush failing in the background thread stops the thread and is
+    raised from the next ``put``, ``flush`` or ``close``.
+    """
+
+    def __init__(self, max_rows=10000, max_delay=1.0, upsert=False,
+                 signals=(signal.SIGTERM,)):
+        if max_delay is not None and _owner is not None:
+            raise ValueError(
+                "A single-connection database cannot be flushed from a "
+                "background thread, pass max_delay=None"
+            )
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.upsert = upsert
+        self.flushed = 0
+
+        self._buf = {}
+        self._since = None
+        self._lock = threading.RLock()
+        self._closed = threading.Event()
+        self._flusher = None  # thread id inside flush
+        self._deferred = None # signal that interrupted it
+        self._error = None    # of the background thread
+
+        self._prev_handlers = {}
+        if threading.current_thread() is threading.main_thread():
+            for sig in signals:
+                self._prev_handlers[sig] = signal.signal(sig, self._on_signal)
+        atexit.register(self.close)
+
+        self._thread = None
+        if max_delay is not None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def put(self, a, b, val):
+        if a > b:
+            a, b = b, a
+        with self._lock:
+            self._raise_error()
+            if self._closed.is_set():
+                raise ValueError("ResultSink is closed")
+            if not self._buf:
+                self._since = time.monotonic()
+            self._buf[(a, b)] = val
+            # closed by a signal meanwhile: its flush missed this row
+            if (len(self._buf) >= self.max_rows or self._expired()
+                    or self._closed.is_set()):
+                self.flush()
+
+    def put_many(self, rows):
+        for a, b, val in rows:
+            self.put(a, b, val)
+
+    def flush(self) -> int:
+        """Write out everything buffered so far. Returns the row count."""
+        with self._lock:
+            self._raise_error()
+            self._flusher = threading.get_ident()
+            try:
+                return self._write()
+            finally:
+                self._flusher = None
+                deferred, self._deferred = self._deferred, None
+                if deferred is not None:
+                    self._on_signal(*deferred)
+
+    def _write(self):
+        if not self._buf:
+            return 0
+        rows = [[a, b, val] for (a, b), val in self._buf.items()]
+        if self.upsert:
+            bulk_insert(Result, rows, on_conflict='update')
+        else:
+            table = _result_table()
+            a, b = "(j.value ->> '$[0]')", "(j.value ->> '$[1]')"
+            SQL = f"""
+            UPDATE {table} SET val = (j.value ->> '$[2]')
+            FROM json_each(?) AS j
+            WHERE {_match(table, a, b)};
+            """
+            with conn.atomic():
+                if conn.execute_sql(SQL, (json.dumps(rows),)).rowcount:
+                    _bump_generation()
+            if cache is not None:
+                cache.invalidate(self._buf)
+        self._buf = {}
+        self._since = None
+        self.flushed += len(rows)
+        return len(rows)
+
+    def close(self, wait=True):
+        """
+        Flush and stop. ``wait=False`` does not join the background thread,
+        which stops on its own; the signal handler must not wait for it,
+        the thread may be blocked on the lock of the interrupted code.
+        """
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        try:
+            if wait and self._thread is not None:
+                self._thread.join()
+            self.flush()
+        finally:
+            atexit.unregister(self.close)
+            for sig, handler in self._prev_handlers.items():
+                signal.signal(sig, handler)
+            self._prev_handlers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self._buf)
+
+    def _expired(self):
+        return (
+            self.max_delay is not None and self._since is not None
+            and time.monotonic() - self._since >= self.max_delay
+        )
+
+    def _raise_error(self):
+        err, self._error = self._error, None
+        if err is not None:
+            raise err
+
+    def _run(self):
+        try:
+            while not self._closed.wait(self.max_delay / 4):
+                with self._lock:
+                    if self._expired():
+                        self.flush()
+        except Exception as e:
+            self._error = e
+        finally:
+            # peewee keeps one connection per thread
+            if not conn.is_closed():
+                conn.close()
+
+    def _on_signal(self, sig, frame):
+        if self._flusher == threading.get_ident():
+            # half-written flush: it handles the signal once it is done
+            self._deferred = (sig, frame)
+            return
+        prev = self._prev_handlers.get(sig)
+        try:
+            self.close(wait=False)
+        finally:
+            if callable(prev):
+                prev(sig, frame)
+            elif prev == signal.SIG_DFL:
+                signal.signal(sig, signal.SIG_DFL)
+                signal.raise_signal(sig)
+
+
+## Result allocation
+# Samples only ever get larger ids (Sample.id is AUTOINCREMENT), so the
+# largest sample id seen by the last allocation splits them into allocated
+# and new ones. Files whose sample table predates AUTOINCREMENT may have
+# reused ids, so they get every missing pair instead.
+ALLOC_WATERMARK_KEY = 'alloc_watermark'
+
+def _alloc_watermark() -> int:
+    row = Attachment.get_or_none(Attachment.key == ALLOC_WATERMARK_KEY)
+    if row is not None:
+        return int(row.val)
+    # Allocated before watermarks were kept: the largest b among the results
+    if result_layout == 'pair':
+        mark = conn.execute_sql("SELECT max(b_id) FROM result;").fetchone()[0]
+    else:
+        k = conn.execute_sql("SELECT max(k) FROM result_tri;").fetchone()[0]
+        mark = None if k is None else tri_pair(k)[1]
+    return mark or 0
+
+def _sample_autoincrement() -> bool:
+    row = conn.execute_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'sample';"
+    ).fetchone()
+    return row is not None and 'AUTOINCREMENT' in row[0].upper()
+
+def allocate_results() -> int:
+    """
+    Insert a PENDING result for every pair of samples that has none yet, in
+    one native statement. Only samples above the watermark kept in
+    ``Attachment`` are new, so this creates the new x old and new x new
+    pairs, costing k * N for k new of N samples; the first call allocates
+    everything. Returns the number of results created.
+
+    Without AUTOINCREMENT on the sample table (older files) the watermark
+    is ignored and every missing pair is inserted, costing N^2.
+
+    Rows are produced in key order of the layout, (a, b) for "pair" and
+    (b, a) for the tri layouts, so the result b-tree is mostly appended to.
+    """
+    reused = not _sample_autoincrement()
+    insert = "INSERT OR IGNORE" if reused else "INSERT"
+    if result_layout == 'pair':
+        SQL = f"""
+        {insert} INTO result (a_id, b_id, val)
+        SELECT s1.id, s2.id, {PENDING}
+        FROM sample AS s1 CROSS JOIN sample AS s2
+        ON s1.id < s2.id
+        WHERE s2.id > ?;
+        """
+    else:
+        SQL = f"""
+        {insert} INTO result_tri (k, val)
+        SELECT {_tri_key_sql('s1.id', 's2.id')}, {PENDING}
+        FROM sample AS s2 CROSS JOIN sample AS s1
+        ON s1.id < s2.id
+        WHERE s2.id > ?;
+        """
+    with conn.atomic('IMMEDIATE'):
+        mark = 0 if reused else _alloc_watermark()
+        top = conn.execute_sql("SELECT max(id) FROM sample;").fetchone()[0]
+        if top is None or top <= mark:
+            return 0
+        count = conn.execute_sql(SQL, (mark,)).rowcount
+        Attachment.replace(key=ALLOC_WATERMARK_KEY, val=str(top)).execute()
+    return count
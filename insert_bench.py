@@ -1,14 +1,20 @@
-from datetime import datetime, timedelta
+from utils import clock, since
 import pydantic
+import peewee
+import sqlite3
 import db
 import os
 import os.path
 import json
+import random
 
 class InstOption(pydantic.BaseModel):
     sample_count: int = 50
     sample_path_fmt: str = "/tmp/sample-{}"
     test_db_path: str = "bench-insert.db"
+    layout: str = "pair" # see db.LAYOUTS
+    new_count: int = 0 # samples added to an allocated database
+    new_frac: float = 0.5 # share of resolved paths not in the database yet
 
 ## Sample Insertion bench
 def time_sample_generation(opt = InstOption()):
@@ -16,10 +22,10 @@ def time_sample_generation(opt = InstOption()):
     sample_count = opt.sample_count
     sample_path_fmt = opt.sample_path_fmt
 
-    st = datetime.now()
+    st = clock()
     for i in range(sample_count):
         path = sample_path_fmt.format(i)
-    elapsed = datetime.now() - st
+    elapsed = since(st)
     print(f"Generated {sample_count} samples in {elapsed.microseconds} ms")
 
     return elapsed
@@ -33,12 +39,13 @@ def time_sample_inst_1b1(opt = InstOption()):
         os.remove(test_db_path)
     
     db.open(test_db_path)
-    st = datetime.now()
+    st = clock()
     for i in range(sample_count):
         path = sample_path_fmt.format(i)
         db.Sample.create(path=path)
-    count = db.Sample.select().count()
-    elapsed = datetime.now() - st
+    elapsed = since(st)
+    with db.phase("check"):
+        count = db.Sample.select().count()
     db.close()
     print(f"Inserted {count} samples in {elapsed}")
 
@@ -53,13 +60,14 @@ def time_sample_inst_1b1_tsc(opt = InstOption()):
         os.remove(test_db_path)
     
     db.open(test_db_path)
-    st = datetime.now()
+    st = clock()
     with db.conn.atomic() as tsc:
         for i in range(sample_count):
             path = sample_path_fmt.format(i)
             db.Sample.create(path=path)
-    count = db.Sample.select().count()
-    elapsed = datetime.now() - st
+    elapsed = since(st)
+    with db.phase("check"):
+        count = db.Sample.select().count()
     db.close()
     print(f"Inserted {count} samples in {elapsed}")
 
@@ -74,12 +82,13 @@ def time_sample_inst_1b1_wal(opt = InstOption()):
         os.remove(test_db_path)
     
     db.open(test_db_path, wal=True)
-    st = datetime.now()
+    st = clock()
     for i in range(sample_count):
         path = sample_path_fmt.format(i)
         db.Sample.create(path=path)
-    count = db.Sample.select().count()
-    elapsed = datetime.now() - st
+    elapsed = since(st)
+    with db.phase("check"):
+        count = db.Sample.select().count()
     db.close()
     print(f"Inserted {count} samples in {elapsed}")
 
@@ -94,13 +103,36 @@ def time_sample_inst_1b1_wal_tsc(opt = InstOption()):
         os.remove(test_db_path)
     
     db.open(test_db_path, wal=True)
-    st = datetime.now()
+    st = clock()
     with db.conn.atomic() as tsc:
         for i in range(sample_count):
             path = sample_path_fmt.format(i)
             db.Sample.create(path=path)
-    count = db.Sample.select().count()
-    elapsed = datetime.now() - st
+    elapsed = since(st)
+    with db.phase("check"):
+        count = db.Sample.select().count()
+    db.close()
+    print(f"Inserted {count} samples in {elapsed}")
+
+    return elapsed
+
+def time_sample_inst_1b1_compiled_wal_tsc(opt = InstOption()):
+    sample_count = opt.sample_count
+    sample_path_fmt = opt.sample_path_fmt
+    test_db_path = opt.test_db_path
+
+    if os.path.exists(test_db_path):
+        os.remove(test_db_path)
+    
+    db.open(test_db_path, wal=True)
+    st = clock()
+    with db.conn.atomic() as tsc:
+        for i in range(sample_count):
+            path = sample_path_fmt.format(i)
+            db.create_row(db.Sample, path)
+    elapsed = since(st)
+    with db.phase("check"):
+        count = db.Sample.select().count()
     db.close()
     print(f"Inserted {count} samples in {elapsed}")
 
@@ -115,14 +147,16 @@ def time_sample_inst_blk(opt = InstOption()):
         os.remove(test_db_path)
     
     db.open(test_db_path)
-    st = datetime.now()
-    samples = []
-    for i in range(sample_count):
-        path = sample_path_fmt.format(i)
-        samples.append({"path": path})
+    st = clock()
+    with db.phase("build"):
+        samples = []
+        for i in range(sample_count):
+            path = sample_path_fmt.format(i)
+            samples.append({"path": path})
     db.Sample.insert_many(samples).execute()
-    count = db.Sample.select().count()
-    elapsed = datetime.now() - st
+    elapsed = since(st)
+    with db.phase("check"):
+        count = db.Sample.select().count()
     db.close()
     print(f"Inserted {count} samples in {elapsed}")
 
@@ -137,33 +171,127 @@ def time_sample_inst_wal_blkjson(opt = InstOption()):
         os.remove(test_db_path)
     
     db.open(test_db_path, wal=True)
-    st = datetime.now()
-    samples = []
-    for i in range(sample_count):
-        samples.append({"path": sample_path_fmt.format(i)})
+    st = clock()
+    with db.phase("build"):
+        samples = []
+        for i in range(sample_count):
+            samples.append({"path": sample_path_fmt.format(i)})
     SQL = """
     INSERT INTO sample (path)
     SELECT j.value ->> '$.path'
     FROM json_each(?) AS j;
     """
-    db.conn.execute_sql(SQL, (json.dumps(samples),))
-    count = db.Sample.select().count()
-    elapsed = datetime.now() - st
+    with db.phase("serialize"):
+        data = json.dumps(samples)
+    db.conn.execute_sql(SQL, (data,))
+    elapsed = since(st)
+    with db.phase("check"):
+        count = db.Sample.select().count()
     db.close()
     print(f"Inserted {count} samples in {elapsed}")
 
     return elapsed
 
+def time_sample_inst_bulk(opt = InstOption()):
+    sample_count = opt.sample_count
+    sample_path_fmt = opt.sample_path_fmt
+    test_db_path = opt.test_db_path
+
+    if os.path.exists(test_db_path):
+        os.remove(test_db_path)
+    
+    db.open(test_db_path, wal=True)
+    st = clock()
+    samples = (
+        (sample_path_fmt.format(i),)
+        for i in range(sample_count)
+    )
+    db.bulk_insert(db.Sample, samples)
+    elapsed = since(st)
+    with db.phase("check"):
+        count = db.Sample.select().count()
+    db.close()
+    print(f"Inserted {count} samples in {elapsed}")
+
+    return elapsed
+
+def __before_resolve(opt: InstOption):
+    """
+    Store the first (1 - new_frac) * sample_count paths, return them and the
+    sample_count paths to resolve, shuffled.
+    """
+    test_db_path = opt.test_db_path
+    if os.path.exists(test_db_path):
+        os.remove(test_db_path)
+
+    paths = [opt.sample_path_fmt.format(i) for i in range(opt.sample_count)]
+    old = paths[:round(opt.sample_count * (1 - opt.new_frac))]
+    db.open(test_db_path, wal=True)
+    db.bulk_insert(db.Sample, ((p,) for p in old))
+    db.close()
+    random.shuffle(paths)
+    return old, paths
+
+def time_sample_resolve_1b1(opt = InstOption()):
+    _, paths = __before_resolve(opt)
+
+    db.open(opt.test_db_path, wal=True)
+    st = clock()
+    ids = {}
+    with db.conn.atomic() as tsc:
+        for p in paths:
+            sample = db.Sample.get_or_none(db.Sample.path == p)
+            if sample is None:
+                sample = db.Sample.create(path=p)
+            ids[p] = sample.id
+    elapsed = since(st)
+    count = db.Sample.select().count()
+    db.close()
+    assert count == len(ids) == opt.sample_count
+    print(f"Resolved {len(ids)} paths in {elapsed}")
+
+    return elapsed
+
+def time_sample_resolve_bulk(opt = InstOption()):
+    _, paths = __before_resolve(opt)
+
+    db.open(opt.test_db_path, wal=True)
+    st = clock()
+    ids = db.resolve_paths(paths)
+    elapsed = since(st)
+    count = db.Sample.select().count()
+    db.close()
+    assert count == len(ids) == opt.sample_count
+    print(f"Resolved {len(ids)} paths in {elapsed}")
+
+    return elapsed
+
+def time_sample_resolve_warm(opt = InstOption()):
+    """The stored paths were resolved before, only new ones hit SQLite."""
+    old, paths = __before_resolve(opt)
+
+    db.open(opt.test_db_path, wal=True)
+    db.resolve_paths(old)
+    st = clock()
+    ids = db.resolve_paths(paths)
+    elapsed = since(st)
+    count = db.Sample.select().count()
+    db.close()
+    assert count == len(ids) == opt.sample_count
+    print(f"Resolved {len(ids)} paths in {elapsed}")
+
+    return elapsed
+
 ## Result Insertion Bench
 def time_rst_gen(opt = InstOption()):
     sample_count = opt.sample_count
 
-    st = datetime.now()
+    st = clock()
     rst = [] # mock database insertion
     for i in range(sample_count):
         for j in range(i+1, sample_count):
             rst.append({"a": i, "b": j, "val": 0})
-    elapsed = datetime.now() - st
+    elapsed = since(st)
     print(f"Generated {len(rst)} results in {elapsed}")
     return elapsed
 
@@ -186,12 +314,13 @@ def time_rst_inst_1b1(opt = InstOption()):
     sample_count = opt.sample_count
     
     db.open(test_db_path)
-    st = datetime.now()
+    st = clock()
     for i in range(sample_count):
         for j in range(i+1, sample_count):
             db.Result.create(a=i, b=j, val=-1)
-    count = db.Result.select(db.Result.a).count()
-    elapsed = datetime.now() - st
+    elapsed = since(st)
+    with db.phase("check"):
+        count = db.Result.select(db.Result.a).count()
     db.close()
     print(f"Inserted {count} results in {elapsed}")
 
@@ -204,13 +333,14 @@ def time_rst_inst_1b1_tsc(opt = InstOption()):
     sample_count = opt.sample_count
     
     db.open(test_db_path)
-    st = datetime.now()
+    st = clock()
     with db.conn.atomic() as tsc:
         for i in range(sample_count):
             for j in range(i+1, sample_count):
                 db.Result.create(a=i, b=j, val=-1)
-    count = db.Result.select(db.Result.a).count()
-    elapsed = datetime.now() - st
+    elapsed = since(st)
+    with db.phase("check"):
+        count = db.Result.select(db.Result.a).count()
     db.close()
     print(f"Inserted {count} results in {elapsed}")
 
@@ -223,12 +353,13 @@ def time_rst_inst_1b1_wal(opt = InstOption()):
     sample_count = opt.sample_count
     
     db.open(test_db_path, wal=True)
-    st = datetime.now()
+    st = clock()
     for i in range(sample_count):
         for j in range(i+1, sample_count):
             db.Result.create(a=i, b=j, val=-1)
-    count = db.Result.select(db.Result.a).count()
-    elapsed = datetime.now() - st
+    elapsed = since(st)
+    with db.phase("check"):
+        count = db.Result.select(db.Result.a).count()
     db.close()
     print(f"Inserted {count} results in {elapsed}")
 
@@ -241,13 +372,57 @@ def time_rst_inst_1b1_wal_tsc(opt = InstOption()):
     sample_count = opt.sample_count
     
     db.open(test_db_path, wal=True)
-    st = datetime.now()
+    st = clock()
     with db.conn.atomic() as tsc:
         for i in range(sample_count):
             for j in range(i+1, sample_count):
                 db.Result.create(a=i, b=j, val=-1)
-    count = db.Result.select(db.Result.a).count()
-    elapsed = datetime.now() - st
+    elapsed = since(st)
+    with db.phase("check"):
+        count = db.Result.select(db.Result.a).count()
+    db.close()
+    print(f"Inserted {count} results in {elapsed}")
+
+    return elapsed
+
+def time_rst_inst_1b1_compiled_wal_tsc(opt = InstOption()):
+    __before_rst_inst(opt)
+
+    test_db_path = opt.test_db_path
+    sample_count = opt.sample_count
+    
+    db.open(test_db_path, wal=True)
+    st = clock()
+    with db.conn.atomic() as tsc:
+        for i in range(sample_count):
+            for j in range(i+1, sample_count):
+                db.create_row(db.Result, i, j, -1)
+    elapsed = since(st)
+    with db.phase("check"):
+        count = db.Result.select(db.Result.a).count()
+    db.close()
+    print(f"Inserted {count} results in {elapsed}")
+
+    return elapsed
+
+def time_rst_inst_1b1_bare_wal_tsc(opt = InstOption()):
+    """The compiled statement alone, without create_row's bookkeeping."""
+    __before_rst_inst(opt)
+
+    test_db_path = opt.test_db_path
+    sample_count = opt.sample_count
+    
+    db.open(test_db_path, wal=True)
+    con = db.conn.connection()
+    sql = db.compiled_sql(db.Result, 'create')
+    st = clock()
+    with db.conn.atomic() as tsc:
+        for i in range(sample_count):
+            for j in range(i+1, sample_count):
+                con.execute(sql, (i, j, -1))
+    elapsed = since(st)
+    with db.phase("check"):
+        count = db.Result.select(db.Result.a).count()
     db.close()
     print(f"Inserted {count} results in {elapsed}")
 
@@ -260,14 +435,16 @@ def time_rst_inst_blk(opt = InstOption()):
     sample_count = opt.sample_count
     
     db.open(test_db_path)
-    st = datetime.now()
-    results = []
-    for i in range(sample_count):
-        for j in range(i+1, sample_count):
-            results.append({"a": i, "b": j, "val": 0})
+    st = clock()
+    with db.phase("build"):
+        results = []
+        for i in range(sample_count):
+            for j in range(i+1, sample_count):
+                results.append({"a": i, "b": j, "val": 0})
     db.Result.insert_many(results).execute()
-    count = db.Result.select(db.Result.a).count()
-    elapsed = datetime.now() - st
+    elapsed = since(st)
+    with db.phase("check"):
+        count = db.Result.select(db.Result.a).count()
     db.close()
     print(f"Inserted {count} results in {elapsed}")
 
@@ -279,7 +456,7 @@ def time_rst_inst_blkjson(opt = InstOption()):
     test_db_path = opt.test_db_path
     sample_count = opt.sample_count
 
-    # TODO: add a helper function to build the query automatically for a given model
+    # hand-written equivalent of db.insert_sql(db.Result)
     SQL = f"""
     INSERT INTO result (a_id, b_id, val)
     SELECT j.value ->> '$[0]', j.value ->> '$[1]', j.value ->> '$[2]'
@@ -287,23 +464,93 @@ def time_rst_inst_blkjson(opt = InstOption()):
     """
 
     db.open(test_db_path)
-    st = datetime.now()
-    arr = []
-    for i in range(sample_count):
-        for j in range(i+1, sample_count):
-            arr.append([i, j, 0])
-    db.conn.execute_sql(SQL, (json.dumps(arr),))
-    count = db.Result.select(db.Result.a).count()
-    elapsed = datetime.now() - st
+    st = clock()
+    with db.phase("build"):
+        arr = []
+        for i in range(sample_count):
+            for j in range(i+1, sample_count):
+                arr.append([i, j, 0])
+    with db.phase("serialize"):
+        data = json.dumps(arr)
+    db.conn.execute_sql(SQL, (data,))
+    elapsed = since(st)
+    with db.phase("check"):
+        count = db.Result.select(db.Result.a).count()
+    db.close()
+    print(f"Inserted {count} results in {elapsed}")
+
+    return elapsed
+
+def time_rst_inst_bulk(opt = InstOption()):
+    __before_rst_inst(opt)
+
+    test_db_path = opt.test_db_path
+    sample_count = opt.sample_count
+
+    db.open(test_db_path)
+    st = clock()
+    results = (
+        (i, j, 0)
+        for i in range(sample_count)
+        for j in range(i+1, sample_count)
+    )
+    db.bulk_insert(db.Result, results)
+    elapsed = since(st)
+    with db.phase("check"):
+        count = db.Result.select(db.Result.a).count()
+    db.close()
+    print(f"Inserted {count} results in {elapsed}")
+
+    return elapsed
+
+def time_rst_inst_stream(opt = InstOption()):
+    __before_rst_inst(opt)
+
+    test_db_path = opt.test_db_path
+    sample_count = opt.sample_count
+
+    db.open(test_db_path)
+    st = clock()
+    results = (
+        (i, j, 0)
+        for i in range(sample_count)
+        for j in range(i+1, sample_count)
+    )
+    db.stream_insert(db.Result, results)
+    elapsed = since(st)
+    with db.phase("check"):
+        count = db.Result.select(db.Result.a).count()
+    db.close()
+    print(f"Inserted {count} results in {elapsed}")
+
+    return elapsed
+
+def time_rst_inst_stream_wal(opt = InstOption()):
+    __before_rst_inst(opt)
+
+    test_db_path = opt.test_db_path
+    sample_count = opt.sample_count
+
+    db.open(test_db_path, wal=True)
+    st = clock()
+    results = (
+        (i, j, 0)
+        for i in range(sample_count)
+        for j in range(i+1, sample_count)
+    )
+    db.stream_insert(db.Result, results)
+    elapsed = since(st)
+    with db.phase("check"):
+        count = db.Result.select(db.Result.a).count()
     db.close()
     print(f"Inserted {count} results in {elapsed}")
 
     return elapsed
 
 def time_rst_inst_sql(opt = InstOption()):
-    st = datetime.now()
+    st = clock()
     __before_rst_inst(opt)
-    print(f"Preparation done in {datetime.now() - st}")
+    print(f"Preparation done in {since(st)}")
 
     test_db_path = opt.test_db_path
     SQL = """
@@ -314,27 +561,20 @@ def time_rst_inst_sql(opt = InstOption()):
     """
     db.open(test_db_path)
 
-    import time
-    # st = datetime.now()
-    st = time.perf_counter()
+    st = clock()
     db.conn.execute_sql(SQL)
-    count = db.Result.select(db.Result.a).count()
-    # elapsed = datetime.now() - st
-    elapsed = timedelta(seconds=time.perf_counter() - st)
-    class Elapsed:
-        def __init__(self, elapsed):
-            self.elapsed = elapsed
-        def total_seconds(self):
-            return self.elapsed
+    elapsed = since(st)
+    with db.phase("check"):
+        count = db.Result.select(db.Result.a).count()
     db.close()
     print(f"Inserted {count} results in {elapsed}")
 
     return elapsed
 
 def time_rst_inst_sql_wal(opt = InstOption()):
-    st = datetime.now()
+    st = clock()
     __before_rst_inst(opt)
-    print(f"Preparation done in {datetime.now() - st}")
+    print(f"Preparation done in {since(st)}")
 
     test_db_path = opt.test_db_path
     SQL = """
@@ -344,18 +584,109 @@ def time_rst_inst_sql_wal(opt = InstOption()):
     ON s1.id < s2.id;
     """
     db.open(test_db_path, wal=True)
-    import time
-    # st = datetime.now()
-    st = time.perf_counter()
+    st = clock()
     db.conn.execute_sql(SQL)
-    count = db.Result.select(db.Result.a).count()
-    # elapsed = datetime.now() - st
-    elapsed = timedelta(seconds=time.perf_counter() - st)
+    elapsed = since(st)
+    with db.phase("check"):
+        count = db.Result.select(db.Result.a).count()
     db.close()
     print(f"Inserted {count} results in {elapsed}")
 
     return elapsed
 
+def time_rst_inst_alloc(opt = InstOption()):
+    __before_rst_inst(opt)
+
+    test_db_path = opt.test_db_path
+    db.open(test_db_path, wal=True)
+    db.migrate_layout(opt.layout) # result is still empty
+
+    st = clock()
+    db.allocate_results()
+    elapsed = since(st)
+    with db.phase("check"):
+        count = db.Result.select().count()
+    db.close()
+    file_size = os.path.getsize(test_db_path)
+    print(f"Inserted {count} results in {elapsed}, file size {file_size} bytes")
+
+    return elapsed, {"file_size": file_size}
+
+def time_rst_inst_alloc_new(opt = InstOption()):
+    """Allocate the results of new_count samples added to sample_count ones."""
+    __before_rst_inst(opt)
+
+    test_db_path = opt.test_db_path
+    db.open(test_db_path, wal=True)
+    db.migrate_layout(opt.layout)
+    db.allocate_results()
+    db.bulk_insert(db.Sample, (
+        (opt.sample_path_fmt.format(i),)
+        for i in range(opt.sample_count, opt.sample_count + opt.new_count)
+    ))
+
+    st = clock()
+    pairs = db.allocate_results()
+    elapsed = since(st)
+    count = db.Result.select().count()
+    db.close()
+    n = opt.sample_count + opt.new_count
+    assert count == n * (n - 1) // 2, f"{count} results for {n} samples"
+    print(f"Inserted {pairs} results in {elapsed}")
+
+    return elapsed, {"pairs": pairs}
+
+def __time_rst_inst_staged(opt: InstOption, method, indexes):
+    __before_rst_inst(opt)
+
+    test_db_path = opt.test_db_path
+    st = clock()
+    db.open(test_db_path, wal=True, layout=opt.layout, staging=True)
+    db.allocate_results()
+    db.persist(method, indexes)
+    elapsed = since(st)
+    with db.phase("check"):
+        count = db.Result.select().count()
+    db.close()
+    file_size = os.path.getsize(test_db_path)
+    print(f"Inserted {count} results in {elapsed}, file size {file_size} bytes")
+
+    return elapsed, {"file_size": file_size}
+
+def time_rst_inst_staged_backup(opt = InstOption()):
+    return __time_rst_inst_staged(opt, 'backup', indexes=True)
+
+def time_rst_inst_staged_vacuum(opt = InstOption()):
+    return __time_rst_inst_staged(opt, 'vacuum', indexes=True)
+
+def time_rst_inst_staged_backup_disk_idx(opt = InstOption()):
+    """Indexes are built on the file after the backup."""
+    return __time_rst_inst_staged(opt, 'backup', indexes=False)
+
+
+## Attachment Insertion Bench
+def time_attachment_inst_bulk(opt = InstOption()):
+    sample_count = opt.sample_count
+    test_db_path = opt.test_db_path
+
+    if os.path.exists(test_db_path):
+        os.remove(test_db_path)
+
+    db.open(test_db_path, wal=True)
+    st = clock()
+    attachments = (
+        (f"key-{i}", str(i))
+        for i in range(sample_count)
+    )
+    db.bulk_insert(db.Attachment, attachments, on_conflict='replace')
+    elapsed = since(st)
+    with db.phase("check"):
+        count = db.Attachment.select().count()
+    db.close()
+    print(f"Inserted {count} attachments in {elapsed}")
+
+    return elapsed
+
 
 ## Benchmarking
 from utils import bench
@@ -367,8 +698,10 @@ def bench_sample_inst():
         time_sample_inst_1b1_tsc,
         time_sample_inst_1b1_wal,
         time_sample_inst_1b1_wal_tsc,
+        time_sample_inst_1b1_compiled_wal_tsc,
         time_sample_inst_blk,
-        time_sample_inst_wal_blkjson
+        time_sample_inst_wal_blkjson,
+        time_sample_inst_bulk,
     ]
 
     opt_list = [
@@ -379,6 +712,26 @@ def bench_sample_inst():
     bench("Sample Insertion", funcs, opt_list, timeout=3, repeat=5)
 
 
+def bench_sample_resolve():
+    funcs = [
+        time_sample_resolve_1b1,
+        time_sample_resolve_bulk,
+        time_sample_resolve_warm,
+    ]
+
+    opt_list = [
+        InstOption(sample_count=10**n, new_frac=frac)
+        for frac in [0.0, 0.1, 0.5, 1.0]
+        for n in range(3, 7)
+    ]
+
+    bench(
+        "Sample Path Resolution", funcs, opt_list,
+        timeout=30, repeat=5,
+        hint=lambda x: f"sample_count = {x.sample_count}, new_frac = {x.new_frac}"
+    )
+
+
 def bench_rst_inst_slow():
     funcs = [
         time_rst_inst_1b1,
@@ -398,8 +751,12 @@ def bench_rst_inst_fast():
     funcs = [
         time_rst_gen,
         time_rst_inst_1b1_wal_tsc,
+        time_rst_inst_1b1_compiled_wal_tsc,
+        time_rst_inst_1b1_bare_wal_tsc,
         time_rst_inst_blk,
-        time_rst_inst_blkjson
+        time_rst_inst_blkjson,
+        time_rst_inst_bulk,
+        time_rst_inst_stream,
     ]
 
     opt_list = [
@@ -414,7 +771,9 @@ def bench_rst_inst_sql():
     funcs = [
         # time_rst_gen,
         time_rst_inst_sql,
-        time_rst_inst_sql_wal
+        time_rst_inst_sql_wal,
+        time_rst_inst_stream,
+        time_rst_inst_stream_wal,
     ]
 
     opt_list = [
@@ -428,5 +787,134 @@ def bench_rst_inst_sql():
     bench("Result Insertion SQL", funcs, opt_list, timeout=10, repeat=5)
 
 
+LAYOUT_CHECKS = [
+    lambda: db.bulk_insert(db.Result, [(1, 2, 1.0), (2, 4, 2.0)]),
+    lambda: db.bulk_insert(db.Result, [(5, 3, 9.0)], on_conflict='update'),
+    lambda: db.bulk_insert(db.Result, [(4, 4, 9.0)]),
+    lambda: db.bulk_insert(
+        db.Result, [{"a": 4, "b": 2, "val": 9.0}], on_conflict='replace'
+    ),
+    lambda: db.bulk_insert(
+        db.Result, [(3, 1, 9.0), (1, 3, 3.0)], on_conflict='ignore'
+    ),
+    lambda: db.stream_insert(db.Result, [(1, 5, 5.0), (5, 1, 9.0)]),
+    lambda: db.stream_insert(
+        db.Result, [(5, 1, 9.0), (1, 5, 5.0)], on_conflict='ignore'
+    ),
+    lambda: db.create_row(db.Result, 4, 4, 1.0),
+    lambda: db.create_row(db.Result, 5, 3, 1.0),
+    lambda: db.update_row(db.Result, 9.0, 5, 3),
+    lambda: db.update_row(db.Result, 9.0, 3, 3),
+    lambda: db.get_by_pk(db.Result, 5, 3),
+    lambda: db.get_by_pk(db.Result, 4, 4),
+    lambda: db.get_by_pk(db.Result, 2, 4),
+]
+
+def __check_layouts(test_db_path="bench-layout-check.db"):
+    """
+    Every layout must answer LAYOUT_CHECKS, valid or not, like the pair
+    layout: same row counts, same errors, same rows left in the end.
+    """
+    outcomes = {}
+    for layout in db.LAYOUTS:
+        if os.path.exists(test_db_path):
+            os.remove(test_db_path)
+        db.open(test_db_path, layout=layout)
+        db.bulk_insert(db.Sample, ((f"/tmp/check-{i}",) for i in range(5)))
+        runs = []
+        for check in LAYOUT_CHECKS:
+            try:
+                runs.append(check())
+            except (peewee.IntegrityError, sqlite3.IntegrityError) as e:
+                runs.append(str(e))
+        runs.append(sorted(db.Result.select().tuples()))
+        db.close()
+        outcomes[layout] = runs
+    os.remove(test_db_path)
+
+    failures = [
+        (layout, i, got, want)
+        for layout, runs in outcomes.items()
+        for i, (got, want) in enumerate(zip(runs, outcomes["pair"]))
+        if got != want
+    ]
+    for layout, i, got, want in failures:
+        print(f"- {layout}, check {i}: {got!r}, pair layout: {want!r}")
+    if failures:
+        raise AssertionError(f"Layouts disagree in {len(failures)} checks")
+
+
+def bench_rst_inst_layout():
+    __check_layouts()
+
+    funcs = [
+        time_rst_inst_alloc,
+    ]
+
+    # 10^5 to 10^7 results
+    opt_list = [
+        InstOption(sample_count=n, layout=layout)
+        for layout in ["pair", "tri", "tri_without_rowid"]
+        for n in [448, 1000, 1415, 2000, 3163, 4473]
+    ]
+
+    bench(
+        "Result Insertion Layout", funcs, opt_list, timeout=60, repeat=3,
+        hint=lambda x: f"sample_count = {x.sample_count}, layout = {x.layout}"
+    )
+
+
+def bench_rst_inst_staged():
+    funcs = [
+        time_rst_inst_alloc,
+        time_rst_inst_staged_backup,
+        time_rst_inst_staged_vacuum,
+        time_rst_inst_staged_backup_disk_idx,
+    ]
+
+    opt_list = [
+        InstOption(sample_count=n)
+        for n in range(1000, 10001, 1000)
+    ]
+
+    bench("Result Insertion Staged", funcs, opt_list, timeout=120, repeat=3)
+
+
+def bench_rst_inst_incremental():
+    funcs = [
+        time_rst_inst_alloc_new,
+    ]
+
+    opt_list = [
+        InstOption(sample_count=n, new_count=k, layout=layout)
+        for layout in ["pair", "tri"]
+        for n in [1000, 2000, 4000]
+        for k in [10, 100, 1000]
+    ]
+
+    bench(
+        "Result Incremental Allocation", funcs, opt_list,
+        timeout=60, repeat=3,
+        hint=lambda x: (
+            f"layout = {x.layout}, sample_count = {x.sample_count}, "
+            f"new_count = {x.new_count}"
+        )
+    )
+
+
+def bench_bulk_inst():
+    funcs = [
+        time_sample_inst_bulk,
+        time_attachment_inst_bulk,
+    ]
+
+    opt_list = [
+        InstOption(sample_count=10**n)
+        for n in range(2, 6)
+    ]
+
+    bench("Bulk Insertion", funcs, opt_list, timeout=3, repeat=5)
+
+
 if __name__ == "__main__":
     bench_rst_inst_sql()
\ No newline at end of file
@@ -0,0 +1,269 @@
+"""
+Dense distance-matrix backend.
+
+The upper triangle of ``Result.val`` is kept as a packed float64 array in a
+memory-mapped file next to the SQLite database (``<db path>.tri``), so pair
+lookups, id-set submatrices and the pending mask become NumPy operations.
+``Sample`` and ``Attachment`` stay in SQLite, and SQLite remains the source
+of truth.
+
+Crash consistency: every write goes to SQLite first. A write sets the dirty
+flag in the file header and syncs it before touching the file. It then
+commits the new values together with a bumped generation number
+(``Attachment`` key ``matrix_generation``, starting from a random number),
+writes and syncs the values, and finally syncs a clean header carrying the
+new generation. On open, a dirty header, a generation mismatch or a changed
+sample list triggers a rebuild from SQLite, so a crash at any point costs at
+most one rebuild.
+The write functions of ``db`` (``bulk_insert``, ``stream_insert``,
+``update_row``, ``ResultSink``, ``claim_batch``...) bump the generation in
+their own transaction too, so the next open rebuilds; an open matrix, or
+raw SQL writes, need ``refresh``. ``allocate_results`` only appends pairs
+of new samples, which the next open picks up without a rebuild.
+"""
+import os
+import os.path
+import struct
+import zlib
+import numpy as np
+import db
+
+MAGIC = b"TRIMAT01"
+# magic, dirty, n, generation, crc32 of the sample ids
+HEADER = struct.Struct("<8sQQQQ")
+HEADER_SIZE = 64 # keeps the values 64-byte aligned
+GEN_KEY = db.MATRIX_GENERATION_KEY
+
+def tri_size(n):
+    return n * (n - 1) // 2
+
+def tri_index(i, j):
+    """Packed index of offsets i < j (0-based), vectorized."""
+    return j * (j - 1) // 2 + i
+
+def _ids_crc(ids):
+    return zlib.crc32(np.ascontiguousarray(ids, dtype="<i8").tobytes())
+
+
+class DistanceMatrix:
+    def __init__(self, path):
+        self.path = path
+        self.ids = None    # sample ids, the offset of an id is its position
+        self.vals = None   # packed upper triangle
+        self.generation = 0
+        self._header = None
+        self._dense = False # ids == 1..n, offsets are id - 1
+
+    @classmethod
+    def open(cls, path=None):
+        """
+        Open (and if needed build) the matrix of the database currently open
+        through ``db.open``. ``path`` defaults to ``<db path>.tri``.
+        """
+        if path is None:
+            path = db.conn.database + ".tri"
+        m = cls(path)
+        m._load()
+        return m
+
+    def close(self):
+        if self.vals is not None:
+            self.vals.flush()
+            self._header.flush()
+        self.vals = self._header = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    ## File handling
+    def _read_ids(self):
+        cur = db.conn.execute_sql("SELECT id FROM sample ORDER BY id;")
+        return np.fromiter((r[0] for r in cur), dtype=np.int64)
+
+    def _db_generation(self):
+        # Start at a random number so that a recreated database never
+        # matches a stale matrix file
+        row = db.Attachment.get_or_none(db.Attachment.key == GEN_KEY)
+        if row is None:
+            gen = int.from_bytes(os.urandom(6), "little")
+            db.Attachment.insert(key=GEN_KEY, val=str(gen)).execute()
+            return gen
+        return int(row.val)
+
+    def _map(self, n):
+        size = HEADER_SIZE + 8 * tri_size(n)
+        if not os.path.exists(self.path) or os.path.getsize(self.path) != size:
+            with open(self.path, "ab") as f:
+                f.truncate(size)
+        self._header = np.memmap(self.path, dtype=np.uint8, mode="r+",
+                                 shape=(HEADER_SIZE,))
+        self.vals = np.memmap(self.path, dtype="<f8", mode="r+",
+                              offset=HEADER_SIZE, shape=(tri_size(n),))
+
+    def _read_header(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < HEADER_SIZE:
+            return None
+        with open(self.path, "rb") as f:
+            magic, dirty, n, gen, crc = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            return None
+        return dirty, n, gen, crc
+
+    def _write_header(self, dirty):
+        HEADER.pack_into(
+            self._header, 0, MAGIC, int(dirty), len(self.ids),
+            self.generation, _ids_crc(self.ids)
+        )
+        self._header.flush()
+
+    def _set_ids(self, ids):
+        self.ids = ids
+        n = len(ids)
+        self._dense = bool(n == 0 or (ids[0] == 1 and ids[-1] == n))
+
+    def _load(self):
+        ids = self._read_ids()
+        db_gen = self._db_generation()
+        header = self._read_header()
+
+        if header is not None:
+            dirty, n, gen, crc = header
+            clean = not dirty and gen == db_gen and n <= len(ids)
+            if clean and crc == _ids_crc(ids[:n]):
+                # Same samples, possibly more appended after them: new ids
+                # only add pairs at the end of the packed array.
+                self.generation = gen
+                self._set_ids(ids[:n])
+                self._map(n)
+                if n < len(ids):
+                    self._grow(ids)
+                return
+
+        self.generation = db_gen
+        self._set_ids(ids)
+        self._map(len(ids))
+        self.rebuild()
+
+    def _grow(self, ids):
+        old = len(self.ids)
+        self._write_header(dirty=True)
+        self.vals = self._header = None
+        self._set_ids(ids)
+        self._map(len(ids))
+        self.vals[tri_size(old):] = db.PENDING
+        self._fill(min_b=ids[old])
+
+    def _fill(self, min_b=None):
+        """Copy values from SQLite for pairs whose b_id >= min_b."""
+        if db.result_layout == "pair":
+            SQL = "SELECT a_id, b_id, val FROM result"
+            if min_b is not None:
+                SQL += f" WHERE b_id >= {int(min_b)}"
+            rows = np.fromiter(
+                db.conn.execute_sql(SQL),
+                dtype=[("a", "<i8"), ("b", "<i8"), ("val", "<f8")]
+            )
+            a, b, val = rows["a"], rows["b"], rows["val"]
+        else:
+            SQL = "SELECT k, val FROM result_tri"
+            if min_b is not None:
+                SQL += f" WHERE k > {int(db.tri_key(0, min_b))}"
+            rows = np.fromiter(
+                db.conn.execute_sql(SQL),
+                dtype=[("k", "<i8"), ("val", "<f8")]
+            )
+            k, val = rows["k"], rows["val"]
+            b = ((1 + np.sqrt(8 * k - 7)) // 2).astype(np.int64)
+            a = k - b * (b - 1) // 2
+
+        keep = np.isin(a, self.ids) & np.isin(b, self.ids)
+        self.vals[self._index(a[keep], b[keep])] = val[keep]
+        self.vals.flush()
+        self._write_header(dirty=False)
+
+    def rebuild(self):
+        """Reload every value from SQLite."""
+        self._write_header(dirty=True)
+        self.vals[:] = db.PENDING
+        self._fill()
+
+    def refresh(self):
+        """Pick up writes made to SQLite behind this module's back."""
+        self.generation = self._db_generation()
+        self.rebuild()
+
+    ## Lookups
+    def offsets(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        if self._dense:
+            off = ids - 1
+            bad = (off < 0) | (off >= len(self.ids))
+        else:
+            off = np.searchsorted(self.ids, ids)
+            off[off >= len(self.ids)] = 0
+            bad = self.ids[off] != ids
+        if np.any(bad):
+            raise KeyError(f"Unknown sample ids: {ids[bad][:10].tolist()}")
+        return off
+
+    def _index(self, a, b):
+        i, j = self.offsets(a), self.offsets(b)
+        if np.any(i == j):
+            raise ValueError("Pairs must have distinct ids")
+        return tri_index(np.minimum(i, j), np.maximum(i, j))
+
+    def get(self, a, b):
+        """Values of pairs (a[i], b[i]), ids in any order."""
+        return self.vals[self._index(a, b)]
+
+    def submatrix(self, ids1, ids2=None, diag=0.0):
+        """
+        Dense ``len(ids1) x len(ids2)`` block of distances, ``ids2``
+        defaulting to ``ids1``. Entries pairing an id with itself get
+        ``diag``.
+        """
+        i = self.offsets(ids1)[:, None]
+        j = i.T if ids2 is None else self.offsets(ids2)[None, :]
+        lo, hi = np.minimum(i, j), np.maximum(i, j)
+        same = lo == hi
+        out = self.vals[np.where(same, 0, tri_index(lo, hi))]
+        out[same] = diag
+        return out
+
+    def uncomputed(self):
+        """(a, b) id arrays of all PENDING pairs."""
+        idx = np.flatnonzero(self.vals == db.PENDING)
+        j = ((1 + np.sqrt(8 * idx + 1)) // 2).astype(np.int64)
+        i = idx - tri_index(0, j)
+        return self.ids[i], self.ids[j]
+
+    ## Writes
+    def set(self, a, b, val):
+        """Write values to SQLite and then to the matrix, see module doc."""
+        a = np.asarray(a, dtype=np.int64)
+        b = np.asarray(b, dtype=np.int64)
+        val = np.broadcast_to(np.asarray(val, dtype=np.float64), a.shape)
+        idx = self._index(a, b)
+        lo, hi = np.minimum(a, b), np.maximum(a, b)
+
+        self._write_header(dirty=True)
+        with db.conn.atomic():
+            db_gen = self._db_generation()
+            db.bulk_insert(
+                db.Result, zip(lo.tolist(), hi.tolist(), val.tolist()),
+                on_conflict='update'
+            )
+            generation = db_gen + 1
+            db.Attachment.replace(key=GEN_KEY, val=str(generation)).execute()
+        if db_gen != self.generation:
+            # results were written elsewhere since the matrix was loaded
+            self.generation = generation
+            self.rebuild()
+            return
+        self.vals[idx] = val
+        self.vals.flush()
+        self.generation = generation
+        self._write_header(dirty=False)
@@ -0,0 +1,128 @@
+from typing import Optional
+import pydantic
+import db
+import insert_bench
+import query_bench
+
+class PragmaOption(pydantic.BaseModel):
+    sample_count: int = 1000
+    test_db_path: str = "bench-pragma.db"
+    qry_db_path: str = "bench-pragma-query.db"
+
+    wal: bool = True
+    profile: Optional[str] = None # see db.PROFILES, None = SQLite defaults
+    pragmas: dict = {}  # single pragmas set over the profile
+    qry_count: int = 10000
+    layout: str = "pair" # of the query database, see db.LAYOUTS
+
+
+def __inst_opt(opt: PragmaOption):
+    return insert_bench.InstOption(
+        sample_count=opt.sample_count, test_db_path=opt.test_db_path
+    )
+
+
+def __qry_opt(opt: PragmaOption):
+    # page_size only applies to a new database, so each gets its own
+    page_size = db.profile_pragmas(opt.profile, opt.pragmas).get("page_size")
+    return query_bench.QryOption(
+        sample_count=opt.sample_count, qry_count=opt.qry_count, wal=opt.wal,
+        layout=opt.layout, test_db_path=opt.qry_db_path,
+        bench_id=f"pragma-{opt.sample_count}-{opt.layout}-{page_size}",
+    )
+
+
+def __run(func, opt: PragmaOption, sub_opt):
+    """func(sub_opt) with every db.open tuned by opt; extra gets the pragmas."""
+    db.set_default_profile(opt.profile, opt.pragmas)
+    try:
+        rst = func(sub_opt)
+        db.open(sub_opt.test_db_path, wal=opt.wal)
+        pragmas = db.current_pragmas()
+        db.close()
+    finally:
+        db.set_default_profile()
+    elapsed, extra = rst if isinstance(rst, tuple) else (rst, {})
+    return elapsed, {**extra, "pragmas": pragmas}
+
+
+## Insertion
+def time_pragma_rst_inst_sql(opt = PragmaOption()):
+    func = insert_bench.time_rst_inst_sql_wal if opt.wal else insert_bench.time_rst_inst_sql
+    return __run(func, opt, __inst_opt(opt))
+
+def time_pragma_rst_inst_stream(opt = PragmaOption()):
+    func = insert_bench.time_rst_inst_stream_wal if opt.wal else insert_bench.time_rst_inst_stream
+    return __run(func, opt, __inst_opt(opt))
+
+
+## Query
+def time_pragma_qry_1b1(opt = PragmaOption()):
+    return __run(query_bench.time_qry_1b1, opt, __qry_opt(opt))
+
+def time_pragma_qry_json(opt = PragmaOption()):
+    return __run(query_bench.time_qry_get_results_json, opt, __qry_opt(opt))
+
+
+## Benchmark
+from utils import bench
+
+FUNCS = [
+    time_pragma_rst_inst_sql,
+    time_pragma_rst_inst_stream,
+    time_pragma_qry_1b1,
+    time_pragma_qry_json,
+]
+
+# One pragma at a time over SQLite's defaults, then the cache size against
+# the page size, the likely pair behind the drop of the SQL insert at
+# ~400k rows (sample_count ~900).
+SWEEP = [
+    {"synchronous": v} for v in ["off", "normal", "full"]
+] + [
+    {"mmap_size": v} for v in [0, 1 << 28, 1 << 30]
+] + [
+    {"temp_store": v} for v in ["default", "memory"]
+] + [
+    {"locking_mode": v} for v in ["normal", "exclusive"]
+] + [
+    {"cache_size": c, "page_size": p}
+    for c in [-2000, -65536, -1048576]
+    for p in [4096, 16384, 65536]
+]
+
+
+def bench_pragma_profiles():
+    opt_list = [
+        PragmaOption(sample_count=n, profile=profile, wal=wal)
+        for wal in [False, True]
+        for profile in [None] + list(db.PROFILES)
+        for n in [500, 900, 1500]
+    ]
+
+    bench(
+        "Pragma Profiles", FUNCS, opt_list,
+        timeout=120, repeat=3,
+        hint=lambda x: (
+            f"sample_count = {x.sample_count}, profile = {x.profile}, wal = {x.wal}"
+        )
+    )
+
+
+def bench_pragma_sweep():
+    opt_list = [
+        PragmaOption(sample_count=n, pragmas=pragmas)
+        for pragmas in SWEEP
+        for n in [500, 900, 1500]
+    ]
+
+    bench(
+        "Pragma Sweep", FUNCS, opt_list,
+        timeout=120, repeat=3,
+        hint=lambda x: f"sample_count = {x.sample_count}, pragmas = {x.pragmas}"
+    )
+
+
+if __name__ == "__main__":
+    bench_pragma_profiles()
+    bench_pragma_sweep()
@@ -1,13 +1,20 @@
-from datetime import datetime, timedelta
+from utils import clock, since
 import pydantic
 import db
 import os
 import os.path
 import json
+import glob
 import random
+import threading
+import asyncio
+import statistics
+import aiodb
+import tracemalloc
 from peewee import fn
-from functools import reduce
-from math import ceil
+from functools import reduce, lru_cache
+from itertools import accumulate
+from math import ceil, gcd, isqrt
 
 class QryOption(pydantic.BaseModel):
     sample_count: int = 1000
@@ -18,6 +25,22 @@ class QryOption(pydantic.BaseModel):
     
     bench_id: str = str(random.randint(0, 1000000))
     wal: bool = False
+    layout: str = "pair" # see db.LAYOUTS
+
+    shape: str = "random" # "random" pairs or all pairs of an "idset"
+    set_a: int = 100 # cross-set queries: |A|, |B| and |A & B| / |B|
+    set_b: int = 100
+    overlap: float = 0.0
+
+    threads: int = 1 # concurrent querying threads, each runs qry_count lookups
+    readers: int = 0 # size of db's reader pool, 0 = no pool
+    clients: int = 1 # concurrent asyncio clients, each runs qry_count lookups
+    workers: int = 0 # db.LookupPool processes, 0 = one per core
+
+    zipf_s: float = 1.0 # skew of "zipf" shaped queries
+    cache_size: int = 0 # pairs held by db's PairCache, 0 = no cache
+    batch: int = 100    # pairs per get_results call of the cache benchmark
+    calibrate: bool = False # fit the planner from data/*.json first
 
 
 def __prepare_db(opt: QryOption):
@@ -28,18 +51,19 @@ def __prepare_db(opt: QryOption):
             db.Attachment.select(db.Attachment.val)
             .where(db.Attachment.key == "bench_id").get_or_none()
         )
+        layout = db.result_layout
         db.close()
         if bench_id is None: bench_id = None
         else: bench_id = bench_id.val
         # print(f"(opt) {opt.bench_id} ?= {bench_id} (db)")
-        if bench_id != opt.bench_id:
+        if bench_id != opt.bench_id or layout != opt.layout:
             recreate = True
             os.remove(opt.test_db_path)
         else:
             recreate = False
     
     if recreate:
-        db.open(opt.test_db_path, wal=True)
+        db.open(opt.test_db_path, wal=True, layout=opt.layout)
         with db.conn.atomic():
             # insert Samples
             samples = []
@@ -57,6 +81,14 @@ def __prepare_db(opt: QryOption):
             FROM sample AS s1 JOIN sample AS s2
             ON s1.id < s2.id;
             """
+            if opt.layout != "pair":
+                SQL = """
+                INSERT INTO result_tri
+                SELECT s2.id * (s2.id - 1) / 2 + s1.id,
+                ABS(cast((RANDOM() % 1000) as float)) / 1000
+                FROM sample AS s2 CROSS JOIN sample AS s1
+                ON s1.id < s2.id;
+                """
             db.conn.execute_sql(SQL)
             count = db.Result.select().count()
             assert count == opt.sample_count * (opt.sample_count - 1) / 2
@@ -83,12 +115,48 @@ def __gen_qry_pair(opt: QryOption):
     return pairs
 
 
+@lru_cache(maxsize=4)
+def __zipf_table(n, s):
+    """Cumulative Zipf(s) weights of ranks 1..n, and a stride scattering them."""
+    cum = list(accumulate(1 / (r ** s) for r in range(1, n + 1)))
+    stride = 1000003
+    while gcd(stride, n) != 1:
+        stride += 2
+    return cum, stride
+
+def __gen_qry_zipf(opt: QryOption):
+    """
+    Sample qry_count (a, b) pairs with Zipf(zipf_s) skew: the r-th most
+    popular pair is drawn with probability proportional to 1 / r^zipf_s.
+    Popular pairs are scattered over the whole triangle, not clustered.
+    """
+    n = opt.sample_count * (opt.sample_count - 1) // 2
+    cum, stride = __zipf_table(n, opt.zipf_s)
+    pairs = []
+    for r in random.choices(range(n), cum_weights=cum, k=opt.qry_count):
+        idx = r * stride % n # packed upper triangle index, 0-based
+        j = (1 + isqrt(8 * idx + 1)) // 2
+        pairs.append((idx - j * (j - 1) // 2 + 1, j + 1))
+    return pairs
+
+
+def __gen_qry_idset(opt: QryOption):
+    """
+    RANDOMLY pick an id set whose strict upper triangle holds about qry_count
+    pairs.
+    """
+    qry_sz = opt.qry_count
+    idset_sz = ceil((1 + (1 + 8 * qry_sz) ** 0.5) / 2) # then idset_sz * (idset_sz - 1) / 2 ~ qry_sz
+    idset_sz = min(idset_sz, opt.sample_count)
+    return random.sample(range(1, opt.sample_count + 1), idset_sz)
+
+
 def time_qry_1b1(opt = QryOption()):
     __prepare_db(opt)
 
     qry_pairs = __gen_qry_pair(opt)
     db.open(opt.test_db_path, wal = opt.wal)
-    st = datetime.now()
+    st = clock()
 
     valmap = {}
     for a, b in qry_pairs:
@@ -98,7 +166,28 @@ def time_qry_1b1(opt = QryOption()):
         valmap[a] = valmap.get(a, {})
         valmap[a][b] = val
 
-    elapsed = datetime.now() - st
+    elapsed = since(st)
+    print(f"Donw in {elapsed}")
+
+    return elapsed
+
+
+def time_qry_1b1_compiled(opt = QryOption()):
+    __prepare_db(opt)
+
+    qry_pairs = __gen_qry_pair(opt)
+    db.open(opt.test_db_path, wal = opt.wal)
+    st = clock()
+
+    valmap = {}
+    for a, b in qry_pairs:
+        if a >= b:
+            raise ValueError(f"Invalid query pair: {a}, {b}")
+        val = db.get_by_pk(db.Result, a, b)[2]
+        valmap[a] = valmap.get(a, {})
+        valmap[a][b] = val
+
+    elapsed = since(st)
     print(f"Donw in {elapsed}")
 
     return elapsed
@@ -110,7 +199,7 @@ def time_qry_blkcnd(opt = QryOption()):
     qry_pairs = __gen_qry_pair(opt)
     db.open(opt.test_db_path, wal = opt.wal)
     
-    st = datetime.now()
+    st = clock()
     conditions = [
         (db.Result.a == a) & (db.Result.b == b)
         for a, b in qry_pairs
@@ -124,7 +213,7 @@ def time_qry_blkcnd(opt = QryOption()):
         valmap[a] = valmap.get(a, {})
         valmap[a][b] = r.val
     
-    elapsed = datetime.now() - st
+    elapsed = since(st)
     print(f"Donw in {elapsed}")
     return elapsed
 
@@ -141,7 +230,7 @@ def time_qry_blkjson(opt = QryOption()):
     WHERE r.a_id = (j.value ->> '$.a') AND r.b_id = (j.value ->> '$.b');
     """
 
-    st = datetime.now()
+    st = clock()
     ary_list = []
     for a, b in qry_pairs:
         ary_list.append({"a": a, "b": b})
@@ -151,7 +240,7 @@ def time_qry_blkjson(opt = QryOption()):
         valmap[a] = valmap.get(a, {})
         valmap[a][b] = val
     
-    elapsed = datetime.now() - st
+    elapsed = since(st)
     db.close()
     print(f"Donw in {elapsed}")
     return elapsed
@@ -184,28 +273,339 @@ def time_qry_idset(opt = QryOption()):
 
     db.open(opt.test_db_path, wal = opt.wal)
 
-    st = datetime.now()
+    st = clock()
     cur = db.conn.execute_sql(SQL, (json.dumps(idset), json.dumps(idset)))
     valmap = {}
     for a, b, val in cur:
         valmap[a] = valmap.get(b, {})
         valmap[a][b] = val
     
-    elapsed = datetime.now() - st
+    elapsed = since(st)
     db.close()
 
     print(f"Donw in {elapsed}")
     return elapsed
 
+def __gen_qry_shape(opt: QryOption):
+    """
+    Generate about qry_count pairs shaped as opt.shape: "random" pairs,
+    all pairs of an "idset" or "zipf" skewed pairs.
+    """
+    if opt.shape == "idset":
+        idset = __gen_qry_idset(opt)
+        return [(a, b) for a in idset for b in idset if a < b]
+    if opt.shape == "zipf":
+        return __gen_qry_zipf(opt)
+    return __gen_qry_pair(opt)
+
+def __time_get_results(opt: QryOption, method=None):
+    __prepare_db(opt)
+
+    qry_pairs = __gen_qry_shape(opt)
+    db.open(opt.test_db_path, wal = opt.wal)
+    if method is None and opt.calibrate:
+        db.set_cost_model(db.calibrate(glob.glob("data/*.json")))
+
+    st = clock()
+    valmap = db.get_results(qry_pairs, method)
+    elapsed = since(st)
+    db.close()
+
+    print(f"Donw in {elapsed}, {len(valmap)} results")
+    return elapsed
+
+def time_qry_get_results(opt = QryOption()):
+    return __time_get_results(opt)
+
+def time_qry_get_results_1b1(opt = QryOption()):
+    return __time_get_results(opt, '1b1')
+
+def time_qry_get_results_json(opt = QryOption()):
+    return __time_get_results(opt, 'json')
+
+def time_qry_get_results_idset(opt = QryOption()):
+    return __time_get_results(opt, 'idset')
+
+def time_qry_cache(opt = QryOption()):
+    """qry_count shaped lookups issued batch pairs per get_results call."""
+    __prepare_db(opt)
+
+    qry_pairs = __gen_qry_shape(opt)
+    db.open(opt.test_db_path, wal = opt.wal, cache_size = opt.cache_size)
+    found = 0
+    st = clock()
+    for i in range(0, len(qry_pairs), opt.batch):
+        found += len(db.get_results(qry_pairs[i:i + opt.batch]))
+    elapsed = since(st)
+    stats = db.cache.stats() if db.cache is not None else {}
+    db.close()
+
+    extra = {"rps": len(qry_pairs) / elapsed.total_seconds()}
+    if stats:
+        extra["hit_rate"] = stats["hits"] / (stats["hits"] + stats["misses"])
+        extra["evictions"] = stats["evictions"]
+    print(f"Donw in {elapsed}, {found} results, {extra['rps']:.1f} rows/s, "
+          f"cache {stats}")
+    return elapsed, extra
+
+def __time_matrix(opt: QryOption, fn):
+    from matrix import DistanceMatrix
+    __prepare_db(opt)
+
+    db.open(opt.test_db_path, wal = opt.wal)
+    mat = DistanceMatrix.open() # built or validated outside the timed region
+
+    st = clock()
+    count = fn(mat)
+    elapsed = since(st)
+    mat.close()
+    db.close()
+
+    print(f"Donw in {elapsed}, {count} results")
+    return elapsed
+
+def time_qry_matrix(opt = QryOption()):
+    a, b = zip(*__gen_qry_shape(opt))
+    def lookup(mat):
+        return len(mat.get(a, b))
+    return __time_matrix(opt, lookup)
+
+def time_qry_matrix_idset(opt = QryOption()):
+    idset = __gen_qry_idset(opt)
+    def lookup(mat):
+        return mat.submatrix(idset).size
+    return __time_matrix(opt, lookup)
+
+def __time_output(opt: QryOption, fn):
+    """
+    Time fn(), then run it once more under tracemalloc for its peak memory,
+    kept out of the timed run as tracing slows Python code down.
+    """
+    __prepare_db(opt)
+
+    db.open(opt.test_db_path, wal = opt.wal)
+    st = clock()
+    count = fn()
+    elapsed = since(st)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    db.close()
+
+    print(f"Donw in {elapsed}, {count} results, peak memory {peak} bytes")
+    return elapsed, {"peak_mem": peak}
+
+def time_qry_out_dict(opt = QryOption()):
+    qry_pairs = __gen_qry_pair(opt)
+    return __time_output(opt, lambda: len(db.get_results(qry_pairs, 'json')))
+
+def time_qry_out_array(opt = QryOption()):
+    qry_pairs = __gen_qry_pair(opt)
+    return __time_output(
+        opt, lambda: len(db.get_results(qry_pairs, 'json', out='array')[2])
+    )
+
+def time_qry_submatrix_dict(opt = QryOption()):
+    idset = __gen_qry_idset(opt)
+    qry_pairs = [(a, b) for a in idset for b in idset if a < b]
+    return __time_output(opt, lambda: len(db.get_results(qry_pairs, 'idset')))
+
+def time_qry_submatrix_array(opt = QryOption()):
+    idset = __gen_qry_idset(opt)
+    return __time_output(opt, lambda: db.get_submatrix(idset).size)
+
+def __gen_qry_sets(opt: QryOption):
+    """
+    RANDOMLY pick id sets A and B where a fraction overlap of B is drawn
+    from A.
+    """
+    ids = list(range(1, opt.sample_count + 1))
+    random.shuffle(ids)
+    set_a = ids[:opt.set_a]
+    n_both = min(round(opt.set_b * opt.overlap), opt.set_a)
+    set_b = set_a[:n_both] + ids[opt.set_a:opt.set_a + opt.set_b - n_both]
+    return set_a, set_b
+
+def time_qry_cross_cte(opt = QryOption()):
+    """The DISTINCT CTE of time_qry_idset, fed with two different sets"""
+    import numpy as np
+    __prepare_db(opt)
+
+    set_a, set_b = __gen_qry_sets(opt)
+    SQL = """
+    WITH pair AS (
+        SELECT DISTINCT
+        CASE
+            WHEN s1.value < s2.value THEN s1.value
+            ELSE s2.value
+        END as aid,
+        CASE
+            WHEN s1.value < s2.value THEN s2.value
+            ELSE s1.value
+        END as bid
+        FROM json_each(?) as s1, json_each(?) as s2
+        WHERE s1.value <> s2.value
+    )
+    SELECT aid, bid, r.val
+    FROM pair
+    JOIN result AS r
+    ON r.a_id = pair.aid AND r.b_id = pair.bid;
+    """
+
+    db.open(opt.test_db_path, wal = opt.wal)
+    st = clock()
+    cur = db.conn.execute_sql(SQL, (json.dumps(set_a), json.dumps(set_b)))
+    rst = np.fromiter(cur, dtype=db.RESULT_DTYPE)
+    elapsed = since(st)
+    db.close()
+
+    print(f"Donw in {elapsed}, {len(rst)} results")
+    return elapsed, {"rows": len(set_a) * len(set_b)}
+
+def time_qry_cross(opt = QryOption()):
+    __prepare_db(opt)
+
+    set_a, set_b = __gen_qry_sets(opt)
+    db.open(opt.test_db_path, wal = opt.wal)
+    st = clock()
+    _, _, val = db.get_cross(set_a, set_b, out='array')
+    elapsed = since(st)
+    db.close()
+
+    print(f"Donw in {elapsed}, {len(val)} results")
+    return elapsed, {"rows": len(set_a) * len(set_b)}
+
+def time_qry_threads(opt = QryOption()):
+    __prepare_db(opt)
+
+    batches = [__gen_qry_pair(opt) for _ in range(opt.threads)]
+    db.open(opt.test_db_path, wal = opt.wal, readers = opt.readers)
+    counts = [0] * opt.threads
+    errors = []
+    def work(idx):
+        try:
+            counts[idx] = len(db.get_results(batches[idx], 'json'))
+        except Exception as e: # e.g. a single-connection database
+            errors.append(e)
+        finally:
+            if not opt.readers and not db.conn.is_closed():
+                db.conn.close() # peewee opened one connection per thread
+
+    threads = [
+        threading.Thread(target=work, args=(i,))
+        for i in range(opt.threads)
+    ]
+    st = clock()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = since(st)
+    db.close()
+    if errors:
+        raise errors[0]
+
+    rows = opt.threads * opt.qry_count
+    print(f"Donw in {elapsed}, {sum(counts)} results, "
+          f"{rows / elapsed.total_seconds():.1f} rows/s")
+    return elapsed, {"rows": rows}
+
+
+async def __loop_lag(stop, lags, interval=0.001):
+    """Record how late the event loop wakes up a sleeping task."""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        st = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - st - interval)
+
+async def __run_clients(opt: QryOption, lookup):
+    pairs = [__gen_qry_pair(opt) for _ in range(opt.clients)]
+    async def client(idx):
+        found = 0
+        for a, b in pairs[idx]:
+            found += await lookup(a, b) is not None
+        return found
+
+    stop, lags = asyncio.Event(), []
+    monitor = asyncio.create_task(__loop_lag(stop, lags))
+    await asyncio.sleep(0)
+    st = clock()
+    found = await asyncio.gather(*(client(i) for i in range(opt.clients)))
+    elapsed = since(st)
+    stop.set()
+    await monitor
+
+    rows = opt.clients * opt.qry_count
+    lags.sort()
+    extra = {
+        "rows": rows,
+        "rps": rows / elapsed.total_seconds(),
+        "lag_p50": statistics.median(lags) if lags else None,
+        "lag_max": lags[-1] if lags else None,
+    }
+    print(f"Donw in {elapsed}, {sum(found)} results, {extra['rps']:.1f} rows/s, "
+          f"loop lag p50 {extra['lag_p50']} s, max {extra['lag_max']} s")
+    return elapsed, extra
+
+def time_qry_parallel(opt = QryOption()):
+    __prepare_db(opt)
+
+    qry_pairs = __gen_qry_pair(opt)
+    db.open(opt.test_db_path, wal = opt.wal)
+    with db.LookupPool(opt.workers or None) as pool:
+        pool.get_results(qry_pairs[:10]) # the pool is warm in a server
+        st = clock()
+        a, b, val = pool.get_results(qry_pairs)
+        elapsed = since(st)
+    db.close()
+
+    print(f"Donw in {elapsed}, {len(val)} results, "
+          f"{len(val) / elapsed.total_seconds():.1f} rows/s")
+    return elapsed
+
+def time_qry_async_sync(opt = QryOption()):
+    """Baseline: coroutines calling the blocking API directly."""
+    __prepare_db(opt)
+
+    async def main():
+        db.open(opt.test_db_path, wal = opt.wal)
+        async def lookup(a, b):
+            await asyncio.sleep(0) # a handler awaits something between requests
+            return db.get_results([(a, b)], '1b1').get((a, b))
+        try:
+            return await __run_clients(opt, lookup)
+        finally:
+            db.close()
+    return asyncio.run(main())
+
+def time_qry_async(opt = QryOption()):
+    __prepare_db(opt)
+
+    async def main():
+        adb = await aiodb.AsyncDB.open(
+            opt.test_db_path, wal = opt.wal, readers = opt.readers
+        )
+        try:
+            return await __run_clients(opt, adb.get)
+        finally:
+            await adb.close()
+    return asyncio.run(main())
+
 
 ## Benchmark
 from utils import bench
 def bench_qry():
     funcs = [
         time_qry_1b1,
+        time_qry_1b1_compiled,
         # time_qry_blkcnd,
         time_qry_blkjson,
         time_qry_idset,
+        time_qry_get_results,
+        time_qry_parallel,
     ]
 
     bench_id = str(random.randint(0, 1000000))
@@ -227,6 +627,274 @@ def bench_qry():
     )
 
 
+def bench_qry_parallel():
+    funcs = [
+        time_qry_blkjson,
+        time_qry_parallel,
+    ]
+
+    bench_id = str(random.randint(0, 1000000))
+    __prepare_db(QryOption(bench_id=bench_id, sample_count=2200))
+
+    cores = os.cpu_count()
+    opt_list = [
+        QryOption(bench_id=bench_id,
+                  sample_count=2200,
+                  qry_count=n,
+                  workers=w,
+                  wal=True)
+        for w in sorted({1, 2, 4, 8, cores} & set(range(1, cores + 1)))
+        for n in [10000, 100000, 1000000]
+    ]
+
+    bench(
+        "Result Query Parallel (WAL)", funcs, opt_list,
+        timeout=60, repeat=5,
+        hint=lambda x: f"workers = {x.workers}, qry_count = {x.qry_count}"
+    )
+
+
+def bench_qry_layout():
+    funcs = [
+        time_qry_get_results_1b1,
+        time_qry_get_results_json,
+        time_qry_get_results_idset,
+    ]
+
+    opt_list = []
+    for layout in ["pair", "tri", "tri_without_rowid"]:
+        bench_id = str(random.randint(0, 1000000))
+        __prepare_db(QryOption(bench_id=bench_id, layout=layout,
+                               sample_count=2000))
+        opt_list += [
+            QryOption(bench_id=bench_id,
+                      layout=layout,
+                      sample_count=2000,
+                      qry_count=n,
+                      shape=shape,
+                      wal=True)
+            for shape in ["random", "idset"]
+            for n in [100, 1000, 10000]
+        ]
+
+    bench(
+        "Result Query Layout", funcs, opt_list,
+        timeout=5, repeat=5,
+        hint=lambda x: (
+            f"layout = {x.layout}, shape = {x.shape}, qry_count = {x.qry_count}"
+        )
+    )
+
+
+def bench_qry_matrix():
+    funcs = [
+        time_qry_get_results_json,
+        time_qry_get_results_idset,
+        time_qry_matrix,
+        time_qry_matrix_idset,
+    ]
+
+    bench_id = str(random.randint(0, 1000000))
+    __prepare_db(QryOption(bench_id=bench_id, sample_count=2200))
+
+    opt_list = [
+        QryOption(bench_id=bench_id,
+                  sample_count=2200,
+                  qry_count=n,
+                  shape="idset",
+                  wal=True)
+        for n in [100, 1000, 10000, 100000, 1000000]
+    ]
+
+    bench(
+        "Result Query Matrix (WAL)", funcs, opt_list,
+        timeout=10, repeat=5, hint=lambda x: f"qry_count = {x.qry_count}"
+    )
+
+
+def bench_qry_output():
+    funcs = [
+        time_qry_out_dict,
+        time_qry_out_array,
+        time_qry_submatrix_dict,
+        time_qry_submatrix_array,
+    ]
+
+    bench_id = str(random.randint(0, 1000000))
+    __prepare_db(QryOption(bench_id=bench_id, sample_count=2200))
+
+    opt_list = [
+        QryOption(bench_id=bench_id,
+                  sample_count=2200,
+                  qry_count=n,
+                  wal=True)
+        for n in [100, 1000, 10000, 100000, 1000000]
+    ]
+
+    bench(
+        "Result Query Output (WAL)", funcs, opt_list,
+        timeout=20, repeat=5, hint=lambda x: f"qry_count = {x.qry_count}"
+    )
+
+
+def bench_qry_cross():
+    funcs = [
+        time_qry_cross_cte,
+        time_qry_cross,
+    ]
+
+    bench_id = str(random.randint(0, 1000000))
+    __prepare_db(QryOption(bench_id=bench_id, sample_count=5000))
+
+    opt_list = [
+        QryOption(bench_id=bench_id,
+                  sample_count=5000,
+                  set_a=a, set_b=b, overlap=overlap,
+                  wal=True)
+        for a, b in [(100, 100), (100, 2000), (1000, 1000), (2000, 2000)]
+        for overlap in [0.0, 0.5, 1.0]
+    ]
+
+    bench(
+        "Result Query Cross Set (WAL)", funcs, opt_list,
+        timeout=20, repeat=5,
+        hint=lambda x: f"|A| = {x.set_a}, |B| = {x.set_b}, overlap = {x.overlap}"
+    )
+
+
+def bench_qry_threads():
+    funcs = [
+        time_qry_threads,
+    ]
+
+    bench_id = str(random.randint(0, 1000000))
+    __prepare_db(QryOption(bench_id=bench_id, sample_count=2200))
+
+    cores = os.cpu_count()
+    opt_list = [
+        QryOption(bench_id=bench_id,
+                  sample_count=2200,
+                  qry_count=10000,
+                  threads=n,
+                  readers=readers,
+                  wal=True)
+        for readers in [0, cores]
+        for n in sorted({1, 2, 4, 8, cores} & set(range(1, cores + 1)))
+    ]
+
+    bench(
+        "Result Query Threads (WAL)", funcs, opt_list,
+        timeout=20, repeat=5,
+        hint=lambda x: f"threads = {x.threads}, readers = {x.readers}"
+    )
+
+
+def bench_qry_async():
+    funcs = [
+        time_qry_async_sync,
+        time_qry_async,
+    ]
+
+    bench_id = str(random.randint(0, 1000000))
+    __prepare_db(QryOption(bench_id=bench_id))
+
+    opt_list = [
+        QryOption(bench_id=bench_id,
+                  qry_count=10000 // n,
+                  clients=n,
+                  wal=True)
+        for n in [1, 10, 100, 1000]
+    ]
+
+    bench(
+        "Result Query asyncio (WAL)", funcs, opt_list,
+        timeout=30, repeat=5,
+        hint=lambda x: f"clients = {x.clients}, qry_count = {x.qry_count}"
+    )
+
+
+def bench_qry_cache():
+    funcs = [
+        time_qry_cache,
+    ]
+
+    bench_id = str(random.randint(0, 1000000))
+    __prepare_db(QryOption(bench_id=bench_id))
+
+    opt_list = [
+        QryOption(bench_id=bench_id,
+                  qry_count=100000,
+                  shape=shape,
+                  zipf_s=s,
+                  cache_size=size,
+                  wal=True)
+        for shape, s in [("random", 0), ("zipf", 0.8), ("zipf", 1.2)]
+        for size in [0, 1000, 10000, 100000]
+    ]
+
+    bench(
+        "Result Query Pair Cache (WAL)", funcs, opt_list,
+        timeout=30, repeat=5,
+        hint=lambda x: (
+            f"shape = {x.shape}, zipf_s = {x.zipf_s}, cache_size = {x.cache_size}"
+        )
+    )
+
+
+def __check_planner(records, margin=0.2, slack=2e-3):
+    """
+    The planner may not be slower than the best fixed method by more than
+    ``margin`` (relative) plus ``slack`` seconds for timer noise at tiny scales.
+    """
+    digest = records["digest"]
+    fixed = [fn for fn in digest if fn != "time_qry_get_results"]
+    failures = []
+    for opt_idx, opt in enumerate(records["options"]):
+        times = [digest[fn][opt_idx] for fn in fixed]
+        times = [t for t in times if t is not None and t > 0]
+        planned = digest["time_qry_get_results"][opt_idx]
+        if not times or planned is None:
+            continue
+        best = min(times)
+        ok = planned <= best * (1 + margin) + slack
+        print(
+            f"- {opt['shape']}, qry_count = {opt['qry_count']}: "
+            f"planner {planned:.4f} s, best fixed {best:.4f} s"
+            f"{'' if ok else ' REGRESSION'}"
+        )
+        if not ok:
+            failures.append(opt)
+    if failures:
+        raise AssertionError(f"Planner lost to a fixed method in {len(failures)} cases")
+
+def bench_planner():
+    funcs = [
+        time_qry_get_results_1b1,
+        time_qry_get_results_json,
+        time_qry_get_results_idset,
+        time_qry_get_results,
+    ]
+
+    bench_id = str(random.randint(0, 1000000))
+    __prepare_db(QryOption(bench_id=bench_id))
+
+    opt_list = [
+        QryOption(bench_id=bench_id,
+                  qry_count=n,
+                  shape=shape,
+                  calibrate=True,
+                  wal=True)
+        for shape in ["random", "idset"]
+        for n in [1, 5, 20, 100, 1000, 10000]
+    ]
+
+    records = bench(
+        "Result Query Planner", funcs, opt_list,
+        timeout=5, repeat=5,
+        hint=lambda x: f"shape = {x.shape}, qry_count = {x.qry_count}"
+    )
+    __check_planner(records)
+
+
 if __name__ == "__main__":
     bench_qry()
-
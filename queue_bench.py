@@ -0,0 +1,193 @@
+from utils import clock, since
+import multiprocessing as mp
+import pydantic
+import queue
+import db
+import os
+import os.path
+import time
+
+class QueueOption(pydantic.BaseModel):
+    sample_count: int = 1000
+    sample_path_fmt: str = "/tmp/sample-{}"
+    test_db_path: str = "bench-queue.db"
+
+    workers: int = 4
+    batch_size: int = 100
+
+    report_count: int = 5000
+    arrival_rate: float = 0 # results/s reported by workers, 0 = as fast as possible
+    max_delay: float = 1.0  # durability window of the result sink
+
+
+def __prepare_db(opt: QueueOption):
+    if os.path.exists(opt.test_db_path):
+        os.remove(opt.test_db_path)
+
+    db.open(opt.test_db_path, wal=True)
+    db.bulk_insert(db.Sample, (
+        (opt.sample_path_fmt.format(i),)
+        for i in range(opt.sample_count)
+    ))
+    SQL = """
+    INSERT INTO result
+    SELECT s1.id, s2.id, -1
+    FROM sample AS s1 JOIN sample AS s2
+    ON s1.id < s2.id;
+    """
+    db.conn.execute_sql(SQL)
+    db.create_queue_index()
+    db.close()
+
+
+def __claim_worker(opt: QueueOption, worker_id: str, que):
+    db.open(opt.test_db_path, wal=True)
+    claimed = 0
+    while True:
+        pairs = db.claim_batch(worker_id, opt.batch_size)
+        if not pairs:
+            break
+        claimed += len(pairs)
+    db.close()
+    que.put(claimed)
+
+
+def __collect(que, procs, poll=1.0) -> list:
+    """
+    One value from every process in procs, through que. Raises if a process
+    fails, or all exit, before sending theirs.
+    """
+    got = []
+    try:
+        while len(got) < len(procs):
+            try:
+                got.append(que.get(timeout=poll))
+            except queue.Empty:
+                codes = [p.exitcode for p in procs]
+                if any(c not in (None, 0) for c in codes) or None not in codes:
+                    raise RuntimeError(f"Workers exited with codes {codes}")
+    except BaseException:
+        for p in procs:
+            p.kill()
+        raise
+    return got
+
+
+def time_claim_wal(opt = QueueOption()):
+    __prepare_db(opt)
+
+    que = mp.Queue()
+    procs = [
+        mp.Process(target=__claim_worker, args=(opt, f"worker-{i}", que))
+        for i in range(opt.workers)
+    ]
+
+    st = clock()
+    for p in procs:
+        p.start()
+    claimed = sum(__collect(que, procs))
+    for p in procs:
+        p.join()
+    elapsed = since(st)
+
+    expected = opt.sample_count * (opt.sample_count - 1) // 2
+    assert claimed == expected, f"claimed {claimed} of {expected} results"
+    print(f"Claimed {claimed} results in {elapsed}, "
+          f"{claimed / opt.batch_size / elapsed.total_seconds():.1f} claims/s")
+
+    return elapsed, {"rows": claimed}
+
+
+def __gen_report(opt: QueueOption):
+    """
+    Yield report_count (a, b, val) results paced at arrival_rate.
+    """
+    pairs = (
+        (a, b)
+        for b in range(2, opt.sample_count + 1)
+        for a in range(1, b)
+    )
+    st = time.perf_counter()
+    for i in range(opt.report_count):
+        if opt.arrival_rate:
+            delay = st + i / opt.arrival_rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        a, b = next(pairs)
+        yield a, b, i / opt.report_count
+
+
+def time_report_1b1_wal(opt = QueueOption()):
+    __prepare_db(opt)
+
+    db.open(opt.test_db_path, wal=True)
+    st = clock()
+    for a, b, val in __gen_report(opt):
+        db.Result.update(val=val).where(
+            (db.Result.a == a) & (db.Result.b == b)
+        ).execute()
+    elapsed = since(st)
+    count = db.Result.select().where(db.Result.val >= 0).count()
+    db.close()
+    print(f"Reported {count} results in {elapsed}")
+
+    return elapsed
+
+
+def time_report_sink_wal(opt = QueueOption()):
+    __prepare_db(opt)
+
+    db.open(opt.test_db_path, wal=True)
+    st = clock()
+    with db.ResultSink(max_delay=opt.max_delay) as sink:
+        for a, b, val in __gen_report(opt):
+            sink.put(a, b, val)
+    elapsed = since(st)
+    count = db.Result.select().where(db.Result.val >= 0).count()
+    db.close()
+    print(f"Reported {count} results in {elapsed}")
+
+    return elapsed
+
+
+## Benchmark
+from utils import bench
+
+def bench_claim():
+    funcs = [
+        time_claim_wal,
+    ]
+
+    opt_list = [
+        QueueOption(workers=w, batch_size=n)
+        for n in [10, 100, 1000]
+        for w in [1, 2, 4, 8, 16]
+    ]
+
+    bench(
+        "Job Queue Claim (WAL)", funcs, opt_list,
+        timeout=30, repeat=3,
+        hint=lambda x: f"workers = {x.workers}, batch_size = {x.batch_size}"
+    )
+
+
+def bench_report():
+    funcs = [
+        time_report_1b1_wal,
+        time_report_sink_wal,
+    ]
+
+    opt_list = [
+        QueueOption(arrival_rate=r)
+        for r in [500, 1000, 5000, 20000, 0]
+    ]
+
+    bench(
+        "Result Report (WAL)", funcs, opt_list,
+        timeout=60, repeat=3,
+        hint=lambda x: f"arrival_rate = {x.arrival_rate}"
+    )
+
+
+if __name__ == "__main__":
+    bench_claim()
@@ -0,0 +1,275 @@
+"""
+Sharded result storage.
+
+Results are split by ``a_id`` over several SQLite files next to the main
+database (``<db path>.shard<i>``), each holding a plain ``result`` table, so
+every shard has its own writer lock and a smaller b-tree. ``Sample`` and
+``Attachment`` stay in the main database, which also records the shard map.
+
+The shards are ATTACHed to ``db.conn`` as ``shard<i>``, and the temporary
+view ``result_all`` unions them for ad-hoc SQL. Bulk lookups and allocation
+are split by shard and run in a process pool, each process keeping one
+connection per shard.
+
+    db.open("results.db", wal=True)
+    sr = ShardedResults.create(shards=4)
+    sr.allocate()
+    vals = sr.get_results(pairs)
+    sr.close()
+
+"hash" sends ``a`` to shard ``a % shards``. "range" cuts ``[1, max sample
+id]`` into ranges holding the same number of pairs when the shards are
+created; later samples go to the last shard. SQLite attaches at most 10
+databases unless built with a larger SQLITE_MAX_ATTACHED, see
+``max_shards``.
+"""
+import json
+import os
+import os.path
+import sqlite3
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from peewee import fn
+import db
+
+MAP_KEY = "shard_map"
+WATERMARK_KEY = "shard_alloc_watermark"
+SCHEMES = ("hash", "range")
+
+SHARD_DDL = f"""
+CREATE TABLE IF NOT EXISTS result (
+    a_id INTEGER NOT NULL,
+    b_id INTEGER NOT NULL,
+    val REAL NOT NULL DEFAULT {float(db.PENDING)},
+    PRIMARY KEY (a_id, b_id),
+    CHECK (a_id < b_id)
+) WITHOUT ROWID;
+"""
+
+def range_bounds(max_id, shards):
+    """First a_id of each shard, balancing the pairs (a, b > a) per shard."""
+    total = max_id * (max_id - 1) // 2
+    bounds, acc = [0], 0
+    for a in range(1, max_id):
+        if len(bounds) == shards:
+            break
+        acc += max_id - a
+        if acc >= total * len(bounds) / shards:
+            bounds.append(a + 1)
+    while len(bounds) < shards: # fewer samples than shards
+        bounds.append(max(bounds[-1] + 1, max_id))
+    return bounds
+
+
+def max_shards() -> int:
+    """Shards ``db.conn`` can still ATTACH, per SQLITE_LIMIT_ATTACHED."""
+    con = db.conn.connection()
+    names = [row[1] for row in con.execute("PRAGMA database_list;")]
+    attached = len([n for n in names if n not in ("main", "temp")])
+    return con.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED) - attached
+
+
+## Shard workers
+# Run in pool processes (or in-process without a pool); they only use
+# sqlite3, never db's connection.
+_conns = {}
+
+def _shard_conn(path):
+    con = _conns.get(path)
+    if con is None:
+        con = _conns[path] = sqlite3.connect(path, isolation_level=None)
+    return con
+
+def _allocate_shard(path, main_path, where, mark):
+    con = sqlite3.connect(path, isolation_level=None, uri=True)
+    try:
+        con.execute("ATTACH DATABASE ? AS m;", (f"file:{main_path}?mode=ro",))
+        con.execute("BEGIN IMMEDIATE;")
+        cur = con.execute(f"""
+        INSERT INTO result (a_id, b_id, val)
+        SELECT s1.id, s2.id, {db.PENDING}
+        FROM m.sample AS s1 CROSS JOIN m.sample AS s2
+        ON s1.id < s2.id
+        WHERE s2.id > ? AND {where}
+        ON CONFLICT DO NOTHING;
+        """, (mark,))
+        con.execute("COMMIT;")
+        return cur.rowcount
+    finally:
+        con.close()
+
+def _lookup_shard(path, pairs):
+    SQL = """
+    SELECT r.a_id, r.b_id, r.val
+    FROM json_each(?) AS j CROSS JOIN result AS r
+    ON r.a_id = j.value ->> '$[0]' AND r.b_id = j.value ->> '$[1]';
+    """
+    return _shard_conn(path).execute(SQL, (json.dumps(pairs),)).fetchall()
+
+
+class ShardedResults:
+    def __init__(self, shards, scheme="hash", bounds=None, workers=None):
+        if scheme not in SCHEMES:
+            raise ValueError(f"Unknown sharding scheme: {scheme!r}")
+        # checked before create() writes anything
+        limit = max_shards()
+        if not 1 <= shards <= limit:
+            raise ValueError(f"{shards} shards, SQLite can attach 1 to {limit}")
+        self.path = db.conn.database
+        self.shards = shards
+        self.scheme = scheme
+        self.bounds = bounds
+        if workers is None:
+            workers = min(shards, os.cpu_count())
+        # workers = 0 runs every shard in this process, one after another
+        self._pool = ProcessPoolExecutor(workers) if workers else None
+        self._attached = []
+
+    @classmethod
+    def create(cls, shards, scheme="hash", workers=None):
+        """
+        Shard the database currently open through ``db.open``: create the
+        shard files and record the shard map. "range" bounds are computed
+        from the samples present now.
+        """
+        if db.Attachment.get_or_none(db.Attachment.key == MAP_KEY) is not None:
+            raise ValueError(f"{db.conn.database} is sharded already")
+        bounds = None
+        if scheme == "range":
+            max_id = db.Sample.select(fn.MAX(db.Sample.id)).scalar() or 1
+            bounds = range_bounds(max_id, shards)
+        sr = cls(shards, scheme, bounds, workers)
+        for i in range(shards):
+            con = sqlite3.connect(sr.shard_path(i))
+            con.execute("PRAGMA journal_mode = wal;") # readers never block writers
+            con.execute(SHARD_DDL)
+            con.close()
+        db.Attachment.insert(key=MAP_KEY, val=json.dumps({
+            "shards": shards, "scheme": scheme, "bounds": bounds,
+        })).execute()
+        sr._attach()
+        return sr
+
+    @classmethod
+    def open(cls, workers=None):
+        """Open the shards of the database currently open through ``db.open``."""
+        row = db.Attachment.get_or_none(db.Attachment.key == MAP_KEY)
+        if row is None:
+            raise ValueError(f"{db.conn.database} is not sharded")
+        spec = json.loads(row.val)
+        sr = cls(spec["shards"], spec["scheme"], spec["bounds"], workers)
+        sr._attach()
+        return sr
+
+    def close(self):
+        db.conn.execute_sql("DROP VIEW IF EXISTS temp.result_all;")
+        for name in self._attached:
+            db.conn.execute_sql(f"DETACH DATABASE {name};")
+        self._attached = []
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _attach(self):
+        for i in range(self.shards):
+            name = f"shard{i}"
+            db.conn.execute_sql(
+                f"ATTACH DATABASE ? AS {name};", (self.shard_path(i),)
+            )
+            self._attached.append(name)
+        union = " UNION ALL ".join(
+            f"SELECT a_id, b_id, val FROM {name}.result"
+            for name in self._attached
+        )
+        db.conn.execute_sql(f"CREATE TEMP VIEW result_all AS {union};")
+
+    def shard_path(self, i):
+        return f"{self.path}.shard{i}"
+
+    def shard_of(self, a):
+        if self.scheme == "hash":
+            return a % self.shards
+        return bisect_right(self.bounds, a) - 1
+
+    def _shard_where(self, i, col):
+        """SQL condition on the a_id column ``col`` selecting shard i."""
+        if self.scheme == "hash":
+            return f"{col} % {self.shards} = {i}"
+        lo = self.bounds[i]
+        if i + 1 == self.shards:
+            return f"{col} >= {lo}"
+        return f"{col} >= {lo} AND {col} < {self.bounds[i + 1]}"
+
+    def _fan_out(self, func, args_list):
+        if self._pool is None:
+            return [func(*args) for args in args_list]
+        futures = [self._pool.submit(func, *args) for args in args_list]
+        return [f.result() for f in futures]
+
+    def _split(self, items, key=lambda x: x[0]):
+        parts = {}
+        for item in items:
+            parts.setdefault(self.shard_of(key(item)), []).append(item)
+        return parts
+
+    ## Allocation
+    def allocate(self) -> int:
+        """
+        ``db.allocate_results`` over the shards: every shard inserts its
+        pairs for the samples above the watermark in parallel, reading
+        ``sample`` from the main database. Returns the number created.
+        """
+        row = db.Attachment.get_or_none(db.Attachment.key == WATERMARK_KEY)
+        mark = int(row.val) if row is not None else 0
+        top = db.Sample.select(fn.MAX(db.Sample.id)).scalar()
+        if top is None or top <= mark:
+            return 0
+        counts = self._fan_out(_allocate_shard, [
+            (self.shard_path(i), self.path, self._shard_where(i, "s1.id"), mark)
+            for i in range(self.shards)
+        ])
+        db.Attachment.replace(key=WATERMARK_KEY, val=str(top)).execute()
+        return sum(counts)
+
+    ## Lookup
+    def get_results(self, pairs) -> dict:
+        """Like ``db.get_results(pairs)``, each shard queried in parallel."""
+        parts = self._split(db.normalize_pairs(pairs))
+        rows = self._fan_out(_lookup_shard, [
+            (self.shard_path(i), part) for i, part in parts.items()
+        ])
+        return {(a, b): val for shard in rows for a, b, val in shard}
+
+    ## Writes
+    def bulk_insert(self, rows, on_conflict=None) -> int:
+        """
+        Write ``(a, b, val)`` rows, ``a < b``, to their shards through the
+        attached databases in one transaction. ``on_conflict`` is as for
+        ``db.bulk_insert``.
+        """
+        if on_conflict not in db.CONFLICT_MODES:
+            raise ValueError(f"Unknown on_conflict mode: {on_conflict!r}")
+        verb = {
+            "ignore": "INSERT OR IGNORE",
+            "replace": "INSERT OR REPLACE",
+        }.get(on_conflict, "INSERT")
+        upsert = ""
+        if on_conflict == "update":
+            upsert = " WHERE true ON CONFLICT DO UPDATE SET val = excluded.val"
+
+        count = 0
+        with db.conn.atomic():
+            for i, part in self._split(rows).items():
+                SQL = f"""
+                {verb} INTO shard{i}.result (a_id, b_id, val)
+                SELECT j.value ->> '$[0]', j.value ->> '$[1]', j.value ->> '$[2]'
+                FROM json_each(?) AS j{upsert};
+                """
+                count += db.conn.execute_sql(SQL, (json.dumps(part),)).rowcount
+        return count
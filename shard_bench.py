@@ -0,0 +1,153 @@
+from utils import clock, since
+import pydantic
+import random
+import json
+import glob
+import sqlite3
+import db
+import shard
+import os
+import os.path
+
+class ShardOption(pydantic.BaseModel):
+    sample_count: int = 2000
+    sample_path_fmt: str = "/tmp/sample-{}"
+    test_db_path: str = "bench-shard.db"
+
+    shards: int = 1
+    scheme: str = "hash" # see shard.SCHEMES
+    workers: int = 1     # pool processes, 0 = query shards in this process
+    qry_count: int = 10000
+
+
+def __remove_db(opt: ShardOption):
+    for path in [opt.test_db_path] + glob.glob(opt.test_db_path + ".shard*"):
+        for suffix in ["", "-wal", "-shm", "-journal"]:
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+def __prepare_db(opt: ShardOption, allocate: bool):
+    """Samples and empty shards; allocated too if asked. Reused when it fits."""
+    if allocate and os.path.exists(opt.test_db_path):
+        db.open(opt.test_db_path, wal=True)
+        spec = db.Attachment.get_or_none(db.Attachment.key == shard.MAP_KEY)
+        count = db.Sample.select().count()
+        mark = db.Attachment.get_or_none(db.Attachment.key == shard.WATERMARK_KEY)
+        db.close()
+        if spec is not None and mark is not None and count == opt.sample_count:
+            spec = json.loads(spec.val)
+            if spec["shards"] == opt.shards and spec["scheme"] == opt.scheme:
+                return
+
+    __remove_db(opt)
+    db.open(opt.test_db_path, wal=True)
+    db.bulk_insert(db.Sample, (
+        (opt.sample_path_fmt.format(i),)
+        for i in range(opt.sample_count)
+    ))
+    sr = shard.ShardedResults.create(opt.shards, opt.scheme, workers=opt.workers)
+    if allocate:
+        sr.allocate()
+    sr.close()
+    db.close()
+
+
+def time_shard_alloc(opt = ShardOption()):
+    __prepare_db(opt, allocate=False)
+
+    db.open(opt.test_db_path, wal=True)
+    sr = shard.ShardedResults.open(workers=opt.workers)
+    st = clock()
+    pairs = sr.allocate()
+    elapsed = since(st)
+    count = db.conn.execute_sql("SELECT count(*) FROM result_all;").fetchone()[0]
+    sr.close()
+    db.close()
+
+    expected = opt.sample_count * (opt.sample_count - 1) // 2
+    assert count == expected, f"allocated {count} of {expected} results"
+    print(f"Inserted {pairs} results in {elapsed}")
+    return elapsed, {"rows": pairs, "rows_per_s": pairs / elapsed.total_seconds()}
+
+
+def __gen_qry_pair(opt: ShardOption):
+    pairs = []
+    for i in range(opt.qry_count):
+        a = random.randint(1, opt.sample_count - 1)
+        b = random.randint(a + 1, opt.sample_count)
+        pairs.append((a, b))
+    return pairs
+
+
+def time_shard_qry(opt = ShardOption()):
+    __prepare_db(opt, allocate=True)
+
+    qry_pairs = __gen_qry_pair(opt)
+    db.open(opt.test_db_path, wal=True)
+    sr = shard.ShardedResults.open(workers=opt.workers)
+    sr.get_results(qry_pairs[:10]) # start the pool processes
+    st = clock()
+    valmap = sr.get_results(qry_pairs)
+    elapsed = since(st)
+    sr.close()
+    db.close()
+
+    rows = len(valmap)
+    print(f"Donw in {elapsed}, {rows} results")
+    return elapsed, {"rows": rows, "rps": rows / elapsed.total_seconds()}
+
+
+## Benchmark
+from utils import bench
+
+def __shard_counts():
+    cores = os.cpu_count()
+    # every shard is attached to the main connection
+    limit = sqlite3.connect(":memory:").getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    return sorted({1, 2, 4, 8, cores} & set(range(1, min(cores, limit) + 1)))
+
+
+def bench_shard_alloc():
+    funcs = [
+        time_shard_alloc,
+    ]
+
+    opt_list = [
+        ShardOption(sample_count=n, shards=s, workers=s, scheme=scheme)
+        for scheme in ["hash", "range"]
+        for n in [2000, 5000]
+        for s in __shard_counts()
+    ]
+
+    bench(
+        "Sharded Result Allocation", funcs, opt_list,
+        timeout=120, repeat=3,
+        hint=lambda x: (
+            f"sample_count = {x.sample_count}, shards = {x.shards}, "
+            f"scheme = {x.scheme}"
+        )
+    )
+
+
+def bench_shard_qry():
+    funcs = [
+        time_shard_qry,
+    ]
+
+    opt_list = [
+        ShardOption(qry_count=n, shards=s, workers=s)
+        for n in [1000, 10000, 100000]
+        for s in __shard_counts()
+    ]
+
+    bench(
+        "Sharded Result Query", funcs, opt_list,
+        timeout=30, repeat=5,
+        hint=lambda x: f"qry_count = {x.qry_count}, shards = {x.shards}"
+    )
+
+
+if __name__ == "__main__":
+    bench_shard_alloc()
+    bench_shard_qry()
@@ -0,0 +1,45 @@
+import pytest
+import compare
+import utils
+
+
+def test_row_count_prefers_recorded_rows(capsys):
+    opt = {"sample_count": 100, "qry_count": 7}
+    extras = [{"rows": 10}, None, {"rows": 20}]
+    assert compare.row_count("time_qry_cross", opt, extras=extras) == 15
+    assert compare.row_count("time_qry_x", opt, extras=[{"pairs": 4}]) == 4
+    assert capsys.readouterr().err == ""
+
+
+def test_row_count_warns_when_guessing(capsys):
+    opt = {"sample_count": 100, "qry_count": 7}
+    assert compare.row_count("time_qry_guessed", opt) == 7
+    assert "time_qry_guessed" in capsys.readouterr().err
+    compare.row_count("time_qry_guessed", opt)
+    assert capsys.readouterr().err == "" # once per method
+
+
+def test_row_count_explicit():
+    opt = {"sample_count": 100, "report_count": 5}
+    extras = [{"rows": 10}]
+    assert compare.row_count("time_x", opt, rows="pairs", extras=extras) == 4950
+    assert compare.row_count("time_x", opt, rows="report_count") == 5
+
+
+def test_summarize():
+    assert utils.summarize([None, -1]) is None
+    stats = utils.summarize([1.0, 2.0, 3.0, None, -1])
+    assert stats["n"] == 3
+    assert stats["mean"] == stats["median"] == 2.0
+    assert stats["stdev"] == 1.0
+    lo, hi = stats["ci95"]
+    assert lo == pytest.approx(2.0 - utils.t95(2) / 3 ** 0.5)
+    assert hi == pytest.approx(2.0 + utils.t95(2) / 3 ** 0.5)
+    assert utils.summarize([2.0])["ci95"] == [2.0, 2.0]
+
+
+def test_welch():
+    assert compare.welch([1.0], [2.0, 3.0]) is None
+    assert compare.welch([1.0, 1.01, 0.99], [2.0, 2.01, 1.99])
+    assert not compare.welch([1.0, 2.0, 3.0], [1.1, 2.1, 2.9])
+    assert compare.welch([1.0, 1.0], [1.0, 1.0]) is False
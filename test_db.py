@@ -0,0 +1,151 @@
+import sqlite3
+import time
+import peewee
+import pytest
+import db
+import matrix
+
+
+@pytest.fixture
+def database(tmp_path):
+    def open_(layout='pair', n=5, **kwargs):
+        db.open(str(tmp_path / "test.db"), layout=layout, **kwargs)
+        db.resolve_paths([f"/tmp/sample-{i}" for i in range(n)])
+        db.allocate_results()
+    yield open_
+    db.close()
+
+
+def _all_results():
+    return dict(((a, b), val) for a, b, val in db.conn.execute_sql(
+        "SELECT a_id, b_id, val FROM result ORDER BY a_id, b_id;"
+    ))
+
+
+@pytest.mark.parametrize("layout", db.LAYOUTS)
+def test_layout_round_trip(database, layout):
+    database(layout)
+    assert len(_all_results()) == 10
+    db.update_row(db.Result, 0.5, 1, 2)
+    db.bulk_insert(db.Result, [(2, 3, 0.25)], on_conflict='update')
+    db.Result.update(val=0.75).where(
+        (db.Result.a == 4) & (db.Result.b == 5)
+    ).execute()
+    assert db.get_results([(2, 1), (2, 3), (4, 5)]) == {
+        (1, 2): 0.5, (2, 3): 0.25, (4, 5): 0.75,
+    }
+
+
+@pytest.mark.parametrize("layout", ['tri', 'tri_without_rowid'])
+def test_tri_rejects_unordered_pairs(database, layout):
+    database(layout)
+    with pytest.raises((sqlite3.IntegrityError, peewee.IntegrityError)):
+        db.create_row(db.Result, 3, 2, 0.5)
+    with pytest.raises((sqlite3.IntegrityError, peewee.IntegrityError)):
+        db.conn.execute_sql("INSERT INTO result VALUES (3, 3, 0.5);")
+
+
+def test_migrate_layout(database):
+    database('pair')
+    db.create_queue_index()
+    db.update_row(db.Result, 0.5, 1, 2)
+    before = _all_results()
+    for layout in ['tri', 'tri_without_rowid', 'pair']:
+        db.migrate_layout(layout)
+        assert db.result_layout == layout
+        assert _all_results() == before
+        names = set(db._schema_names())
+        assert 'result_pending' in names or 'result_tri_pending' in names
+
+
+def test_claim_batch(database):
+    database()
+    first = db.claim_batch("w1", 4)
+    second = db.claim_batch("w2", 10)
+    assert len(first) == 4 and len(second) == 6
+    assert not set(first) & set(second)
+    assert db.claim_batch("w3", 10) == []
+    assert set(_all_results().values()) == {db.DISPATCHED}
+    assert db.Lease.select().count() == 10
+
+
+def test_reclaim_expired(database):
+    database()
+    pairs = db.claim_batch("w1", 3, lease_time=60)
+    assert db.reclaim_expired() == 0
+    assert db.reclaim_expired(now=time.time() + 120) == 3
+    assert db.Lease.select().count() == 0
+    assert all(_all_results()[p] == db.PENDING for p in pairs)
+    assert sorted(db.claim_batch("w2", 10)) == sorted(_all_results())
+
+
+def test_result_sink_flushes_on_close(database):
+    database()
+    sink = db.ResultSink(max_rows=100, max_delay=None)
+    sink.put(2, 1, 0.5)
+    sink.put_many([(3, 4, 0.25)])
+    assert _all_results()[(1, 2)] == db.PENDING
+    sink.close()
+    assert sink.flushed == 2
+    assert db.get_results([(1, 2), (3, 4)]) == {(1, 2): 0.5, (3, 4): 0.25}
+    with pytest.raises(ValueError):
+        sink.put(1, 3, 1.0)
+
+
+def test_result_sink_raises_background_error(database):
+    database()
+    sink = db.ResultSink(max_rows=100, max_delay=0.01)
+    def fail():
+        raise sqlite3.OperationalError("disk I/O error")
+    sink._write = fail
+    sink.put(1, 2, 0.5)
+    sink._thread.join(5)
+    with pytest.raises(sqlite3.OperationalError):
+        sink.put(1, 3, 0.5)
+    del sink._write
+    sink.put(1, 3, 0.25)
+    sink.close()
+    assert db.get_results([(1, 2), (1, 3)]) == {(1, 2): 0.5, (1, 3): 0.25}
+
+
+def _generation():
+    return int(db.Attachment.get(db.Attachment.key == db.MATRIX_GENERATION_KEY).val)
+
+
+def test_generation_bumped_once_per_transaction(database):
+    database()
+    db.Attachment.insert(key=db.MATRIX_GENERATION_KEY, val="0").execute()
+    with db.conn.atomic():
+        db.update_row(db.Result, 0.5, 1, 2)
+        db.update_row(db.Result, 0.5, 1, 3)
+    assert _generation() == 1
+    db.update_row(db.Result, 0.5, 1, 4)
+    assert _generation() == 2
+    db.update_row(db.Result, 0.5, 1, 9) # no such pair
+    assert _generation() == 2
+    with db.conn.atomic():
+        with db.conn.atomic() as sp:
+            db.update_row(db.Result, 0.25, 1, 2)
+            sp.rollback()
+        db.update_row(db.Result, 0.25, 1, 3)
+    assert _generation() == 3
+
+
+def test_matrix_rebuilds_after_db_write(database, tmp_path):
+    database()
+    path = str(tmp_path / "test.db.tri")
+    with matrix.DistanceMatrix.open(path) as m:
+        m.set([1], [2], 0.5)
+        assert m.get([1], [2])[0] == 0.5
+    db.update_row(db.Result, 0.25, 1, 3)
+    with matrix.DistanceMatrix.open(path) as m:
+        assert m.get([1, 1], [2, 3]).tolist() == [0.5, 0.25]
+
+
+def test_allocate_after_deleting_the_last_sample(database):
+    database(n=3)
+    db.Result.delete().where(db.Result.b == 3).execute()
+    db.Sample.delete().where(db.Sample.id == 3).execute()
+    assert db.resolve_paths(["/tmp/new"]) == {"/tmp/new": 4}
+    assert db.allocate_results() == 2
+    assert sorted(_all_results()) == [(1, 2), (1, 4), (2, 4)]
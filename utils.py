@@ -1,3 +1,4 @@
+import cProfile
 import multiprocessing as mp
 import pydantic
 import time
@@ -6,25 +7,181 @@ from datetime import datetime, timedelta
 import os
 import sys
 import json
+import math
+import platform
+import sqlite3
+import statistics
+import resource
+import tracemalloc
+import db
 
+## Timing
+# Measured functions time themselves:
+#     st = clock()
+#     ...
+#     elapsed = since(st)
+# With instrumentation, clock() restarts db's phase timers and since() marks
+# the end of the measured block, so checks after it, e.g. in a
+# db.phase("check"), are reported apart from the breakdown. With usage
+# accounting, they also delimit the block measured by usage_report().
+class Elapsed(timedelta):
+    """A timedelta that keeps the nanoseconds measured by perf_counter_ns."""
+
+    def __new__(cls, ns):
+        self = super().__new__(cls, microseconds=ns / 1000)
+        self.ns = ns
+        return self
+
+    def total_seconds(self):
+        return self.ns / 1e9
+
+    def __reduce__(self):
+        return (Elapsed, (self.ns,))
+
+def clock() -> int:
+    db.reset_phases()
+    if _usage is not None:
+        __usage_start()
+    return time.perf_counter_ns()
+
+def since(st: int) -> Elapsed:
+    elapsed = Elapsed(time.perf_counter_ns() - st)
+    db.mark_phases()
+    if _usage is not None:
+        __usage_stop()
+    return elapsed
+
+
+## Usage accounting
+# Of the block between clock() and since():
+#   peak_rss          bytes, VmHWM reset through /proc/self/clear_refs; where
+#                     that is not allowed (peak_rss_reset false) the peak of
+#                     the whole process
+#   tracemalloc_peak  bytes of Python allocations, if traced (slows them down)
+#   io                /proc/self/io deltas: rchar/wchar count every read and
+#                     write call, read_bytes/write_bytes what reached storage
+#   db_size, wal_size bytes, of db.conn's files at since()
+#   sqlite_cache      db.db_status() at since(), reset at clock(); only
+#                     with sqlite_status, None otherwise
+# Processes started by the block are not included.
+_usage = None # the measurement in progress, None when not accounting
+_sqlite_status = False
+
+def account(on=True, trace_malloc=False, sqlite_status=False):
+    """Turn usage accounting of clock()/since() blocks on or off."""
+    global _usage, _sqlite_status
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _usage = {} if on else None
+    _sqlite_status = on and sqlite_status
+    if on and trace_malloc:
+        tracemalloc.start()
+
+def usage_report() -> dict:
+    return _usage or None
+
+def __proc_ints(path):
+    """``key: value`` lines of a /proc file, values as ints; {} if unreadable."""
+    out = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                key, _, val = line.partition(":")
+                val = val.split()
+                if val and val[0].isdigit():
+                    out[key] = int(val[0])
+    except OSError:
+        pass
+    return out
+
+def __peak_rss():
+    hwm = __proc_ints("/proc/self/status").get("VmHWM")
+    if hwm is not None:
+        return hwm * 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def __usage_start():
+    _usage.clear()
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5") # reset VmHWM
+        _usage["peak_rss_reset"] = True
+    except OSError:
+        _usage["peak_rss_reset"] = False
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    _usage["io"] = __proc_ints("/proc/self/io")
+    if _sqlite_status:
+        db.db_status(reset=True)
+
+def __usage_stop():
+    _usage["peak_rss"] = __peak_rss()
+    _usage["tracemalloc_peak"] = None
+    if tracemalloc.is_tracing():
+        _usage["tracemalloc_peak"] = tracemalloc.get_traced_memory()[1]
+    io = __proc_ints("/proc/self/io")
+    _usage["io"] = {k: v - _usage["io"].get(k, 0) for k, v in io.items()}
+    _usage["sqlite_cache"] = db.db_status() if _sqlite_status else None
+    _usage["db_size"] = _usage["wal_size"] = None
+    if getattr(db.conn, "obj", None) and db.conn.database != ":memory:":
+        for key, path in [("db_size", db.conn.database),
+                          ("wal_size", db.conn.database + "-wal")]:
+            if os.path.exists(path):
+                _usage[key] = os.path.getsize(path)
+
+
+## Runners
 class RunRst(pydantic.BaseModel):
     rtn: Any = None
     err: str = None
     timeout: bool = False
+    phases: Any = None # db.phase_report() of the run when instrumented
+    usage: Any = None  # usage_report() of the run when accounting
 
-def run_wrapper(func, args, kwargs, que):
-    err = None
-    rst = None
+def measured_call(func, args=(), kwargs={}, instrument=False, profile=None,
+                  usage=False, trace_malloc=False, sqlite_status=False):
+    """
+    Call ``func`` in this process, with db instrumentation and usage
+    accounting if asked and under cProfile if ``profile`` names a file for
+    the stats. Returns ``(return value, error, phases, usage)``.
+    """
+    rst, err = None, None
+    # calibrate() rewrites the cost model; runs in a warm worker start afresh
+    cost_model = dict(db.COST_MODEL)
+    db.instrument(instrument)
+    account(usage, trace_malloc, sqlite_status)
+    prof = cProfile.Profile() if profile else None
     try:
-        sys.stdout = open(os.devnull, 'w')
+        if prof is not None:
+            prof.enable()
         rst = func(*args, **kwargs)
     except Exception as e:
         err = str(e)
-    que.put((rst, err))
+    finally:
+        # as the process exit would, for the runs to come in a warm worker
+        db.close()
+        db.set_cost_model(cost_model)
+        if prof is not None:
+            prof.disable()
+            os.makedirs(os.path.dirname(profile) or ".", exist_ok=True)
+            prof.dump_stats(profile)
+    phases, used = db.phase_report(), usage_report()
+    db.instrument(False)
+    account(False)
+    return rst, err, phases, used
 
-def run_with_timeout(func, args=(), kwargs={}, timeout: float = 5) -> RunRst:
+def run_wrapper(func, args, kwargs, que, *measure):
+    sys.stdout = open(os.devnull, 'w')
+    que.put(measured_call(func, args, kwargs, *measure))
+
+def run_with_timeout(func, args=(), kwargs={}, timeout: float = 5,
+                     instrument=False, profile=None, usage=False,
+                     trace_malloc=False, sqlite_status=False) -> RunRst:
     que = mp.Queue()
-    p = mp.Process(target=run_wrapper, args=(func, args, kwargs, que))
+    p = mp.Process(target=run_wrapper, args=(
+        func, args, kwargs, que, instrument, profile, usage, trace_malloc,
+        sqlite_status,
+    ))
     p.start()
     p.join(timeout)
 
@@ -38,16 +195,179 @@ def run_with_timeout(func, args=(), kwargs={}, timeout: float = 5) -> RunRst:
         except: raise RuntimeError("Failed to terminate the process")
     
     try: 
-        (rtn, err) = que.get_nowait()
+        (rtn, err, phases, used) = que.get_nowait()
         rst.rtn = rtn
         rst.err = err
+        rst.phases = phases
+        rst.usage = used
     except: 
         pass
 
     return rst
 
 
-def bench(name, funcs, opt_list, repeat=1, timeout=5, hint=lambda x: f"sample_count = {x.sample_count}"):
+def warm_worker_main(conn):
+    sys.stdout = open(os.devnull, 'w')
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            break
+        if msg is None:
+            break
+        rst, err, phases, used = measured_call(*msg)
+        try:
+            conn.send((rst, err, phases, used))
+        except Exception as e:
+            conn.send((None, f"Failed to send the result: {e}", None, None))
+
+class WarmWorker:
+    """
+    A benchmark process reused across runs, so process start-up and module
+    imports are paid once instead of in every measurement. A run that
+    overruns its timeout kills the process and a fresh one takes its place.
+    """
+
+    def __init__(self):
+        self._start()
+
+    def _start(self):
+        self._conn, child = mp.Pipe()
+        # not a daemon: benchmarks start processes of their own
+        self._proc = mp.Process(target=warm_worker_main, args=(child,))
+        self._proc.start()
+        child.close()
+
+    def restart(self):
+        self._proc.kill()
+        self._proc.join()
+        self._conn.close()
+        self._start()
+
+    def run(self, func, args=(), kwargs={}, timeout: float = 5,
+            instrument=False, profile=None, usage=False,
+            trace_malloc=False, sqlite_status=False) -> RunRst:
+        rst = RunRst()
+        self._conn.send((
+            func, args, kwargs, instrument, profile, usage, trace_malloc,
+            sqlite_status,
+        ))
+        if not self._conn.poll(timeout):
+            rst.timeout = True
+            self.restart()
+            return rst
+        try:
+            rst.rtn, rst.err, rst.phases, rst.usage = self._conn.recv()
+        except EOFError:
+            rst.err = f"Worker died with exit code {self._proc.exitcode}"
+            self.restart()
+        return rst
+
+    def close(self):
+        if self._proc.is_alive():
+            self._conn.send(None)
+            self._proc.join(5)
+            if self._proc.is_alive():
+                self._proc.kill()
+                self._proc.join()
+        self._conn.close()
+
+
+## Statistics & environment
+# two-sided 95% Student t quantiles by degrees of freedom
+T95 = {
+    1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365,
+    8: 2.306, 9: 2.262, 10: 2.228, 15: 2.131, 20: 2.086, 30: 2.042,
+}
+
+def t95(df):
+    if df > 30:
+        return 1.96
+    return T95[max(k for k in T95 if k <= df)]
+
+def summarize(times) -> dict:
+    """Statistics of the successful runs in ``times`` (seconds)."""
+    times = [t for t in times if t is not None and t >= 0]
+    if not times:
+        return None
+    n = len(times)
+    mean = statistics.fmean(times)
+    stdev = statistics.stdev(times) if n > 1 else 0.0
+    half = t95(n - 1) * stdev / math.sqrt(n) if n > 1 else 0.0
+    return {
+        "n": n, "mean": mean, "median": statistics.median(times),
+        "stdev": stdev, "min": min(times), "max": max(times),
+        "ci95": [mean - half, mean + half],
+    }
+
+def __cpu_model():
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+def __filesystem(path):
+    """(mount point, fs type) holding path, from /proc/mounts."""
+    path = os.path.realpath(path)
+    best = (None, None)
+    try:
+        with open("/proc/mounts") as f:
+            for line in f:
+                _, mnt, fstype = line.split()[:3]
+                inside = path == mnt or path.startswith(mnt.rstrip("/") + "/")
+                if inside and len(mnt) >= len(best[0] or ""):
+                    best = (mnt, fstype)
+    except OSError:
+        pass
+    return best
+
+def environment() -> dict:
+    import peewee
+    mount, fstype = __filesystem(os.getcwd())
+    return {
+        "time": datetime.now().isoformat(),
+        "python": sys.version,
+        "sqlite": sqlite3.sqlite_version,
+        "peewee": peewee.__version__,
+        "platform": platform.platform(),
+        "cpu": __cpu_model(),
+        "cpu_count": os.cpu_count(),
+        "cwd_mount": mount,
+        "cwd_fs": fstype,
+    }
+
+
+def __with_other(phases, elapsed):
+    if phases is None or elapsed is None or elapsed < 0:
+        return phases
+    timed = sum(phases["time"].values())
+    phases["time"]["other"] = max(0.0, elapsed - timed)
+    return phases
+
+
+def bench(name, funcs, opt_list, repeat=1, timeout=5, hint=lambda x: f"sample_count = {x.sample_count}",
+          warmup=1, fresh_process=False, instrument=False, profile=False,
+          usage=True, trace_malloc=False, sqlite_status=False):
+    """
+    Run every function on every option ``repeat`` times after ``warmup``
+    discarded runs, and save the records to ``data/<name>.json``. Runs
+    share one warm worker process; ``fresh_process=True`` starts a new one
+    for every run instead. A warm worker closes the database and restores
+    ``db.COST_MODEL`` after every run; other module state is shared.
+
+    ``instrument=True`` records db's phase breakdown of every run (see
+    ``db.instrument``); it adds a little overhead to each statement.
+    ``profile=True`` saves cProfile stats of every run under
+    ``data/profile/<name>/``.
+    ``usage=True`` records memory, I/O and file sizes of every run (see
+    "Usage accounting"); ``trace_malloc=True`` adds the tracemalloc peak,
+    at the cost of slower Python allocations, and ``sqlite_status=True``
+    SQLite's page-cache counters (see ``db.db_status``).
+    """
     print(f"Start benchmarking {name}")
     print(f"Funcs: ")
     for f in funcs:
@@ -58,40 +378,106 @@ def bench(name, funcs, opt_list, repeat=1, timeout=5, hint=lambda x: f"sample_co
         print(f"- {opt}")
     
     records = {}
+    records["name"] = name
     records["options"] = [opt.dict() for opt in opt_list]
     records["results"] = {} # records["results"][fn_name][opt_idx][rpt_idx]
+    # Functions may return (elapsed, extra) where extra is a JSON-able dict
+    # of additional measurements, kept in records["extra"][fn_name][opt_idx][rpt_idx]
+    records["extra"] = {}
+    # db.phase_report() of every run, "other" being the measured time no
+    # phase accounts for: records["phases"][fn_name][opt_idx][rpt_idx]
+    if instrument:
+        records["phases"] = {}
+    # usage_report() of every run: records["usage"][fn_name][opt_idx][rpt_idx]
+    if usage:
+        records["usage"] = {}
+
+    records["warmup"] = warmup
+    records["env"] = environment()
+
+    worker = None if fresh_process else WarmWorker()
+    def run(f, opt, profile=None):
+        measure = dict(
+            instrument=instrument, profile=profile,
+            usage=usage, trace_malloc=trace_malloc, sqlite_status=sqlite_status,
+        )
+        if worker is None:
+            return run_with_timeout(f, args=(opt,), timeout=timeout, **measure)
+        return worker.run(f, args=(opt,), timeout=timeout, **measure)
 
     print("Progress: ")
-    for f in funcs:
-        fn = f.__name__
-        records["results"][fn] = []   
-        for opt_idx, opt in enumerate(opt_list):
-            rpt_rcds = []
-            for r in range(1, repeat + 1):
-                print(f"- ({r}/{repeat}) Running {f.__name__}, {hint(opt)}... ", end="")
-                rst = run_with_timeout(f, args=(opt,), timeout=timeout)
-                if rst.timeout:
-                    print("Timeout")
-                    rpt_rcds.append(None)
-                elif rst.err:
-                    print(f"Error: {rst.err}")
-                    rpt_rcds.append(-1)
-                else:
-                    print(f"Done in {rst.rtn}")
-                    rpt_rcds.append(rst.rtn.total_seconds())
-            records["results"][fn].append(rpt_rcds)
+    try:
+        for f in funcs:
+            fn = f.__name__
+            records["results"][fn] = []   
+            records["extra"][fn] = []
+            if instrument:
+                records["phases"][fn] = []
+            if usage:
+                records["usage"][fn] = []
+            for opt_idx, opt in enumerate(opt_list):
+                rpt_rcds = []
+                rpt_extra = []
+                rpt_phases = []
+                rpt_usage = []
+                warm_timeout = False
+                for w in range(1, warmup + 1):
+                    print(f"- (warmup {w}/{warmup}) Running {f.__name__}, {hint(opt)}... ", end="")
+                    rst = run(f, opt)
+                    warm_timeout = rst.timeout
+                    print("Timeout" if rst.timeout else f"Error: {rst.err}" if rst.err else "Done")
+                    if warm_timeout:
+                        break
+                for r in range(1, repeat + 1):
+                    if warm_timeout: # would time out again
+                        rpt_rcds.append(None)
+                        rpt_extra.append(None)
+                        rpt_phases.append(None)
+                        rpt_usage.append(None)
+                        continue
+                    print(f"- ({r}/{repeat}) Running {f.__name__}, {hint(opt)}... ", end="")
+                    prof = f"data/profile/{name}/{fn}-{opt_idx}-{r}.prof" if profile else None
+                    rst = run(f, opt, prof)
+                    extra = None
+                    if isinstance(rst.rtn, tuple):
+                        rst.rtn, extra = rst.rtn
+                    rpt_extra.append(extra)
+                    if rst.timeout:
+                        print("Timeout")
+                        rpt_rcds.append(None)
+                    elif rst.err or not isinstance(rst.rtn, timedelta):
+                        print(f"Error: {rst.err or f'returned {rst.rtn!r}, not a timedelta'}")
+                        rpt_rcds.append(-1)
+                    else:
+                        print(f"Done in {rst.rtn}")
+                        rpt_rcds.append(rst.rtn.total_seconds())
+                    rpt_phases.append(__with_other(rst.phases, rpt_rcds[-1]))
+                    rpt_usage.append(rst.usage)
+                records["results"][fn].append(rpt_rcds)
+                records["extra"][fn].append(rpt_extra)
+                if instrument:
+                    records["phases"][fn].append(rpt_phases)
+                if usage:
+                    records["usage"][fn].append(rpt_usage)
+    finally:
+        # an exception must not leave the (non-daemon) worker behind
+        if worker is not None:
+            worker.close()
     print("Benchmarking done")
 
-    # Digest
+    # Digest, timeouts (None) and errors (-1) left out
     records["digest"] = {} # records["digest"][fn_name][opt_idx] -> avg time
+    records["stats"] = {}  # records["stats"][fn_name][opt_idx] -> summarize()
     for f in funcs:
         fn = f.__name__
         records["digest"][fn] = []
+        records["stats"][fn] = []
         for opt_idx, opt in enumerate(opt_list):
-            rpt_rcds = records["results"][fn][opt_idx]
-            rpt_rcds = [r for r in rpt_rcds if r is not None]
-            avg_time = sum(rpt_rcds) / len(rpt_rcds) if rpt_rcds else None
-            records["digest"][fn].append(avg_time)
+            stats = summarize(records["results"][fn][opt_idx])
+            records["digest"][fn].append(stats["mean"] if stats else None)
+            records["stats"][fn].append(stats)
 
     with open(f"data/{name}.json", "w") as f:
-        json.dump(records, f, indent=2, ensure_ascii=False)
\ No newline at end of file
+        json.dump(records, f, indent=2, ensure_ascii=False)
+
+    return records
\ No newline at end of file